@@ -85,6 +85,19 @@ def action2seq(action_seq, atis_controller, general_controller, entity_lex_map={
     if not legal_action_seq:
         logical_form = ['a']
         return logical_form
+    return action2seq_from_state(node_dict, entity_node_dict, operation_dict, return_node,
+                                 db_triple, fun_trace_list_in)
+
+def action2seq_from_state(node_dict, entity_node_dict, operation_dict, return_node, db_triple,
+                          fun_trace_list_in):
+    """Render the logical form of an action sequence from the controller state.
+
+    The state is what the general controller builds while reading a legal
+    action sequence, e.g. the state a finished beam derivation holds, so the
+    sequence does not need to be read again.
+    """
+    logical_form = []
+    legal_action_seq = True
 
     if 'node' not in return_node:
         return_node['node'] = []
@@ -8,6 +8,7 @@ import re
 import sys
 
 from lexicon import Lexicon
+import lexiconcache
 
 DB_DIR = os.path.join(
     os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
@@ -70,7 +71,7 @@ def handle_flight_numbers(lex):
 def handle_dollars(lex):
   lex.add_handler('([0-9]+) dollars$', lambda m: '%d:_do' % int(m.group(1)))
 
-def get_manual_lexicon():
+def get_manual_lexicon(add_handlers=True):
   DAYS_OF_WEEK = [
       (s, '%s:_da' % s) 
       for s in ('monday', 'tuesday', 'wednesday', 'thursday', 
@@ -87,7 +88,6 @@ def get_manual_lexicon():
   lex.add_entries([(x + 's', y) for x, y in DAYS_OF_WEEK])  # Handle "on tuesdays"
   lex.add_entries(read_db('AIRLINE.TAB', 0, 1, '_al',
                           strip_name=[', inc.', ', ltd.']))
-  handle_times(lex)
   lex.add_entries(read_db('INTERVAL.TAB', 0, 0, '_pd'))
   lex.add_entries(WORD_NUMBERS)
   lex.add_entries(ORDINAL_NUMBERS)
@@ -96,11 +96,19 @@ def get_manual_lexicon():
                           strip_name=[], split_name=['/']))
   lex.add_entries(read_db('COMP_CLS.TAB', 1, 1, '_cl'))
   lex.add_entries(read_db('CLS_SVC.TAB', 0, 0, '_fb', prefix_name='code '))
-  handle_flight_numbers(lex)
   lex.add_entries(MEALS)
-  handle_dollars(lex)
+  if add_handlers:
+    add_manual_handlers(lex)
   return lex
 
+def add_manual_handlers(lex):
+  handle_times(lex)
+  handle_flight_numbers(lex)
+  handle_dollars(lex)
+
+MANUAL_DB_FILES = ['CITY.TAB', 'AIRLINE.TAB', 'INTERVAL.TAB', 'MONTH.TAB',
+                   'AIRPORT.TAB', 'COMP_CLS.TAB', 'CLS_SVC.TAB']
+
 #   8207 _ci = cities
 #    888 _da = days of the week
 #    735 _al = airlines
@@ -151,9 +159,19 @@ def get_ccg_lexicon():
   lexicon.add_entries(entries)
   return lexicon
 
+def get_cached_manual_lexicon():
+  return lexiconcache.load_or_build(
+      'atis-manual', [os.path.join(DB_DIR, x) for x in MANUAL_DB_FILES],
+      lambda: get_manual_lexicon(add_handlers=False),
+      add_handlers_fn=add_manual_handlers)
+
+def get_cached_ccg_lexicon():
+  return lexiconcache.load_or_build(
+      'atis-ccg', [os.path.join(DB_DIR, 'lexicon.txt')], get_ccg_lexicon)
+
 def get_lexicon():
-  return get_ccg_lexicon()
-  #return get_manual_lexicon()
+  return get_cached_ccg_lexicon()
+  #return get_cached_manual_lexicon()
 
 if __name__ == '__main__':
   # Print out the lexicon
@@ -14,10 +14,29 @@ import copy
 
 from attnspec import AttentionSpec
 from derivation import Derivation
-from neural import NeuralModel, CLIP_THRESH, NESTEROV_MU
+from neural import NeuralModel, DecodingBudget, CLIP_THRESH, NESTEROV_MU
 from vocabulary import Vocabulary
 from action_vocabulary import ActionVocabulary
 
+class GreedyHypothesis(object):
+  """The actions decoded greedily for one example, and the controller state they built."""
+  def __init__(self):
+    self.y_tok_seq = []
+    self.p_y_seq = []  # Should be handy for error analysis
+    self.p = 1
+    self.done = False
+    self.gen_pre_action_in = ''
+    self.gen_pre_action_class_in = 'start'
+    self.gen_pre_arg_list_in = []
+    self.node_dict = {}
+    self.type_node_dict = {}
+    self.entity_node_dict = {}
+    self.operation_dict = {}
+    self.edge_dict = {}
+    self.return_node = {}
+    self.db_triple = {}
+    self.fun_trace_list_in = []
+
 class AttentionModel(NeuralModel):
   """An encoder-decoder RNN model."""
   def setup(self):
@@ -78,6 +97,64 @@ class AttentionModel(NeuralModel):
     self._decoder_write = theano.function(
         inputs=[annotations, h_prev], outputs=[write_dist, c_t, alpha])
 
+  def setup_batch_decoder(self):
+    """Compile batched versions of the test-time functions.
+
+    Each function maps the single-example computation over a batch,
+    so one theano call serves every example.  Inputs have different
+    lengths, so they are padded; the lengths are passed alongside,
+    and outputs whose size depends on the input length (annotations,
+    alpha, and write_dist when copying) are zero-padded to the longest.
+    Compiled on first use, since only serving needs them.
+    """
+    if hasattr(self, '_encode_batch'):
+      return
+    shared = self.spec.get_all_shared()
+
+    x = T.lmatrix('x_for_batch_enc')
+    x_lens = T.lvector('x_lens_for_batch_enc')
+    def encode_one(x_b, len_b, max_len, *params):
+      dec_init_state, annotations = self._symb_encoder(x_b[:len_b])
+      padded = T.zeros((max_len, annotations.shape[1]), dtype=annotations.dtype)
+      padded = T.set_subtensor(padded[:len_b], annotations)
+      return dec_init_state, padded
+    (dec_init_states, all_annotations), _ = theano.map(
+        encode_one, sequences=[x, x_lens],
+        non_sequences=[x.shape[1]] + shared)
+    self._encode_batch = theano.function(
+        inputs=[x, x_lens], outputs=[dec_init_states, all_annotations])
+
+    annotations = T.tensor3('annotations_for_batch_write')
+    ann_lens = T.lvector('ann_lens_for_batch_write')
+    h_prev = T.matrix('h_prev_for_batch_write')
+    def write_one(ann_b, len_b, h_b, max_len, *params):
+      cur_annotations = ann_b[:len_b]
+      h_for_write = self.spec.decoder.get_h_for_write(h_b)
+      scores = self.spec.get_attention_scores(h_for_write, cur_annotations)
+      alpha = self.spec.get_alpha(scores)
+      c_t = self.spec.get_context(alpha, cur_annotations)
+      write_dist = self.spec.f_write(h_for_write, c_t, scores)
+      num_pad = max_len - len_b
+      if self.spec.attention_copying:
+        write_dist = T.concatenate([write_dist, T.zeros((num_pad,), dtype=write_dist.dtype)])
+      alpha = T.concatenate([alpha, T.zeros((num_pad,), dtype=alpha.dtype)])
+      return write_dist, c_t, alpha
+    (write_dists, c_ts, alphas), _ = theano.map(
+        write_one, sequences=[annotations, ann_lens, h_prev],
+        non_sequences=[annotations.shape[1]] + shared)
+    self._decoder_write_batch = theano.function(
+        inputs=[annotations, ann_lens, h_prev], outputs=[write_dists, c_ts, alphas])
+
+    y = T.lvector('y_for_batch_dec')
+    c_prev = T.matrix('c_prev_for_batch_dec')
+    h_prev = T.matrix('h_prev_for_batch_dec')
+    def step_one(y_b, c_b, h_b, *params):
+      return self.spec.f_dec(y_b, c_b, h_b)
+    h_ts, _ = theano.map(step_one, sequences=[y, c_prev, h_prev],
+                         non_sequences=shared)
+    self._decoder_step_batch = theano.function(
+        inputs=[y, c_prev, h_prev], outputs=h_ts)
+
   def setup_backprop(self):
     eta = T.scalar('eta_for_backprop')
     x = T.lvector('x_for_backprop')
@@ -202,88 +279,314 @@ class AttentionModel(NeuralModel):
           ret_list[i] = 1.0
       return ret_list
 
-  def decode_greedy(self, domain, ex, domain_convertor, domain_controller, general_controller, max_len=100):
-    h_t, annotations = self._encode(ex.x_inds)
-    y_tok_seq = []
-    p_y_seq = []  # Should be handy for error analysis
-    p = 1
-    break_flag = False
+  def _profiled(self, fn, phase):
+    """fn, counted towards a phase of decoding if there is a profiler."""
+    if self.profiler is None or fn is None:
+      return fn
+    return self.profiler.wrap(fn, phase)
+
+  def _profile_decode(self, ex, decode_fn, *args):
+    """Run the decode of ex, timed as a whole if there is a profiler.
+
+    If there is a trace recorder, the legality queries made are recorded
+    as those of ex.
+    """
+    if self.trace_recorder is not None:
+      self.trace_recorder.begin(ex.x_str)
+    if self.profiler is not None:
+      self.profiler.begin()
+    try:
+      return decode_fn(*args)
+    finally:
+      if self.profiler is not None:
+        self.profiler.end()
+      if self.trace_recorder is not None:
+        self.trace_recorder.end()
+
+  def decode_greedy(self, domain, ex, domain_convertor, domain_controller, general_controller, max_len=100,
+                    time_limit=None, step_limit=None):
+    """Greedy decoding.
+
+    With a time_limit (in seconds) or step_limit (in decoder steps),
+    stops calling the decoder once the budget is spent, and completes the
+    actions decoded so far with _finish_greedy.  The result is marked as
+    truncated.
+    """
+    return self._profile_decode(ex, self._decode_greedy, domain, ex, domain_convertor, domain_controller,
+                                general_controller, max_len, time_limit, step_limit)
+
+  def _get_greedy_fns(self, general_controller):
+    """The ontology functions of a greedy step, profiled if there is a profiler."""
+    return (self._profiled(self.get_legal_action_list, 'get_legal_action_list.general'),
+            self._profiled(self.get_legal_action_list, 'get_legal_action_list.domain'),
+            self._profiled(general_controller.is_legal_action_then_read, 'is_legal_action_then_read'))
+
+  def _greedy_step(self, domain, hyp, write_dist, domain_controller, general_controller, action_all, greedy_fns,
+                   preferred=None):
+    """Extend hyp with the most likely legal action under write_dist.
+
+    If preferred (a 0/1 mask over the actions) is given and one of those
+    actions is legal, the best of them is taken instead.  Returns the index
+    of the action.  hyp.done is set if it ends the derivation.
+    """
+    get_legal_gen, get_legal_dom, read_action = greedy_fns
+    legal_dist_gen = get_legal_gen(general_controller, hyp.gen_pre_action_class_in, hyp.gen_pre_arg_list_in,
+                                   hyp.gen_pre_action_in, hyp.node_dict, hyp.type_node_dict, hyp.entity_node_dict,
+                                   hyp.operation_dict, hyp.edge_dict, hyp.return_node, hyp.db_triple,
+                                   hyp.fun_trace_list_in, action_all)
+    legal_dist_dom = get_legal_dom(domain_controller, hyp.gen_pre_action_class_in, hyp.gen_pre_arg_list_in,
+                                   hyp.gen_pre_action_in, hyp.node_dict, hyp.type_node_dict, hyp.entity_node_dict,
+                                   hyp.operation_dict, hyp.edge_dict, hyp.return_node, hyp.db_triple,
+                                   hyp.fun_trace_list_in, action_all)
+    legal_dist = legal_dist_gen * legal_dist_dom
+    final_dist = write_dist * legal_dist
+    if preferred is not None and numpy.any(legal_dist * preferred):
+      final_dist = numpy.where(legal_dist * preferred > 0, write_dist, -1.0)
+    y_t = numpy.argmax(final_dist)
+
+    p_y_t = write_dist[y_t]
+    hyp.p_y_seq.append(p_y_t)
+    hyp.p *= p_y_t
+    hyp.done = self.out_vocabulary.action_is_end(domain, y_t)
+    y_tok = self.out_vocabulary.get_action(y_t)
+    if y_t >= self.out_vocabulary.all_size():
+      print('error in attention for out vocabulary')
+    hyp.y_tok_seq.append(y_tok)
+    gen_flag, gen_pre_action_class_out, gen_pre_arg_list_out, gen_pre_action_out, fun_trace_list_out = \
+      read_action(hyp.gen_pre_action_class_in, hyp.gen_pre_arg_list_in, y_tok,
+                  hyp.gen_pre_action_in, hyp.node_dict, hyp.type_node_dict, hyp.entity_node_dict,
+                  hyp.operation_dict, hyp.edge_dict, hyp.return_node, hyp.db_triple,
+                  hyp.fun_trace_list_in)
+    hyp.gen_pre_action_class_in = gen_pre_action_class_out
+    hyp.gen_pre_arg_list_in = gen_pre_arg_list_out
+    hyp.gen_pre_action_in = gen_pre_action_out
+    hyp.fun_trace_list_in = fun_trace_list_out
+    return y_t
+
+  def _finish_greedy(self, domain, hyp, write_dist, domain_controller, general_controller, action_all, greedy_fns,
+                     max_len):
+    """Complete hyp without calling the decoder, once the budget is spent.
+
+    The actions are picked under the legality masks from write_dist, the
+    last distribution the decoder wrote (uniform if there was none), and
+    an end action is taken as soon as one is legal.  Stops at max_len
+    actions, ended or not.
+    """
+    if write_dist is None:
+      write_dist = numpy.ones(len(action_all))
+    is_end = numpy.array([self.out_vocabulary.action_is_end(domain, i) for i in range(len(write_dist))],
+                         dtype=write_dist.dtype)
+    while not hyp.done and len(hyp.y_tok_seq) < max_len:
+      self._greedy_step(domain, hyp, write_dist, domain_controller, general_controller, action_all, greedy_fns,
+                        preferred=is_end)
+
+  def _convert(self, convertor, *args):
+    """The logical form convertor gives, or [] if it cannot render the actions.
+
+    E.g. action2seq fails on actions that do not end in a return.
+    """
+    try:
+      return convertor(*args)
+    except Exception:
+      return []
+
+  def _decode_greedy(self, domain, ex, domain_convertor, domain_controller, general_controller, max_len,
+                     time_limit, step_limit):
+    budget = DecodingBudget.create(time_limit, step_limit)
+    truncated = False
+    decoder_write = self._profiled(self._decoder_write, 'decoder_write')
+    decoder_step = self._profiled(self._decoder_step, 'decoder_step')
+    greedy_fns = self._get_greedy_fns(general_controller)
+    h_t, annotations = self._profiled(self._encode, 'encode')(ex.x_inds)
     action_all = self.out_vocabulary.get_action_list()
+    hyp = GreedyHypothesis()
 
-    gen_pre_action_in = ''
-    gen_pre_action_class_in = 'start'
-    gen_pre_arg_list_in = []
-    node_dict = {}
-    type_node_dict = {}
-    entity_node_dict = {}
-    operation_dict = {}
-    edge_dict = {}
-    return_node = {}
-    db_triple = {}
-    fun_trace_list_in = []
-
+    write_dist = None
     for i in range(max_len):
-      write_dist, c_t, alpha = self._decoder_write(annotations, h_t)
-      legal_dist_gen = self.get_legal_action_list(general_controller, gen_pre_action_class_in, gen_pre_arg_list_in,
-                                                     gen_pre_action_in, node_dict, type_node_dict, entity_node_dict,
-                                                     operation_dict, edge_dict, return_node, db_triple,
-                                                     fun_trace_list_in, action_all)
-
-      legal_dist_dom = self.get_legal_action_list(domain_controller, gen_pre_action_class_in, gen_pre_arg_list_in,
-                                                     gen_pre_action_in, node_dict, type_node_dict, entity_node_dict,
-                                                     operation_dict, edge_dict, return_node, db_triple,
-                                                     fun_trace_list_in, action_all)
-
+      if budget is not None:
+        if budget.expired():
+          truncated = True
+          self._finish_greedy(domain, hyp, write_dist, domain_controller, general_controller, action_all,
+                              greedy_fns, max_len)
+          break
+        budget.spend()
+      write_dist, c_t, alpha = decoder_write(annotations, h_t)
+      y_t = self._greedy_step(domain, hyp, write_dist, domain_controller, general_controller,
+                              action_all, greedy_fns)
+      if hyp.done:
+        break
+      h_t = decoder_step(y_t, c_t, h_t)
+    y_tok_lf = self._convert(self._profiled(domain_convertor, 'domain_convertor'),
+                             ' '.join(hyp.y_tok_seq), domain_controller, general_controller)
+    return [Derivation(ex, hyp.p, hyp.y_tok_seq, y_tok_lf, truncated=truncated)]
+
+  def decode_greedy_batch(self, domain, examples, domain_convertor, domain_controller, general_controller, max_len=100,
+                          time_limit=None, step_limit=None):
+    """Greedily decode several examples at once.
+
+    Gives the same result as decode_greedy on each example, but makes one
+    theano call per step for the whole batch.  The ontology masks are still
+    computed per example, from that example's controller state.  Each
+    example has its own time and step limits, as in decode_greedy: once an
+    example has spent its budget, it is completed with _finish_greedy and
+    the others go on.
+    """
+    if not examples:
+      return []
+    if self.profiler is not None:
+      self.profiler.begin()
+    try:
+      return self._decode_greedy_batch(domain, examples, domain_convertor, domain_controller,
+                                       general_controller, max_len, time_limit, step_limit)
+    finally:
+      if self.profiler is not None:
+        self.profiler.end(num_decodes=len(examples))
+
+  def _decode_greedy_batch(self, domain, examples, domain_convertor, domain_controller, general_controller, max_len,
+                           time_limit, step_limit):
+    budgets = [DecodingBudget.create(time_limit, step_limit) for ex in examples]
+    truncated = [False] * len(examples)
+    self.setup_batch_decoder()
+    decoder_write = self._profiled(self._decoder_write_batch, 'decoder_write')
+    decoder_step = self._profiled(self._decoder_step_batch, 'decoder_step')
+    greedy_fns = self._get_greedy_fns(general_controller)
+    action_all = self.out_vocabulary.get_action_list()
+    x_lens = numpy.array([len(ex.x_inds) for ex in examples], dtype=numpy.int64)
+    x = numpy.zeros((len(examples), max(x_lens)), dtype=numpy.int64)
+    for i, ex in enumerate(examples):
+      x[i, :x_lens[i]] = ex.x_inds
+    h_ts, all_annotations = self._profiled(self._encode_batch, 'encode')(x, x_lens)
+    num_pad = all_annotations.shape[1] - x_lens
+    hyps = [GreedyHypothesis() for ex in examples]
+    last_write_dists = [None] * len(examples)
+
+    active = range(len(examples))
+    for step in range(max_len):
+      within_budget = []
+      for i in active:
+        if budgets[i] is not None:
+          if budgets[i].expired():
+            truncated[i] = True
+            if self.trace_recorder is not None:
+              self.trace_recorder.begin(examples[i].x_str)
+            self._finish_greedy(domain, hyps[i], last_write_dists[i], domain_controller, general_controller,
+                                action_all, greedy_fns, max_len)
+            if self.trace_recorder is not None:
+              self.trace_recorder.end()
+            continue
+          budgets[i].spend()
+        within_budget.append(i)
+      active = within_budget
+      if not active:
+        break
+      write_dists, c_ts, alphas = decoder_write(
+          all_annotations[active], x_lens[active], h_ts[active])
+      next_active = []
+      next_y = []
+      next_rows = []
+      for row, i in enumerate(active):
+        write_dist = write_dists[row]
+        if self.spec.attention_copying:
+          write_dist = write_dist[:len(write_dist) - num_pad[i]]
+        last_write_dists[i] = write_dist
+        # The examples take turns, so each step is marked with its own.
+        if self.trace_recorder is not None:
+          self.trace_recorder.begin(examples[i].x_str)
+        y_t = self._greedy_step(domain, hyps[i], write_dist, domain_controller, general_controller,
+                                action_all, greedy_fns)
+        if not hyps[i].done:
+          next_active.append(i)
+          next_y.append(y_t)
+          next_rows.append(row)
+      if self.trace_recorder is not None:
+        self.trace_recorder.end()
+      if next_active and step + 1 < max_len:
+        h_ts[next_active] = decoder_step(
+            numpy.array(next_y, dtype=numpy.int64), c_ts[next_rows], h_ts[next_active])
+      active = next_active
+
+    domain_convertor = self._profiled(domain_convertor, 'domain_convertor')
+    derivs = []
+    for i, (ex, hyp) in enumerate(zip(examples, hyps)):
+      y_tok_lf = self._convert(domain_convertor, ' '.join(hyp.y_tok_seq), domain_controller, general_controller)
+      derivs.append([Derivation(ex, hyp.p, hyp.y_tok_seq, y_tok_lf, truncated=truncated[i])])
+    return derivs
+
+  def decode_beam(self, domain, ex, domain_convertor, domain_controller, general_controller, beam_size=1, max_len=100,
+                  time_limit=None, step_limit=None, state_convertor=None):
+    """Beam search.
+
+    With a time_limit (in seconds) or step_limit (in decoder steps), the
+    search stops once the budget is spent and returns the derivations that
+    finished so far.  If none did, the best one on the beam is completed
+    greedily.  Either way, the results are marked as truncated.
+
+    If state_convertor is given (an action2seq_from_state function), the
+    logical forms are rendered from the controller state that each finished
+    derivation already holds, rather than by reading its actions again with
+    domain_convertor.  That state is only built when both controllers use
+    their ontology.
+    """
+    return self._profile_decode(ex, self._decode_beam, domain, ex, domain_convertor, domain_controller,
+                                general_controller, beam_size, max_len, time_limit, step_limit,
+                                state_convertor)
+
+  def _decode_beam(self, domain, ex, domain_convertor, domain_controller, general_controller, beam_size, max_len,
+                   time_limit, step_limit, state_convertor):
+    use_state = (state_convertor is not None and general_controller.use_ontology
+                 and domain_controller.use_ontology)
+    budget = DecodingBudget.create(time_limit, step_limit)
+    h_t, annotations = self._profiled(self._encode, 'encode')(ex.x_inds)
+    start = Derivation(ex, 1, [], [], hidden_state=h_t,p_list=[],
+                       attention_list=[], copy_list=[], copy_entity_list=ex.copy_toks)
+    finished, live, expired = self._beam_search(domain, ex, annotations, [start], domain_controller, general_controller,
+                                                beam_size, max_len, budget)
+    if expired and not finished and live:
+      finished, _, _ = self._beam_search(domain, ex, annotations, live[:1], domain_controller, general_controller,
+                                         1, max_len - len(live[0].y_toks), None)
+    final_finished = []
+    state_convertor = self._profiled(state_convertor, 'domain_convertor')
+    domain_convertor = self._profiled(domain_convertor, 'domain_convertor')
+    for deriv in finished:
+      if use_state:
+        y_toks_lf = self._convert(state_convertor, deriv.node_dict_in_deriv, deriv.entity_node_dict_in_deriv,
+                                  deriv.operation_dict_in_deriv, deriv.return_node_in_deriv, deriv.db_triple_in_deriv,
+                                  deriv.fun_trace_list_in_deriv)
+      else:
+        y_toks_lf = self._convert(domain_convertor, ' '.join(deriv.y_toks), domain_controller, general_controller)
+      new_entry = Derivation(deriv.example, deriv.p, deriv.y_toks, y_toks_lf, \
+                             deriv.hidden_state, deriv.p_list, deriv.attention_list, deriv.copy_list, deriv.copy_entity_list,
+                             truncated=expired)
+      final_finished.append(new_entry)
+    return sorted(final_finished, key=lambda x: x.p, reverse=True)
 
-      final_dist = write_dist * legal_dist_gen * legal_dist_dom
-      #print('write_dist: ', write_dist)
-      #print('legal_dist_gen: ', legal_dist_gen)
-      #print('legal_dist_dom: ', legal_dist_dom)
-      #print('final_dist: ', final_dist)
-      y_t = numpy.argmax(final_dist)
-
-      p_y_t = write_dist[y_t]
-      p_y_seq.append(p_y_t)
-      p *= p_y_t
-      if self.out_vocabulary.action_is_end(y_t):
-        break_flag = True
-      y_tok = self.out_vocabulary.get_action(y_t)
-      if y_t >= self.out_vocabulary.all_size():
-        print('error in attention for out vocabulary')
-      y_tok_seq.append(y_tok)
-      action_token = y_tok
-      gen_flag, gen_pre_action_class_out, gen_pre_arg_list_out, gen_pre_action_out, fun_trace_list_out = \
-        general_controller.is_legal_action_then_read(gen_pre_action_class_in, gen_pre_arg_list_in, action_token,
-                                                     gen_pre_action_in, node_dict, type_node_dict, entity_node_dict,
-                                                     operation_dict, edge_dict, return_node, db_triple,
-                                                     fun_trace_list_in)
-      gen_pre_action_class_in = gen_pre_action_class_out
-      gen_pre_arg_list_in = gen_pre_arg_list_out
-      gen_pre_action_in = gen_pre_action_out
-      fun_trace_list_in = fun_trace_list_out
+  def _beam_search(self, domain, ex, annotations, start_beam, domain_controller, general_controller, beam_size, max_len, budget):
+    """Run beam search from the given derivations.
 
-      if break_flag:
-        break
-      h_t = self._decoder_step(y_t, c_t, h_t)
-    y_tok_lf = domain_convertor(' '.join(y_tok_seq), domain_controller, general_controller)
-    return [Derivation(ex, p, y_tok_seq, y_tok_lf)]
-
-  def decode_beam(self, domain, ex, domain_convertor, domain_controller, general_controller, beam_size=1, max_len=100):
-    h_t, annotations = self._encode(ex.x_inds)
-    beam = [[Derivation(ex, 1, [], [], hidden_state=h_t,p_list=[],
-                        attention_list=[], copy_list=[], copy_entity_list=ex.copy_toks)]]
+    Returns (finished derivations, last beam, whether the budget ran out).
+    """
+    copy_entity_list = ex.copy_toks
+    beam = [start_beam]
     finished = []
-    final_finished = []
+    expired = False
     action_all_raw = self.out_vocabulary.get_action_list()
     action_all = action_all_raw[:self.out_vocabulary.size()]
     for action in action_all_raw[self.out_vocabulary.size():]:
         action_all.append('<COPY>')
-    copy_entity_list = ex.copy_toks
+    decoder_write = self._profiled(self._decoder_write, 'decoder_write')
+    decoder_step = self._profiled(self._decoder_step, 'decoder_step')
+    get_legal_gen = self._profiled(self.get_legal_action_list, 'get_legal_action_list.general')
+    get_legal_dom = self._profiled(self.get_legal_action_list, 'get_legal_action_list.domain')
+    read_action = self._profiled(general_controller.is_legal_action_then_read, 'is_legal_action_then_read')
+    deepcopy = self._profiled(copy.deepcopy, 'deepcopy')
 
 
     for i in range(1, max_len):
       #print >> sys.stderr, 'decode_beam: length = %d' % i
       if len(beam[i-1]) == 0: break
+      if budget is not None and budget.expired():
+        expired = True
+        break
       # See if beam_size-th finished deriv is best than everything on beam now.
       if len(finished) >= beam_size:
         finished_p = finished[beam_size-1].p
@@ -293,6 +596,11 @@ class AttentionModel(NeuralModel):
       new_beam = []
 
       for deriv in beam[i-1]:
+        if budget is not None:
+          if budget.expired():
+            expired = True
+            break
+          budget.spend()
         cur_p = deriv.p
         expanded_action_all = action_all
         h_t = deriv.hidden_state
@@ -314,16 +622,16 @@ class AttentionModel(NeuralModel):
 
         gen_pre_action_for_test = deriv.gen_pre_action_in_deriv
         gen_pre_action_class_for_test = deriv.gen_pre_action_class_in_deriv
-        gen_pre_arg_list_for_test = copy.deepcopy(deriv.gen_pre_arg_list_in_deriv)
-
-        node_dict_for_test = copy.deepcopy(deriv.node_dict_in_deriv)
-        type_node_dict_for_test = copy.deepcopy(deriv.type_node_dict_in_deriv)
-        entity_node_dict_for_test = copy.deepcopy(deriv.entity_node_dict_in_deriv)
-        operation_dict_for_test = copy.deepcopy(deriv.operation_dict_in_deriv)
-        edge_dict_for_test = copy.deepcopy(deriv.edge_dict_in_deriv)
-        return_node_for_test = copy.deepcopy(deriv.return_node_in_deriv)
-        db_triple_for_test = copy.deepcopy(deriv.db_triple_in_deriv)
-        fun_trace_list_for_test = copy.deepcopy(deriv.fun_trace_list_in_deriv)
+        gen_pre_arg_list_for_test = deepcopy(deriv.gen_pre_arg_list_in_deriv)
+
+        node_dict_for_test = deepcopy(deriv.node_dict_in_deriv)
+        type_node_dict_for_test = deepcopy(deriv.type_node_dict_in_deriv)
+        entity_node_dict_for_test = deepcopy(deriv.entity_node_dict_in_deriv)
+        operation_dict_for_test = deepcopy(deriv.operation_dict_in_deriv)
+        edge_dict_for_test = deepcopy(deriv.edge_dict_in_deriv)
+        return_node_for_test = deepcopy(deriv.return_node_in_deriv)
+        db_triple_for_test = deepcopy(deriv.db_triple_in_deriv)
+        fun_trace_list_for_test = deepcopy(deriv.fun_trace_list_in_deriv)
         #print('***************************************')
         #print('y_tok_seq: ', y_tok_seq)
         #print('pre_action_for_test: ', gen_pre_action_for_test)
@@ -338,9 +646,9 @@ class AttentionModel(NeuralModel):
         #print('return_node_for_test: ', return_node_for_test)
         #print('fun_trace_list_for_test: ', fun_trace_list_for_test)
 
-        write_dist, c_t, alpha = self._decoder_write(annotations, h_t)
+        write_dist, c_t, alpha = decoder_write(annotations, h_t)
 
-        legal_dist_gen = self.get_legal_action_list(general_controller, gen_pre_action_class_for_test, gen_pre_arg_list_for_test,
+        legal_dist_gen = get_legal_gen(general_controller, gen_pre_action_class_for_test, gen_pre_arg_list_for_test,
                                                      gen_pre_action_for_test, node_dict_for_test, type_node_dict_for_test, entity_node_dict_for_test,
                                                      operation_dict_for_test, edge_dict_for_test, return_node_for_test, db_triple_for_test,
                                                      fun_trace_list_for_test, expanded_action_all)
@@ -352,7 +660,7 @@ class AttentionModel(NeuralModel):
                 expanded_action_all_for_domain.append('<COPY>')
 
 
-        legal_dist_dom = self.get_legal_action_list(domain_controller, gen_pre_action_class_for_test, gen_pre_arg_list_for_test,
+        legal_dist_dom = get_legal_dom(domain_controller, gen_pre_action_class_for_test, gen_pre_arg_list_for_test,
                                                      gen_pre_action_for_test, node_dict_for_test, type_node_dict_for_test, entity_node_dict_for_test,
                                                      operation_dict_for_test, edge_dict_for_test, return_node_for_test, db_triple_for_test,
                                                      fun_trace_list_for_test, expanded_action_all_for_domain)
@@ -372,16 +680,16 @@ class AttentionModel(NeuralModel):
         for j in range(beam_size):
           gen_pre_action_for_read = gen_pre_action_for_test
           gen_pre_action_class_for_read = gen_pre_action_class_for_test
-          gen_pre_arg_list_for_read = copy.deepcopy(gen_pre_arg_list_for_test)
+          gen_pre_arg_list_for_read = deepcopy(gen_pre_arg_list_for_test)
 
-          node_dict_for_read = copy.deepcopy(node_dict_for_test)
-          type_node_dict_for_read = copy.deepcopy(type_node_dict_for_test)
-          entity_node_dict_for_read = copy.deepcopy(entity_node_dict_for_test)
-          operation_dict_for_read = copy.deepcopy(operation_dict_for_test)
-          edge_dict_for_read = copy.deepcopy(edge_dict_for_test)
-          return_node_for_read = copy.deepcopy(return_node_for_test)
-          db_triple_for_read = copy.deepcopy(db_triple_for_test)
-          fun_trace_list_for_read = copy.deepcopy(fun_trace_list_for_test)
+          node_dict_for_read = deepcopy(node_dict_for_test)
+          type_node_dict_for_read = deepcopy(type_node_dict_for_test)
+          entity_node_dict_for_read = deepcopy(entity_node_dict_for_test)
+          operation_dict_for_read = deepcopy(operation_dict_for_test)
+          edge_dict_for_read = deepcopy(edge_dict_for_test)
+          return_node_for_read = deepcopy(return_node_for_test)
+          db_triple_for_read = deepcopy(db_triple_for_test)
+          fun_trace_list_for_read = deepcopy(fun_trace_list_for_test)
 
           #print('--------------')
           #print('pre_action_for_read: ', gen_pre_action_for_read)
@@ -410,13 +718,13 @@ class AttentionModel(NeuralModel):
           else:
             do_copy = 1
             new_index = y_t - self.out_vocabulary.all_size()
-            y_tok = 'add_entity_node:-:' + ex.copy_toks[new_index]
+            y_tok = 'add_entity_node:-:' + copy_entity_list[new_index]
             y_t = self.out_vocabulary.get_index(y_tok)
-          new_h_t = self._decoder_step(y_t, c_t, h_t)
+          new_h_t = decoder_step(y_t, c_t, h_t)
           #print('y_tok: ', y_tok, ' p_y_t: ', p_y_t)
           action_token = y_tok
           gen_flag, gen_pre_action_class_out, gen_pre_arg_list_out, gen_pre_action_out, fun_trace_list_out = \
-            general_controller.is_legal_action_then_read(gen_pre_action_class_for_read, gen_pre_arg_list_for_read, action_token,
+            read_action(gen_pre_action_class_for_read, gen_pre_arg_list_for_read, action_token,
                                                          gen_pre_action_for_read, node_dict_for_read, type_node_dict_for_read, entity_node_dict_for_read,
                                                          operation_dict_for_read, edge_dict_for_read, return_node_for_read, db_triple_for_read,
                                                          fun_trace_list_for_read)
@@ -442,12 +750,10 @@ class AttentionModel(NeuralModel):
                                   db_triple_in_deriv = db_triple_for_read, fun_trace_list_in_deriv = fun_trace_list_out)
           new_beam.append(new_entry)
 
+      if expired:
+        break
       new_beam.sort(key=lambda x: x.p, reverse=True)
       beam.append(new_beam[:beam_size])
       finished.sort(key=lambda x: x.p, reverse=True)
-    for deriv in finished:
-      y_toks_lf = domain_convertor(' '.join(deriv.y_toks), domain_controller, general_controller)
-      new_entry = Derivation(deriv.example, deriv.p, deriv.y_toks, y_toks_lf, \
-                             deriv.hidden_state, deriv.p_list, deriv.attention_list, deriv.copy_list, deriv.copy_entity_list)
-      final_finished.append(new_entry)
-    return sorted(final_finished, key=lambda x: x.p, reverse=True)
+    finished.sort(key=lambda x: x.p, reverse=True)
+    return finished, beam[-1], expired
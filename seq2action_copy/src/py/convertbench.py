@@ -0,0 +1,266 @@
+"""Benchmark round-trip conversion: logical form -> actions -> logical form.
+
+Runs seq2action and then action2seq over the logical forms of .tsv files
+(utterance, logical form), optionally with synthetic examples added, e.g.
+    python convertbench.py geo geo880/seq0/*.tsv --synthetic 20000
+and reports:
+  - sequences/sec of seq2action, action2seq and the whole round trip;
+  - calls and inclusive time of each controller method during action2seq
+    (measured in a second pass, so that the timers do not slow down the
+    first);
+  - the examples that do not round-trip.  An output that only differs
+    from the input in the order of conjuncts counts as reordered, not as
+    a mismatch.
+Synthetic examples are real logical forms with each entity replaced by
+another one of the same type seen in the data.
+"""
+import argparse
+import collections
+import glob
+import importlib
+import os
+import random
+import sys
+import time
+
+from convert import GRAMMAR_DIR, setup_atis, setup_geo
+from decodeprofile import MethodTimer
+
+# domain -> (seq2action module, action2seq module, controller setup)
+DOMAINS = collections.OrderedDict([
+    ('geo', ('geoseq2action', 'geoaction2seq', setup_geo)),
+    ('atis', ('atisseq2action', 'atisaction2seq', setup_atis)),
+])
+
+# Functors whose arguments are a set of conjuncts, in ATIS logical forms.
+CONJUNCTIONS = ('_and', '_or')
+
+def read_examples(filenames):
+  examples = []
+  for filename in filenames:
+    with open(filename) as f:
+      for line in f:
+        line = line.strip()
+        if line:
+          utterance, logical_form = line.split('\t')[:2]
+          examples.append((utterance, logical_form))
+  return examples
+
+def tokenize(logical_form):
+  """Split a logical form, keeping quoted geo names (' new york ') whole."""
+  toks = []
+  quoted = None
+  for tok in logical_form.split(' '):
+    if quoted is not None:
+      quoted.append(tok)
+      if tok == "'":
+        toks.append(' '.join(quoted))
+        quoted = None
+    elif tok == "'":
+      quoted = [tok]
+    else:
+      toks.append(tok)
+  if quoted is not None:
+    toks.extend(quoted)
+  return toks
+
+def get_entity_type(toks, i):
+  """The type of the entity at toks[i], or None if it is not one.
+
+  ATIS entities carry their type (denver:_ci); geo entities are the first
+  argument of an id functor (_stateid ( texas )).
+  """
+  tok = toks[i]
+  if ':_' in tok:
+    return tok[tok.index(':_'):]
+  if i >= 2 and toks[i - 1] == '(' and toks[i - 2].endswith('id') and tok not in ('(', ')', ','):
+    return toks[i - 2]
+  return None
+
+def synthesize(logical_forms, num, seed=0):
+  """Make num logical forms by swapping entities for others of their type."""
+  entities = collections.defaultdict(set)
+  for lf in logical_forms:
+    toks = tokenize(lf)
+    for i in range(len(toks)):
+      entity_type = get_entity_type(toks, i)
+      if entity_type:
+        entities[entity_type].add(toks[i])
+  entities = dict((k, sorted(v)) for k, v in entities.items())
+  rng = random.Random(seed)
+  synthetic = []
+  for _ in range(num):
+    toks = tokenize(rng.choice(logical_forms))
+    new_toks = []
+    for i in range(len(toks)):
+      entity_type = get_entity_type(toks, i)
+      new_toks.append(rng.choice(entities[entity_type]) if entity_type else toks[i])
+    synthetic.append(' '.join(new_toks))
+  return synthetic
+
+def parse_tree(toks):
+  """Parse tokens into nested lists, one per pair of parentheses."""
+  stack = [[]]
+  for tok in toks:
+    if tok == '(':
+      stack.append([])
+    elif tok == ')' and len(stack) > 1:
+      subtree = stack.pop()
+      stack[-1].append(subtree)
+    else:
+      stack[-1].append(tok)
+  while len(stack) > 1:
+    subtree = stack.pop()
+    stack[-1].append(subtree)
+  return stack[0]
+
+def tree_to_str(tree):
+  return ' '.join('( %s )' % tree_to_str(x) if isinstance(x, list) else x for x in tree)
+
+def split_commas(items):
+  groups = [[]]
+  for x in items:
+    if x == ',':
+      groups.append([])
+    else:
+      groups[-1].append(x)
+  return groups
+
+def canonicalize_tree(tree):
+  items = []
+  for i, x in enumerate(tree):
+    if isinstance(x, list):
+      x = canonicalize_tree(x)
+      if i == 0 or tree[i - 1] == ',':
+        # A geo conjunction: parentheses that are not a functor's arguments.
+        conjuncts = sorted(tree_to_str(c) for c in split_commas(x))
+        x = ' , '.join(conjuncts).split(' ')
+    items.append(x)
+  if items and items[0] in CONJUNCTIONS:
+    items = [items[0]] + sorted(items[1:], key=lambda x: tree_to_str([x]))
+  return items
+
+def canonicalize(logical_form):
+  """A string that is the same for logical forms differing in conjunct order."""
+  return tree_to_str(canonicalize_tree(parse_tree(logical_form.split(' '))))
+
+class Quiet(object):
+  """Discard what is printed inside a with block (the converters print a lot)."""
+  def __enter__(self):
+    self.stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+
+  def __exit__(self, *args):
+    sys.stdout.close()
+    sys.stdout = self.stdout
+
+def round_trip(logical_forms, seq2action_fn, action2seq_fn, controllers):
+  """Convert every logical form both ways.
+
+  Returns the action sequences (None on failure), logical forms (None on
+  failure), errors (by index) and the seconds spent in each direction.
+  """
+  domain_controller, general_controller = controllers
+  actions = []
+  errors = {}
+  with Quiet():
+    t0 = time.time()
+    for i, lf in enumerate(logical_forms):
+      try:
+        actions.append(' '.join(seq2action_fn(lf)))
+      except Exception as e:
+        actions.append(None)
+        errors[i] = 'seq2action: %s: %s' % (type(e).__name__, e)
+    t1 = time.time()
+    outputs = []
+    for i, action_seq in enumerate(actions):
+      if action_seq is None:
+        outputs.append(None)
+        continue
+      try:
+        outputs.append(' '.join(action2seq_fn(action_seq, domain_controller, general_controller)))
+      except Exception as e:
+        outputs.append(None)
+        errors[i] = 'action2seq: %s: %s' % (type(e).__name__, e)
+    t2 = time.time()
+  return actions, outputs, errors, t1 - t0, t2 - t1
+
+def get_rate(num, seconds):
+  return num / max(seconds, 1e-9)
+
+def _parse_args():
+  parser = argparse.ArgumentParser(
+      description='Benchmark round-trip conversion between logical forms and actions.')
+  parser.add_argument('domain', choices=list(DOMAINS))
+  parser.add_argument('inputs', nargs='+', help='.tsv files (or directories of them) of logical forms')
+  parser.add_argument('--synthetic', type=int, default=0,
+                      help='Number of synthetic examples to add')
+  parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic examples')
+  parser.add_argument('--grammar-dir', default=GRAMMAR_DIR,
+                      help='Directory with the .grammar files')
+  parser.add_argument('--no-controller-timing', action='store_true',
+                      help='Skip the pass that times the controller methods')
+  parser.add_argument('--mismatch-file', default=None,
+                      help='File to write every non-round-tripping example to')
+  parser.add_argument('--show', type=int, default=10,
+                      help='Number of non-round-tripping examples to print')
+  return parser.parse_args()
+
+def main():
+  args = _parse_args()
+  seq2action_name, action2seq_name, setup = DOMAINS[args.domain]
+  seq2action_fn = importlib.import_module(seq2action_name).seq2action
+  action2seq_fn = importlib.import_module(action2seq_name).action2seq
+  filenames = []
+  for path in args.inputs:
+    if os.path.isdir(path):
+      filenames.extend(sorted(glob.glob(os.path.join(path, '*.tsv'))))
+    else:
+      filenames.append(path)
+  logical_forms = [lf for _, lf in read_examples(filenames)]
+  num_real = len(logical_forms)
+  if args.synthetic:
+    logical_forms += synthesize(logical_forms, args.synthetic, seed=args.seed)
+  print('%d examples (%d synthetic) from %d files' % (
+      len(logical_forms), len(logical_forms) - num_real, len(filenames)))
+
+  controllers = setup(args.grammar_dir)
+  actions, outputs, errors, t_s2a, t_a2s = round_trip(
+      logical_forms, seq2action_fn, action2seq_fn, controllers)
+  n = len(logical_forms)
+  print('seq2action: %.1f sequences/s (%.3fs)' % (get_rate(n, t_s2a), t_s2a))
+  print('action2seq: %.1f sequences/s (%.3fs)' % (get_rate(n, t_a2s), t_a2s))
+  print('round trip: %.1f sequences/s (%.3fs)' % (get_rate(n, t_s2a + t_a2s), t_s2a + t_a2s))
+
+  if not args.no_controller_timing:
+    timer = MethodTimer()
+    controllers = setup(args.grammar_dir)
+    timer.instrument(controllers[0], 'domain')
+    timer.instrument(controllers[1], 'general')
+    _, _, _, _, t_timed = round_trip(logical_forms, seq2action_fn, action2seq_fn, controllers)
+    print('Controller methods during action2seq (inclusive, %.3fs with timers):' % t_timed)
+    for key, calls, seconds in timer.get_rows():
+      print('  %-40s %10d calls %10.3fs %8.2fus/call' % (key, calls, seconds, 1e6 * seconds / calls))
+
+  num_exact = 0
+  num_reordered = 0
+  mismatches = []
+  for i, (lf, action_seq, output) in enumerate(zip(logical_forms, actions, outputs)):
+    if output == lf:
+      num_exact += 1
+    elif output is not None and canonicalize(output) == canonicalize(lf):
+      num_reordered += 1
+    else:
+      mismatches.append((i, lf, action_seq or '', output or errors.get(i, '')))
+  print('Round trip: %d exact, %d reordered, %d mismatched (%d failed)' % (
+      num_exact, num_reordered, len(mismatches), len(errors)))
+  for i, lf, action_seq, output in mismatches[:args.show]:
+    print('  [%d] %s' % (i, lf))
+    print('   -> %s' % output)
+  if args.mismatch_file:
+    with open(args.mismatch_file, 'w') as f:
+      for mismatch in mismatches:
+        f.write('%d\t%s\t%s\t%s\n' % mismatch)
+
+if __name__ == '__main__':
+  main()
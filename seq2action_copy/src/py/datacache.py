@@ -0,0 +1,155 @@
+"""An on-disk cache of preprocessed datasets.
+
+Preprocessing a dataset replays every action sequence through the ontology
+controllers (to get the logical form) and maps every token through the
+vocabularies and the lexicon.  Since the result only depends on the raw
+examples, the vocabularies, the lexicon and the grammars, it is cached on
+disk under a key made from hashes of all of these.
+
+Each cached dataset is a directory containing:
+  - meta.pkl: the strings (x_str, y_str, y_str_lf) and lexicon matches
+      of every example.
+  - {x,y,copy}_data.npy: the concatenated x_inds, y_inds and copy alignment
+      pairs of all examples.
+  - {x,y,copy}_offsets.npy: where each example starts in the arrays above.
+
+The .npy files are opened memory-mapped, so loading a cached dataset
+does not read the arrays into memory until they are used.
+"""
+import hashlib
+import os
+import shutil
+import sys
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+
+import numpy
+
+from example import Example
+
+CACHE_VERSION = 1
+ARRAY_NAMES = ('x', 'y', 'copy')
+
+def hash_file(h, filename):
+  with open(filename, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 16), b''):
+      h.update(block)
+
+def hash_strings(h, strings):
+  for s in strings:
+    h.update(s.encode('utf-8') if not isinstance(s, bytes) else s)
+    h.update(b'\n')
+
+def get_vocab_tokens(vocab):
+  if hasattr(vocab, 'num_buckets'):
+    # A HashedVocabulary is fully determined by its hashing parameters.
+    return ['<hashed>', str(vocab.num_buckets), str(vocab.num_hashes)]
+  if hasattr(vocab, 'get_action_list'):
+    return vocab.get_action_list()
+  return vocab.word_list
+
+def get_lexicon_strings(lex):
+  if not lex:
+    return ['<no lexicon>']
+  strings = ['%s\t%s' % x for x in lex.entries.items()]
+  strings.extend('%s\t%s' % x for x in getattr(lex, 'unique_word_map', {}).items())
+  strings.extend(regex for regex, func in getattr(lex, 'handlers', []))
+  return strings
+
+def get_key(raw, in_vocabulary, out_vocabulary, lex, grammar_files,
+            convertor_name, reverse_input):
+  """Hash everything that the preprocessed examples depend on."""
+  h = hashlib.sha1()
+  hash_strings(h, ['version=%d' % CACHE_VERSION, 'convertor=%s' % convertor_name,
+                   'reverse_input=%s' % reverse_input])
+  hash_strings(h, ('\t'.join(raw_ex) for raw_ex in raw))
+  hash_strings(h, get_vocab_tokens(in_vocabulary))
+  hash_strings(h, get_vocab_tokens(out_vocabulary))
+  hash_strings(h, get_lexicon_strings(lex))
+  for filename in grammar_files:
+    hash_file(h, filename)
+  return h.hexdigest()
+
+def pack(arrays, width=None):
+  """Concatenate a list of arrays, and record where each one starts."""
+  offsets = numpy.zeros(len(arrays) + 1, dtype=numpy.int64)
+  dtype = numpy.int32
+  for i, a in enumerate(arrays):
+    offsets[i + 1] = offsets[i] + len(a)
+    if a.dtype == numpy.int64:
+      dtype = numpy.int64
+  if width:
+    data = numpy.zeros((offsets[-1], width), dtype=dtype)
+  else:
+    data = numpy.zeros(offsets[-1], dtype=dtype)
+  for i, a in enumerate(arrays):
+    data[offsets[i]:offsets[i + 1]] = a
+  return data, offsets
+
+def write(cache_dir, key, data):
+  """Write the dataset to a temporary directory, then rename it into place."""
+  out_dir = os.path.join(cache_dir, key)
+  tmp_dir = '%s.tmp.%d' % (out_dir, os.getpid())
+  if os.path.isdir(tmp_dir):
+    shutil.rmtree(tmp_dir)
+  os.makedirs(tmp_dir)
+  arrays = {
+      'x': pack([ex.x_inds for ex in data]),
+      'y': pack([ex.y_inds for ex in data]),
+      'copy': pack([ex.y_in_x_pairs for ex in data], width=2),
+  }
+  for name in ARRAY_NAMES:
+    numpy.save(os.path.join(tmp_dir, '%s_data.npy' % name), arrays[name][0])
+    numpy.save(os.path.join(tmp_dir, '%s_offsets.npy' % name), arrays[name][1])
+  meta = {
+      'version': CACHE_VERSION,
+      'examples': [
+          (ex.x_str, ex.y_str, ex.y_str_lf, ex.reverse_input, ex.copy_entities)
+          for ex in data],
+  }
+  with open(os.path.join(tmp_dir, 'meta.pkl'), 'wb') as f:
+    pickle.dump(meta, f, pickle.HIGHEST_PROTOCOL)
+  try:
+    os.rename(tmp_dir, out_dir)
+  except OSError:
+    # Another process wrote the same dataset first.
+    shutil.rmtree(tmp_dir)
+
+def read(cache_dir, key):
+  """Load a cached dataset, or return None if it is not there."""
+  in_dir = os.path.join(cache_dir, key)
+  if not os.path.isdir(in_dir):
+    return None
+  with open(os.path.join(in_dir, 'meta.pkl'), 'rb') as f:
+    meta = pickle.load(f)
+  if meta['version'] != CACHE_VERSION:
+    return None
+  arrays = {}
+  for name in ARRAY_NAMES:
+    arrays[name] = (
+        numpy.load(os.path.join(in_dir, '%s_data.npy' % name), mmap_mode='r'),
+        numpy.load(os.path.join(in_dir, '%s_offsets.npy' % name)))
+
+  def get(name, i):
+    data, offsets = arrays[name]
+    return data[offsets[i]:offsets[i + 1]]
+
+  dataset = []
+  for i, (x_str, y_str, y_str_lf, reverse_input, copy_entities) in enumerate(meta['examples']):
+    dataset.append(Example.from_arrays(
+        x_str, y_str, y_str_lf, get('x', i), get('y', i), copy_entities,
+        get('copy', i), reverse_input=reverse_input))
+  return dataset
+
+def load_or_preprocess(cache_dir, key, preprocess_fn):
+  """Get a preprocessed dataset from the cache, or preprocess and cache it."""
+  data = read(cache_dir, key)
+  if data is not None:
+    print >> sys.stderr, 'Loaded %d preprocessed examples from %s' % (
+        len(data), os.path.join(cache_dir, key))
+    return data
+  data = preprocess_fn()
+  write(cache_dir, key, data)
+  return data
@@ -0,0 +1,86 @@
+"""Streaming access to TSV datasets.
+
+A TsvDataset is a re-iterable view over the records of a TSV file that
+never holds the whole file in memory: every iteration re-reads the file.
+Records can be restricted to
+  - one side of a train/dev split, decided by hashing each record
+    (so the split does not depend on file order or on a shuffle), and
+  - one shard out of several, decided by the record's line index
+    (so each worker process trains on a disjoint subset).
+"""
+import hashlib
+import itertools
+
+HASH_BUCKETS = 1000000
+
+def read_records(filename):
+  """Yield each line of a TSV file as a tuple of fields."""
+  with open(filename) as f:
+    for line in f:
+      yield tuple(line.rstrip('\n\r').split('\t'))
+
+def hash_fraction(record, seed):
+  """Map a record to a number in [0, 1), deterministically given the seed."""
+  h = hashlib.md5(('%d\t%s' % (seed, '\t'.join(record))).encode('utf-8'))
+  return float(int(h.hexdigest()[:8], 16) % HASH_BUCKETS) / HASH_BUCKETS
+
+def is_dev(record, dev_frac, seed):
+  return hash_fraction(record, seed) < dev_frac
+
+class TsvDataset(object):
+  """A lazily-read, optionally split and sharded, TSV dataset."""
+  def __init__(self, filename, dev_frac=0.0, dev_seed=0, split=None,
+               shard_index=0, num_shards=1):
+    """Create a TsvDataset.
+
+    Args:
+      filename: Path to the TSV file.
+      dev_frac: Fraction of records that go to the dev split.
+      dev_seed: Seed for the hash deciding the train/dev split.
+      split: 'train' or 'dev' to keep only that side of the split,
+          or None to keep every record.
+      shard_index, num_shards: Keep only records whose line index
+          is shard_index modulo num_shards.
+    """
+    if split not in (None, 'train', 'dev'):
+      raise ValueError('Unrecognized split "%s"' % split)
+    if not 0 <= shard_index < num_shards:
+      raise ValueError('Shard index %d out of range for %d shards' % (
+          shard_index, num_shards))
+    self.filename = filename
+    self.dev_frac = dev_frac
+    self.dev_seed = dev_seed
+    self.split = split
+    self.shard_index = shard_index
+    self.num_shards = num_shards
+
+  def __iter__(self):
+    records = itertools.islice(read_records(self.filename),
+                               self.shard_index, None, self.num_shards)
+    for record in records:
+      if self.split:
+        in_dev = is_dev(record, self.dev_frac, self.dev_seed)
+        if in_dev != (self.split == 'dev'):
+          continue
+      yield record
+
+  def count(self):
+    return sum(1 for _ in self)
+
+  def get_shard(self, shard_index, num_shards):
+    """Get the records of this dataset whose line index is shard_index modulo num_shards."""
+    return TsvDataset(self.filename, dev_frac=self.dev_frac, dev_seed=self.dev_seed,
+                      split=self.split, shard_index=shard_index, num_shards=num_shards)
+
+  def split_train_dev(self):
+    """Split this dataset into (train, dev) streams by hash.
+
+    Only the train side keeps this dataset's sharding, so that every
+    worker evaluates on the same dev set.
+    """
+    train = TsvDataset(self.filename, dev_frac=self.dev_frac, dev_seed=self.dev_seed,
+                       split='train', shard_index=self.shard_index,
+                       num_shards=self.num_shards)
+    dev = TsvDataset(self.filename, dev_frac=self.dev_frac, dev_seed=self.dev_seed,
+                     split='dev')
+    return train, dev
@@ -0,0 +1,94 @@
+"""Wall time and call counts of the phases of decoding.
+
+A model with a DecodeProfiler (model.profiler) times each phase of
+decode_greedy, decode_greedy_batch and decode_beam:
+  - encode, decoder_write and decoder_step (the theano calls);
+  - get_legal_action_list.general and get_legal_action_list.domain;
+  - is_legal_action_then_read;
+  - deepcopy (of the controller state, in decode_beam);
+  - domain_convertor (rendering the logical forms at the end).
+After instrument(controller, label), the time spent in each public method
+of the controller while decoding is counted as well, inclusive of the
+methods it calls.  With no profiler (the default), decoding only pays for
+a few checks of model.profiler per example.
+
+MethodTimer, which does the counting, also times the controllers in
+convertbench.py.
+"""
+import collections
+import time
+
+class MethodTimer(object):
+  """Counts the calls and inclusive time of functions, by key.
+
+  If enabled is given, calls are only counted while it returns True.
+  """
+  def __init__(self, enabled=None):
+    self.calls = collections.Counter()
+    self.seconds = collections.Counter()
+    self.enabled = enabled
+
+  def instrument(self, obj, label):
+    """Shadow each public method of obj with a timed one."""
+    for name in dir(obj):
+      if name.startswith('_'):
+        continue
+      method = getattr(obj, name)
+      if callable(method):
+        setattr(obj, name, self.wrap(method, '%s.%s' % (label, name)))
+
+  def wrap(self, method, key):
+    def timed(*args, **kwargs):
+      if self.enabled is not None and not self.enabled():
+        return method(*args, **kwargs)
+      t0 = time.time()
+      try:
+        return method(*args, **kwargs)
+      finally:
+        self.calls[key] += 1
+        self.seconds[key] += time.time() - t0
+    return timed
+
+  def get_rows(self):
+    return [(key, self.calls[key], self.seconds[key])
+            for key, _ in self.seconds.most_common()]
+
+class DecodeProfiler(object):
+  """Accumulates calls and seconds per phase and per ontology method."""
+  def __init__(self):
+    self.phases = MethodTimer()
+    self.methods = MethodTimer(enabled=lambda: self.decoding)
+    self.num_decodes = 0
+    self.decode_seconds = 0.0
+    self.decoding = False
+    self.start = None
+
+  def begin(self):
+    """Called when a decode starts."""
+    self.decoding = True
+    self.start = time.time()
+
+  def end(self, num_decodes=1):
+    """Called when a decode (of num_decodes examples at once) ends."""
+    self.decoding = False
+    self.num_decodes += num_decodes
+    self.decode_seconds += time.time() - self.start
+
+  def wrap(self, fn, phase):
+    """Get a version of fn whose calls are counted towards phase."""
+    return self.phases.wrap(fn, phase)
+
+  def instrument(self, obj, label):
+    """Shadow each public method of obj with one timed while decoding."""
+    self.methods.instrument(obj, label)
+
+  def to_stats(self):
+    def rows(timer):
+      return dict((key, {'calls': calls, 'seconds': seconds})
+                  for key, calls, seconds in timer.get_rows())
+    return {
+        'decodes': self.num_decodes,
+        'seconds': self.decode_seconds,
+        'phases': rows(self.phases),
+        'ontology_methods': rows(self.methods),
+    }
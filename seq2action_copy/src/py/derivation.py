@@ -3,7 +3,7 @@ class Derivation(object):
   def __init__(self, example, p, y_toks, y_toks_lf, hidden_state=None, p_list=None,
                attention_list=None, copy_list=None, copy_entity_list=None, gen_pre_action_in_deriv = '', gen_pre_action_class_in_deriv = 'start', gen_pre_arg_list_in_deriv = [],
             node_dict_in_deriv = {}, type_node_dict_in_deriv = {}, entity_node_dict_in_deriv = {}, operation_dict_in_deriv = {}, edge_dict_in_deriv = {}, return_node_in_deriv = {},
-          db_triple_in_deriv = {}, fun_trace_list_in_deriv = []):
+          db_triple_in_deriv = {}, fun_trace_list_in_deriv = [], truncated=False):
     self.example = example
     self.p = p
     self.y_toks = y_toks
@@ -25,3 +25,5 @@ class Derivation(object):
     self.return_node_in_deriv = return_node_in_deriv
     self.db_triple_in_deriv = db_triple_in_deriv
     self.fun_trace_list_in_deriv = fun_trace_list_in_deriv
+    # Whether decoding ran out of budget before finishing normally
+    self.truncated = truncated
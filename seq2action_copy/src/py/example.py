@@ -1,24 +1,47 @@
 """A single example in a dataset."""
+import numpy
+
 import lexicon
 
+COPY_TOKEN = '<COPY>'
+
+def get_index_dtype(inds):
+  """Use int32 unless some index needs more bits."""
+  if inds and max(inds) > numpy.iinfo(numpy.int32).max:
+    return numpy.int64
+  return numpy.int32
+
 class Example(object):
   """A single example in a dataset.
 
   Basically a struct after it's initialized, with the following fields:
     - self.x_str, self.y_str: input/output as single space-separated strings
+    - self.x_inds, self.y_inds: input/output as int32 arrays of indices
+        in the corresponding vocab (x_inds is int64 if some index does not
+        fit in an int32, e.g. with a HashedVocabulary)
+    - self.copy_entities: (x_pos, entity) pairs the lexicon found in x,
+        or None if no lexicon was used.
+    - self.y_in_x_pairs: int32 array of (y_pos, x_pos) rows, one for each
+        position where copy_toks[x_pos] == entity of y_toks[y_pos].
+
+  To keep many examples cheap to hold in memory, token lists are not stored
+  and the vocabularies/lexicon are not referenced.  The following are
+  materialized on demand (e.g. for printing):
     - self.x_toks, self.y_toks: input/output as list of strings
-    - self.input_vocab, self.output_vocab: Vocabulary objects
-    - self.x_inds, self.y_inds: input/output as indices in corresponding vocab
     - self.copy_toks: list of length len(x_toks), having tokens that should
         be generated if copying is performed.
-    - self.y_in_x_inds: ji-th entry is whether copy_toks[i] == y_toks[j].
+    - self.get_y_in_x_inds(): dense matrix whose ji-th entry is whether
+        copy_toks[i] == y_toks[j], as passed to the theano functions.
 
   Treat these objects as read-only.
   """
+  __slots__ = ('x_str', 'y_str', 'y_str_lf', 'reverse_input',
+               'x_inds', 'y_inds', 'copy_entities', 'y_in_x_pairs')
+
   def __init__(self, x_str, y_str, y_str_lf, input_vocab, output_vocab, lex,
                reverse_input=False):
     """Create an Example object.
-    
+
     Args:
       x_str: Input sequence as a space-separated string
       y_str: Output sequence as a space-separated string
@@ -29,35 +52,76 @@ class Example(object):
     self.x_str = x_str  # Don't reverse this, used just for printing out
     self.y_str = y_str
     self.y_str_lf = y_str_lf
-    self.input_vocab = input_vocab
-    self.output_vocab = output_vocab
-    self.lex = lex
     self.reverse_input = reverse_input
-    self.x_toks = x_str.split(' ')
+    # y_str is empty at inference time (e.g. queries to the server)
+    y_inds = output_vocab.action_seq_to_indices(y_str) if y_str else []
+    self.y_inds = numpy.array(y_inds, dtype=numpy.int32)
+    x_inds = input_vocab.sentence_to_indices(self.x_str)
     if reverse_input:
-      self.x_toks = self.x_toks[::-1]
-    self.y_toks = y_str.split(' ')
-    self.input_vocab = input_vocab
-    self.output_vocab = output_vocab
-    self.y_inds = output_vocab.action_seq_to_indices(y_str)
-    self.x_inds = input_vocab.sentence_to_indices(self.x_str)
-    if reverse_input:
-      self.x_inds = self.x_inds[::-1]
+      x_inds = x_inds[::-1]
+    self.x_inds = numpy.array(x_inds, dtype=get_index_dtype(x_inds))
 
     if lex:
-      entities = [entity for entity in lex.map_over_sentence(self.x_str.split(' '))]
-      self.copy_toks = [x if x else '<COPY>' for x in entities]
-      if reverse_input:
-        self.copy_toks = self.copy_toks[::-1]
+      entities = lex.map_over_sentence(self.x_str.split(' '))
+      self.copy_entities = tuple((i, x) for i, x in enumerate(entities) if x)
     else:
-      self.copy_toks = [lexicon.strip_unk(w) for w in self.x_toks]
+      self.copy_entities = None
 
-    self.y_in_x_inds = ([
-        [int(x_tok == self.extract_entity_from_action(y_tok)) for x_tok in self.copy_toks] + [0]
-        for y_tok in self.y_toks
-    ])
+    copy_toks = self.copy_toks
+    pairs = []
+    for j, y_tok in enumerate(self.y_toks):
+      entity = self.extract_entity_from_action(y_tok)
+      for i, x_tok in enumerate(copy_toks):
+        if x_tok == entity:
+          pairs.append((j, i))
+    self.y_in_x_pairs = numpy.array(pairs, dtype=numpy.int32).reshape(-1, 2)
     # Make sure to add EOS tags for x
 
+  @classmethod
+  def from_arrays(cls, x_str, y_str, y_str_lf, x_inds, y_inds, copy_entities,
+                  y_in_x_pairs, reverse_input=False):
+    """Create an Example from already-computed fields (e.g. from a cache)."""
+    ex = cls.__new__(cls)
+    ex.x_str = x_str
+    ex.y_str = y_str
+    ex.y_str_lf = y_str_lf
+    ex.reverse_input = reverse_input
+    ex.x_inds = x_inds
+    ex.y_inds = y_inds
+    ex.copy_entities = copy_entities
+    ex.y_in_x_pairs = y_in_x_pairs
+    return ex
+
+  @property
+  def x_toks(self):
+    x_toks = self.x_str.split(' ')
+    if self.reverse_input:
+      x_toks = x_toks[::-1]
+    return x_toks
+
+  @property
+  def y_toks(self):
+    return self.y_str.split(' ')
+
+  @property
+  def copy_toks(self):
+    if self.copy_entities is None:
+      return [lexicon.strip_unk(w) for w in self.x_toks]
+    copy_toks = [COPY_TOKEN] * len(self.x_str.split(' '))
+    for i, entity in self.copy_entities:
+      copy_toks[i] = entity
+    if self.reverse_input:
+      copy_toks = copy_toks[::-1]
+    return copy_toks
+
+  def get_y_in_x_inds(self):
+    """Expand the copy alignment to the dense |y| x (|x|+1) matrix."""
+    y_in_x_inds = numpy.zeros((len(self.y_inds), len(self.x_inds)),
+                              dtype=numpy.int64)
+    if len(self.y_in_x_pairs):
+      y_in_x_inds[self.y_in_x_pairs[:, 0], self.y_in_x_pairs[:, 1]] = 1
+    return y_in_x_inds
+
   def extract_entity_from_action(self, action):
     entity = ''
     if action.startswith('add_entity'):
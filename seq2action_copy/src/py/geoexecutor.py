@@ -0,0 +1,751 @@
+"""An in-process executor for Geoquery logical forms.
+
+Executes the Prolog-style queries that GeoqueryDomain.format_lf produces, e.g.
+    _parse([query], answer(A,(state(A),next_to(A,B),const(B,stateid(texas))))).
+over the facts in ontology/geobase.dlog, and returns denotations in the
+'{...}' format that GeoqueryDomain.get_denotation extracts from the output
+of the external evaluator, or one of its error strings.
+
+The facts are turned into relations over the same entities geobase.py uses
+(stateid, cityid, riverid, lakeid, mountainid, placeid, countryid).
+Every relation has a hash index on each argument position, so a goal with
+a bound argument only looks at the tuples that match it.
+
+The higher-order predicates follow the DatalogInterpreter of the external
+evaluator (evaluator/geoquery):
+  - largest(A, G), highest(A, G), ...: the solutions of G whose A has the
+      best degree; the degree is A itself if A is a number, and otherwise
+      its size, elevation or len;
+  - count(A, G, N), the(A, G, X), min(A, G, N), max(A, G, N): over the
+      distinct values of A in the solutions of G; min and max of nothing
+      have no solution;
+  - sum(A, G, D, N), argmin(A, G, D, X), argmax(A, G, D, X): over the
+      distinct pairs of A and its degree, where the degree goal D (e.g.
+      population(A)) gets the degree appended as its last argument; a sum
+      over nothing fails to execute;
+  - most(A, B, G), fewest(A, B, G): the values of A with the most (fewest)
+      distinct values of B.  If G is a conjunction, the values of A that
+      satisfy the goals of G that only depend on A count as having none.
+These are solved on their own, without the bindings made around them,
+and their solutions are then joined with those bindings; so they are
+memoized on the sub-query, since the same sub-queries come up for the
+gold LF and for many beam candidates.  Comparisons and negations, which do
+depend on the bindings around them, are memoized on the sub-query with its
+bound variables substituted.
+
+Running this file starts a worker for the protocol in evaluator.py:
+    python geoexecutor.py [geobase.dlog]
+and
+    python geoexecutor.py compare data.tsv [...]
+compares its denotations of the gold LFs of Geoquery data files with those
+of the external evaluator, and lists the ones that differ.
+"""
+import collections
+import os
+import re
+import sys
+
+import evaluator
+
+GEOBASE_FILE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    'ontology/geobase.dlog')
+
+PARSE_ERROR = 'Example FAILED TO PARSE'
+EXECUTE_ERROR = 'Example FAILED TO EXECUTE'
+
+MAX_MEMO_SIZE = 100000
+
+# Superlatives: name -> (measure relation, True to pick the maximum)
+SUPERLATIVES = {
+    'largest': ('size', True),
+    'smallest': ('size', False),
+    'highest': ('elevation', True),
+    'lowest': ('elevation', False),
+    'longest': ('len', True),
+    'shortest': ('len', False),
+}
+# Aggregates over the distinct values of their first argument:
+# name -> number of arguments
+AGGREGATES = {
+    'count': 3,
+    'the': 3,
+    'min': 3,
+    'max': 3,
+    'sum': 4,
+    'argmin': 4,
+    'argmax': 4,
+}
+# Superlatives over the last argument of a measure goal, e.g.
+# largest_one(population(A,B)); they apply to the whole conjunction so far.
+SUPERLATIVES_ONE = {
+    'largest_one': True,
+    'smallest_one': False,
+}
+# Comparisons: name -> (measure relation, True if the first is larger)
+COMPARISONS = {
+    'higher': ('elevation', True),
+    'lower': ('elevation', False),
+    'longer': ('len', True),
+    'shorter': ('len', False),
+}
+
+MAJOR_CITY_POPULATION = 150000
+MAJOR_RIVER_LENGTH = 750
+
+TOKEN_RE = re.compile(r"""\s*(?:
+    (\\\+)                                   # negation
+  | ([()\[\],.])                             # punctuation
+  | "([^"]*)" | '([^']*)'                    # quoted atom
+  | (-?[0-9][0-9.]*(?:e[+-]?[0-9]+)?)        # number
+  | ([A-Za-z_][A-Za-z0-9_]*)                 # atom or variable
+)""", re.VERBOSE)
+
+class Var(object):
+  """A logic variable; compared by identity."""
+  __slots__ = ('name',)
+  def __init__(self, name):
+    self.name = name
+
+  def __repr__(self):
+    return self.name
+
+class ParseError(Exception):
+  pass
+
+class ExecuteError(Exception):
+  pass
+
+def tokenize(s):
+  """Yield (kind, value) tokens; kind is 'punct', 'atom', 'num' or 'name'."""
+  pos = 0
+  s = s.rstrip()
+  while pos < len(s):
+    m = TOKEN_RE.match(s, pos)
+    if not m or m.end() == pos:
+      raise ParseError('Cannot tokenize at "%s"' % s[pos:pos+20])
+    pos = m.end()
+    neg, punct, dq, sq, num, name = m.groups()
+    if neg:
+      yield ('punct', neg)
+    elif punct:
+      yield ('punct', punct)
+    elif dq is not None:
+      yield ('atom', dq)
+    elif sq is not None:
+      yield ('atom', sq)
+    elif num:
+      yield ('num', float(num))
+    else:
+      yield ('name', name)
+
+class Parser(object):
+  """Parses Prolog terms.
+
+  Atoms are strings, numbers are floats, lists are Python lists and
+  compound terms are tuples (functor, arg1, ...).  A parenthesized
+  conjunction (g1, g2, ...) becomes (',', g1, g2, ...) and a negation
+  \\+ g becomes ('\\\\+', g).  Each '_' is a fresh variable.
+  """
+  def __init__(self, s):
+    self.toks = list(tokenize(s))
+    self.pos = 0
+    self.vars = {}
+
+  def peek(self):
+    if self.pos < len(self.toks):
+      return self.toks[self.pos]
+    return (None, None)
+
+  def next(self):
+    tok = self.peek()
+    if tok[0] is None:
+      raise ParseError('Unexpected end of input')
+    self.pos += 1
+    return tok
+
+  def expect(self, value):
+    tok = self.next()
+    if tok != ('punct', value):
+      raise ParseError('Expected "%s", got "%s"' % (value, tok[1]))
+
+  def parse_args(self, close):
+    args = [self.parse_term()]
+    while self.peek() == ('punct', ','):
+      self.next()
+      args.append(self.parse_term())
+    self.expect(close)
+    return args
+
+  def get_var(self, name):
+    if name == '_':
+      return Var('_')
+    if name not in self.vars:
+      self.vars[name] = Var(name)
+    return self.vars[name]
+
+  def parse_term(self):
+    kind, value = self.next()
+    if kind == 'punct':
+      if value == '(':
+        goals = self.parse_args(')')
+        if len(goals) == 1:
+          return goals[0]
+        return tuple([','] + goals)
+      if value == '[':
+        if self.peek() == ('punct', ']'):
+          self.next()
+          return []
+        return self.parse_args(']')
+      if value == '\\+':
+        return ('\\+', self.parse_term())
+      raise ParseError('Unexpected "%s"' % value)
+    if kind != 'name':
+      return value
+    if self.peek() == ('punct', '('):
+      self.next()
+      return tuple([value] + self.parse_args(')'))
+    if value[0] == '_' or value[0].isupper():
+      return self.get_var(value)
+    return value
+
+  def parse_statement(self):
+    term = self.parse_term()
+    if self.peek() == ('punct', '.'):
+      self.next()
+    if self.peek()[0] is not None:
+      raise ParseError('Trailing input after statement')
+    return term
+
+def parse(s):
+  return Parser(s).parse_statement()
+
+def walk(t, bindings):
+  while isinstance(t, Var) and t in bindings:
+    t = bindings[t]
+  return t
+
+def resolve(t, bindings):
+  """Substitute all bound variables in t."""
+  t = walk(t, bindings)
+  if isinstance(t, tuple):
+    return tuple([t[0]] + [resolve(a, bindings) for a in t[1:]])
+  return t
+
+def is_ground(t):
+  if isinstance(t, Var):
+    return False
+  if isinstance(t, tuple):
+    return all(is_ground(a) for a in t[1:])
+  return True
+
+def unify(a, b, bindings):
+  """Return the bindings extended to unify a and b, or None."""
+  a = walk(a, bindings)
+  b = walk(b, bindings)
+  if a is b:
+    return bindings
+  if isinstance(a, Var):
+    new_bindings = dict(bindings)
+    new_bindings[a] = b
+    return new_bindings
+  if isinstance(b, Var):
+    new_bindings = dict(bindings)
+    new_bindings[b] = a
+    return new_bindings
+  if isinstance(a, tuple) and isinstance(b, tuple):
+    if len(a) != len(b) or a[0] != b[0]:
+      return None
+    for x, y in zip(a[1:], b[1:]):
+      bindings = unify(x, y, bindings)
+      if bindings is None:
+        return None
+    return bindings
+  if a == b:
+    return bindings
+  return None
+
+def canonicalize(t, var_list):
+  """Replace variables by ('$VAR', i), appending new ones to var_list."""
+  if isinstance(t, Var):
+    for i, v in enumerate(var_list):
+      if v is t:
+        return ('$VAR', i)
+    var_list.append(t)
+    return ('$VAR', len(var_list) - 1)
+  if isinstance(t, tuple):
+    return tuple([t[0]] + [canonicalize(a, var_list) for a in t[1:]])
+  return t
+
+def get_dependent_vars(t):
+  """The variables through which a goal constrains the goals around it.
+
+  An aggregate only exposes its result; other goals expose all of their
+  variables.
+  """
+  if isinstance(t, Var):
+    return set([t])
+  if not isinstance(t, tuple):
+    return set()
+  if t[0] in AGGREGATES:
+    return get_dependent_vars(t[-1])
+  dependent_vars = set()
+  for a in t[1:]:
+    dependent_vars |= get_dependent_vars(a)
+  return dependent_vars
+
+def is_negation(t):
+  return isinstance(t, tuple) and t[0] == '\\+'
+
+def is_const(t):
+  return isinstance(t, tuple) and t[0] == 'const'
+
+def format_value(t):
+  if isinstance(t, float):
+    if t == int(t):
+      return str(int(t))
+    return repr(t)
+  if isinstance(t, tuple):
+    return '%s(%s)' % (t[0], ','.join(format_value(a) for a in t[1:]))
+  return str(t)
+
+class Relation(object):
+  """A set of ground tuples, with a hash index on every position."""
+  def __init__(self, tuples):
+    self.tuples = sorted(set(tuples), key=format_value)
+    self.index = collections.defaultdict(lambda: collections.defaultdict(list))
+    for tup in self.tuples:
+      for i, value in enumerate(tup):
+        self.index[i][value].append(tup)
+
+  def lookup(self, args):
+    """Get the candidate tuples for these (resolved) arguments."""
+    best = self.tuples
+    for i, arg in enumerate(args):
+      if is_ground(arg):
+        matches = self.index[i].get(arg, [])
+        if len(matches) < len(best):
+          best = matches
+    return best
+
+def read_facts(filename):
+  facts = collections.defaultdict(list)
+  with open(filename) as f:
+    for line in f:
+      line = line.strip()
+      if not line or line.startswith('%'):
+        continue
+      term = parse(line)
+      facts[term[0]].append(term[1:])
+  return facts
+
+def build_relations(facts):
+  """Turn the geobase facts into relations over entities."""
+  rels = collections.defaultdict(list)
+  usa = ('countryid', 'usa')
+  for fact in facts['state']:
+    name, abbr, capital, pop, area = fact[:5]
+    s =('stateid', name)
+    c = ('cityid', capital, abbr)
+    rels['state', 1].append((s,))
+    rels['loc', 2].append((s, usa))
+    rels['population', 2].append((s, pop))
+    rels['area', 2].append((s, area))
+    rels['size', 2].append((s, area))
+    rels['density', 2].append((s, pop / area))
+    rels['capital', 1].append((c,))
+    rels['capital', 2].append((s, c))
+    rels['city', 1].append((c,))
+    rels['loc', 2].extend([(c, s), (c, usa)])
+  for state, abbr, name, pop in facts['city']:
+    c = ('cityid', name, abbr)
+    rels['city', 1].append((c,))
+    rels['loc', 2].extend([(c, ('stateid', state)), (c, usa)])
+    rels['population', 2].append((c, pop))
+    rels['size', 2].append((c, pop))
+    if pop > MAJOR_CITY_POPULATION:
+      rels['major', 1].append((c,))
+  for name, length, states in facts['river']:
+    r = ('riverid', name)
+    rels['river', 1].append((r,))
+    rels['len', 2].append((r, length))
+    rels['size', 2].append((r, length))
+    rels['loc', 2].append((r, usa))
+    rels['traverse', 2].append((r, usa))
+    for state in states:
+      rels['loc', 2].append((r, ('stateid', state)))
+      rels['traverse', 2].append((r, ('stateid', state)))
+    if length > MAJOR_RIVER_LENGTH:
+      rels['major', 1].append((r,))
+  for name, area, states in facts['lake']:
+    l = ('lakeid', name)
+    rels['lake', 1].append((l,))
+    rels['area', 2].append((l, area))
+    rels['size', 2].append((l, area))
+    rels['loc', 2].append((l, usa))
+    for state in states:
+      rels['loc', 2].append((l, ('stateid', state)))
+  for state, abbr, name, elevation in facts['mountain']:
+    m = ('mountainid', name)
+    rels['mountain', 1].append((m,))
+    rels['place', 1].append((m,))
+    rels['elevation', 2].append((m, elevation))
+    rels['loc', 2].extend([(m, ('stateid', state)), (m, usa)])
+  points = []
+  for state, abbr, high, high_elevation, low, low_elevation in facts['highlow']:
+    s = ('stateid', state)
+    for name, elevation, rel in ((high, high_elevation, 'high_point'),
+                                 (low, low_elevation, 'low_point')):
+      p = ('placeid', name)
+      rels['place', 1].append((p,))
+      rels['elevation', 2].append((p, elevation))
+      rels['loc', 2].extend([(p, s), (p, usa)])
+      rels[rel, 2].append((s, p))
+      points.append((elevation, p))
+  if points:
+    rels['high_point', 2].append((usa, max(points)[1]))
+    rels['low_point', 2].append((usa, min(points)[1]))
+  for state, abbr, neighbors in facts['border']:
+    for neighbor in neighbors:
+      rels['next_to', 2].append((('stateid', state), ('stateid', neighbor)))
+      rels['next_to', 2].append((('stateid', neighbor), ('stateid', state)))
+  for name, pop, area in facts['country']:
+    c = ('countryid', name)
+    rels['country', 1].append((c,))
+    rels['population', 2].append((c, pop))
+    rels['area', 2].append((c, area))
+    rels['size', 2].append((c, area))
+  return dict((key, Relation(tuples)) for key, tuples in rels.items())
+
+class GeoExecutor(object):
+  """Executes Geoquery queries over the geobase relations."""
+  def __init__(self, filename=GEOBASE_FILE):
+    self.relations = build_relations(read_facts(filename))
+    self.memo = {}
+
+  def execute(self, request):
+    """Execute a '_parse([query], LF).' request (or a bare LF)."""
+    try:
+      term = parse(request)
+      if isinstance(term, tuple) and term[0] == '_parse' and len(term) >= 3:
+        term = term[2]
+      if not (isinstance(term, tuple) and term[0] == 'answer' and len(term) == 3):
+        raise ParseError('Expected answer(Var, Goal)')
+    except ParseError:
+      return PARSE_ERROR
+    try:
+      values = self.get_answers(term[1], term[2])
+    except (ExecuteError, RuntimeError, TypeError, ZeroDivisionError):
+      return EXECUTE_ERROR
+    return '{%s}' % ', '.join(sorted(format_value(v) for v in values))
+
+  def get_answers(self, var, goal):
+    values = set()
+    for b in self.solve(goal, {}):
+      value = resolve(var, b)
+      if not is_ground(value):
+        raise ExecuteError('Unbound answer %s' % format_value(value))
+      values.add(value)
+    return values
+
+  def solve(self, goal, b):
+    """Yield the bindings that extend b and satisfy goal."""
+    goal = walk(goal, b)
+    if isinstance(goal, Var) or not isinstance(goal, tuple):
+      raise ExecuteError('Not a goal: %s' % format_value(goal))
+    name = goal[0]
+    args = goal[1:]
+    if name == ',':
+      return self.solve_conj(list(args), b)
+    if name == 'const' and len(args) == 2:
+      return self.solve_unify(args[0], args[1], b)
+    if name == 'exclude' and len(args) == 2:
+      return self.solve_exclude(args[0], args[1], b)
+    if name == '\\+' or name in COMPARISONS:
+      return self.solve_memoized(goal, b)
+    if name in SUPERLATIVES or name in AGGREGATES or name in ('most', 'fewest'):
+      return self.solve_isolated(goal, b)
+    if name in SUPERLATIVES_ONE and len(args) == 1:
+      return self.solve_conj([goal], b)
+    if (name, len(args)) in self.relations:
+      return self.solve_relation(self.relations[name, len(args)], args, b)
+    raise ExecuteError('Unknown predicate %s/%d' % (name, len(args)))
+
+  def solve_unify(self, x, y, b):
+    b = unify(x, y, b)
+    if b is not None:
+      yield b
+
+  def solve_exclude(self, x, y, b):
+    x = resolve(x, b)
+    y = resolve(y, b)
+    if not (is_ground(x) and is_ground(y)):
+      raise ExecuteError('exclude/2 on unbound arguments')
+    if x != y:
+      yield b
+
+  def solve_relation(self, relation, args, b):
+    args = [resolve(a, b) for a in args]
+    for tup in relation.lookup(args):
+      new_b = b
+      for arg, value in zip(args, tup):
+        new_b = unify(arg, value, new_b)
+        if new_b is None:
+          break
+      if new_b is not None:
+        yield new_b
+
+  def solve_conj(self, goals, b):
+    # const/2 only unifies, so it is safe (and cheaper) to run it first;
+    # but not before a negation, which only sees the bindings of the goals
+    # that come before it.
+    ordered = []
+    start = 0
+    for i, g in enumerate(goals + [None]):
+      if g is None or is_negation(g):
+        run = goals[start:i]
+        ordered.extend([g1 for g1 in run if is_const(g1)] +
+                       [g1 for g1 in run if not is_const(g1)])
+        if g is not None:
+          ordered.append(g)
+        start = i + 1
+    goals = ordered
+    for i, g in enumerate(goals):
+      if isinstance(g, tuple) and g[0] in SUPERLATIVES_ONE and len(g) == 2:
+        # Keep the solutions of everything so far that maximize (or minimize)
+        # the last argument of the measure goal.
+        measure = g[1]
+        if not isinstance(measure, tuple) or len(measure) < 2:
+          raise ExecuteError('Bad argument to %s' % g[0])
+        solutions = list(self.solve_all(goals[:i] + [measure], b))
+        scores = [resolve(measure[-1], s) for s in solutions]
+        if not solutions:
+          return iter([])
+        if not all(isinstance(score, float) for score in scores):
+          raise ExecuteError('Non-numeric measure in %s' % g[0])
+        best = max(scores) if SUPERLATIVES_ONE[g[0]] else min(scores)
+        rest = goals[i+1:]
+        return (b2 for s, score in zip(solutions, scores) if score == best
+                for b2 in self.solve_all(rest, s))
+    return self.solve_all(goals, b)
+
+  def solve_all(self, goals, b):
+    if not goals:
+      yield b
+      return
+    for b1 in self.solve(goals[0], b):
+      for b2 in self.solve_all(goals[1:], b1):
+        yield b2
+
+  def solve_memoized(self, goal, b):
+    """Solve an aggregate sub-query, sharing results between queries."""
+    term = resolve(goal, b)
+    var_list = []
+    key = canonicalize(term, var_list)
+    if key not in self.memo:
+      if len(self.memo) >= MAX_MEMO_SIZE:
+        self.memo.clear()
+      self.memo[key] = [tuple(resolve(v, s) for v in var_list)
+                        for s in self.solve_aggregate(term)]
+    for values in self.memo[key]:
+      new_b = b
+      for v, value in zip(var_list, values):
+        new_b = unify(v, value, new_b)
+        if new_b is None:
+          break
+      if new_b is not None:
+        yield new_b
+
+  def solve_isolated(self, goal, b):
+    """Solve a higher-order goal on its own, and join its solutions with b."""
+    var_list = []
+    key = canonicalize(goal, var_list)
+    if key not in self.memo:
+      if len(self.memo) >= MAX_MEMO_SIZE:
+        self.memo.clear()
+      # Variables a solution leaves unbound are stored as None.
+      self.memo[key] = [tuple(value if is_ground(value) else None
+                              for value in (resolve(v, s) for v in var_list))
+                        for s in self.solve_aggregate(goal)]
+    for values in self.memo[key]:
+      new_b = b
+      for v, value in zip(var_list, values):
+        if value is not None:
+          new_b = unify(v, value, new_b)
+          if new_b is None:
+            break
+      if new_b is not None:
+        yield new_b
+
+  def get_values(self, v, goal, b):
+    """The distinct values of v in the solutions of goal, in order."""
+    values = set()
+    for s in self.solve(goal, b):
+      value = resolve(v, s)
+      if not is_ground(value):
+        raise ExecuteError('Unbound variable %s' % format_value(v))
+      values.add(value)
+    return sorted(values, key=format_value)
+
+  def get_measure(self, rel_name, x):
+    """Get the (single) value of measure relation rel_name for entity x."""
+    values = [tup[1] for tup in self.relations[rel_name, 2].lookup([x, Var('_')])
+              if tup[0] == x]
+    if not values:
+      return None
+    return values[0]
+
+  def solve_aggregate(self, term):
+    """Solve a higher-order goal, a comparison or a negation from empty bindings.
+
+    Comparisons and negations get the goal with the bindings around it
+    substituted; the other goals get it as it is written.
+    """
+    name = term[0]
+    args = term[1:]
+    b = {}
+    if name == '\\+' and len(args) == 1:
+      for _ in self.solve(args[0], b):
+        return []
+      return [b]
+    if name in SUPERLATIVES and len(args) == 2:
+      rel_name, use_max = SUPERLATIVES[name]
+      x, g = args
+      solutions = list(self.solve(g, b))
+      if not solutions:
+        return []
+      if isinstance(resolve(x, solutions[0]), float):
+        # A number is its own degree, e.g. largest(A,(state(B),population(B,A))).
+        scored = [(resolve(x, s), s) for s in solutions]
+      else:
+        scored = [(self.get_measure(rel_name, resolve(x, s)), s) for s in solutions]
+        scored = [(score, s) for score, s in scored if score is not None]
+      if not scored:
+        return []
+      if not all(isinstance(score, float) for score, s in scored):
+        raise ExecuteError('Non-numeric degree in %s' % name)
+      best = max(score for score, s in scored) if use_max else min(
+          score for score, s in scored)
+      return [s for score, s in scored if score == best]
+    if name in COMPARISONS and len(args) == 2:
+      rel_name, first_larger = COMPARISONS[name]
+      x, y = args
+      results = []
+      measure = self.relations[rel_name, 2]
+      for b1 in self.solve_relation(measure, [x, Var('_X')], b):
+        score_x = self.get_measure(rel_name, resolve(x, b1))
+        for b2 in self.solve_relation(measure, [y, Var('_Y')], b1):
+          score_y = self.get_measure(rel_name, resolve(y, b2))
+          if (score_x > score_y) == first_larger and score_x != score_y:
+            results.append(b2)
+      return results
+    if name in AGGREGATES and len(args) == AGGREGATES[name] == 3:
+      v, g, n = args
+      values = self.get_values(v, g, b)
+      if name == 'count':
+        results = [float(len(values))]
+      elif name == 'the':
+        results = values
+      else:
+        if not all(isinstance(value, float) for value in values):
+          raise ExecuteError('Non-numeric value in %s/3' % name)
+        results = [max(values) if name == 'max' else min(values)] if values else []
+      return [b1 for b1 in (unify(n, value, b) for value in results) if b1 is not None]
+    if name in AGGREGATES and len(args) == AGGREGATES[name] == 4:
+      v, g, degree, n = args
+      if not isinstance(degree, tuple):
+        raise ExecuteError('Bad degree in %s/4' % name)
+      d = Var('_D')
+      pairs = set()
+      for s in self.solve_all([g, degree + (d,)], b):
+        value = resolve(v, s)
+        score = resolve(d, s)
+        if not is_ground(value) or not isinstance(score, float):
+          raise ExecuteError('Bad value or degree in %s/4' % name)
+        pairs.add((value, score))
+      if name == 'sum':
+        if not pairs:
+          raise ExecuteError('sum/4 over an empty set')
+        results = [sum(score for value, score in pairs)]
+      elif pairs:
+        scores = [score for value, score in pairs]
+        best = max(scores) if name == 'argmax' else min(scores)
+        results = sorted(set(value for value, score in pairs if score == best),
+                         key=format_value)
+      else:
+        results = []
+      return [b1 for b1 in (unify(n, value, b) for value in results) if b1 is not None]
+    if name in ('most', 'fewest') and len(args) == 3:
+      x, y, g = args
+      groups = collections.defaultdict(set)
+      for s in self.solve(g, b):
+        x_value = resolve(x, s)
+        y_value = resolve(y, s)
+        if not (is_ground(x_value) and is_ground(y_value)):
+          raise ExecuteError('Unbound variable in %s' % name)
+        groups[x_value].add(y_value)
+      if isinstance(g, tuple) and g[0] == ',':
+        # Values of x that only fail the goals on y count as having no y.
+        restrict = [g1 for g1 in g[1:] if get_dependent_vars(g1) == set([x])]
+        if restrict:
+          for x_value in self.get_values(x, tuple([','] + restrict), b):
+            groups.setdefault(x_value, set())
+      if not groups:
+        return []
+      counts = dict((k, len(v)) for k, v in groups.items())
+      best = max(counts.values()) if name == 'most' else min(counts.values())
+      return [unify(x, k, b) for k in sorted(counts, key=format_value)
+              if counts[k] == best]
+    raise ExecuteError('Bad higher-order predicate %s/%d' % (name, len(args)))
+
+_EXECUTOR = None
+
+def get_executor():
+  """Get the executor of this process, loading the geobase on first use."""
+  global _EXECUTOR
+  if _EXECUTOR is None:
+    _EXECUTOR = GeoExecutor()
+  return _EXECUTOR
+
+def read_gold_lfs(filenames):
+  """The gold LFs (second column) of Geoquery data files."""
+  lfs = []
+  for filename in filenames:
+    with open(filename) as f:
+      for line in f:
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) >= 2:
+          lfs.append(fields[1])
+  return lfs
+
+def compare(requests, executor, reference):
+  """Get the (request, denotation, reference denotation) that differ."""
+  return [(request, denotation, expected)
+          for request, denotation, expected in zip(
+              requests, (executor.execute(r) for r in requests),
+              reference.execute(requests))
+          if denotation != expected]
+
+def main():
+  if len(sys.argv) > 1 and sys.argv[1] == 'compare':
+    if len(sys.argv) < 3:
+      sys.stderr.write('Usage: %s compare data.tsv [...]\n' % sys.argv[0])
+      sys.exit(1)
+    import domains
+    domain = domains.GeoqueryDomain()
+    requests = [domain.get_request(lf) for lf in read_gold_lfs(sys.argv[2:])]
+    diffs = compare(requests, get_executor(), domain.new_evaluator())
+    for request, denotation, expected in diffs:
+      print('%s\n  geoexecutor: %s\n  reference:   %s' % (request, denotation, expected))
+    print('%d of %d denotations differ' % (len(diffs), len(requests)))
+    if diffs:
+      sys.exit(1)
+    return
+  if len(sys.argv) > 1:
+    executor = GeoExecutor(sys.argv[1])
+  else:
+    executor = get_executor()
+  evaluator.serve(executor.execute)
+
+if __name__ == '__main__':
+  main()
@@ -8,6 +8,7 @@ import re
 import sys
 
 from lexicon import Lexicon
+import lexiconcache
 
 LEXICON_DIR = os.path.join(
     os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'lexicon')
@@ -80,8 +81,12 @@ def get_ccg_lexicon():
   lexicon.add_entries(entries, False)
   return lexicon
 
+def get_cached_ccg_lexicon():
+  return lexiconcache.load_or_build(
+      'geo-ccg', [os.path.join(LEXICON_DIR, 'geo-lexicon.txt')], get_ccg_lexicon)
+
 def get_lexicon(basename='', newname=''):
-  return get_ccg_lexicon()
+  return get_cached_ccg_lexicon()
   #return get_lexicon_from_raw_lexicon_then_write(basename, newname)
 
 def extract_entity_from_action(action):
@@ -0,0 +1,108 @@
+"""A hashed input vocabulary for a neural model.
+
+Instead of one embedding row per distinct training word, words are hashed
+into a fixed number of buckets, so the embedding matrix does not grow with
+the training corpus and unseen words still get a (shared) embedding.
+With num_hashes > 1, each word is hashed several times and its embedding
+is the sum of the rows of all its buckets, which makes it unlikely that two
+frequent words share all their rows.
+
+To keep the same interface as Vocabulary (one integer index per word,
+which is what the encoder's theano.scan iterates over), the bucket ids of
+a word are packed into a single index: b_0 + B * b_1 + B^2 * b_2 + ...
+where B is the number of buckets.  get_theano_embedding() unpacks them.
+"""
+import hashlib
+import numpy
+import theano
+
+class HashedVocabulary:
+  """A vocabulary that maps words to hashed embedding buckets.
+
+  By convention, the end-of-sentence token '</s>' always maps to bucket 0,
+  and no other word does.
+  """
+  END_OF_SENTENCE = '</s>'
+  END_OF_SENTENCE_INDEX = 0
+  MAX_NUM_HASHES = 4  # Each hash uses 4 bytes of one md5 digest
+
+  def __init__(self, num_buckets, emb_size, num_hashes=1,
+               float_type=numpy.float64):
+    """Create the vocabulary.
+
+    Args:
+      num_buckets: number of embedding rows (including the one for </s>)
+      emb_size: dimension of word embeddings
+      num_hashes: number of buckets each word is hashed to
+      float_type: numpy float type for theano
+    """
+    if not 1 <= num_hashes <= self.MAX_NUM_HASHES:
+      raise ValueError('num_hashes must be between 1 and %d' % self.MAX_NUM_HASHES)
+    if num_buckets ** num_hashes >= 2 ** 63:
+      raise ValueError('Cannot pack %d hashes into %d buckets in an int64' % (
+          num_hashes, num_buckets))
+    self.num_buckets = num_buckets
+    self.num_hashes = num_hashes
+    self.emb_size = emb_size
+    self.float_type = float_type
+
+    # Embedding matrix
+    init_val = 0.1 * numpy.random.uniform(-1.0, 1.0, (self.size(), emb_size)).astype(theano.config.floatX)
+    self.emb_mat = theano.shared(
+        name='vocab_emb_mat',
+        value=init_val)
+
+  def get_buckets(self, word):
+    """Get the num_hashes buckets of a word, all in [1, num_buckets)."""
+    if word == self.END_OF_SENTENCE:
+      return [0] * self.num_hashes
+    digest = hashlib.md5(word.encode('utf-8') if not isinstance(word, bytes) else word).hexdigest()
+    return [1 + int(digest[8*j:8*(j+1)], 16) % (self.num_buckets - 1)
+            for j in range(self.num_hashes)]
+
+  def get_theano_embedding(self, i):
+    """Get theano embedding for given (packed) word index."""
+    emb = self.emb_mat[i % self.num_buckets]
+    for j in range(1, self.num_hashes):
+      emb = emb + self.emb_mat[(i // (self.num_buckets ** j)) % self.num_buckets]
+    return emb
+
+  def get_theano_params(self):
+    """Get theano parameters to back-propagate through."""
+    return [self.emb_mat]
+
+  def get_theano_all(self):
+    """By default, same as self.get_theano_params()."""
+    return self.get_theano_params()
+
+  def get_index(self, word):
+    index = 0
+    for j, bucket in enumerate(self.get_buckets(word)):
+      index += bucket * self.num_buckets ** j
+    return index
+
+  def sentence_to_indices(self, sentence, add_eos=True):
+    words = sentence.split(' ')
+    if add_eos:
+      words.append(self.END_OF_SENTENCE)
+    indices = [self.get_index(w) for w in words]
+    return indices
+
+  def size(self):
+    return self.num_buckets
+
+  @classmethod
+  def from_sentences(cls, sentences, emb_size, num_buckets=65536, num_hashes=1,
+                     unk_cutoff=0, **kwargs):
+    """Create a hashed vocabulary; the sentences are not needed.
+
+      Args:
+        sentences: ignored, accepted for compatibility with Vocabulary
+        emb_size: size of embedding
+        num_buckets: number of embedding rows
+        num_hashes: number of buckets each word is hashed to
+        unk_cutoff: ignored, since every word gets buckets
+    """
+    print 'Using hashed vocabulary with %d buckets, %d hash(es) per word' % (
+        num_buckets, num_hashes)
+    return cls(num_buckets, emb_size, num_hashes=num_hashes, **kwargs)
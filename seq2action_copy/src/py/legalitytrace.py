@@ -0,0 +1,241 @@
+"""Traces of the legality queries made while decoding, and their replay.
+
+The ontologies (GeneralOntology, AtisGeneralOntology, GeoOntology,
+AtisOntology) are hard to optimize in isolation, because their inputs are
+the controller states built up by a real decode.  With
+    python main.py ... --record-legality-trace trace.pkl
+every call to get_legal_action_list and is_legal_action_then_read made
+while decoding is written to a trace: the label of the controller, its
+arguments (pre_action_class, pre_arg_list, pre_action, the state dicts,
+fun_trace_list and action_all) as of the call, and what it returned.  For
+is_legal_action_then_read, which updates the state dicts in place, the
+arguments after the call are kept as well.  Then
+    python legalitytrace.py replay trace.pkl [--repeat 5]
+        [--controller general=mymodule.FasterGeneralOntology]
+rebuilds the controllers, times each method on every recorded call, and
+checks that the masks and the updated states are identical to those
+recorded.
+
+A trace is a stream of pickled records: a header, then ('example', x_str)
+at the start of each decode, ('action_list', index, actions) the first
+time each action_all is seen, and ('call', label, method, args,
+action_list_index, kwargs, result, args_after) for each call.  In a batch
+decode the examples take turns, so ('example', x_str) comes before the
+calls of each step of each example.
+"""
+import argparse
+import collections
+import copy
+import importlib
+import sys
+import time
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+
+FORMAT_VERSION = 1
+METHODS = ('get_legal_action_list', 'is_legal_action_then_read')
+
+class TraceRecorder(object):
+  """Records the legality queries made to controllers while decoding."""
+  def __init__(self, filename):
+    self.f = open(filename, 'wb')
+    self.controllers = {}
+    self.action_list_indices = {}
+    self.recording = False
+    self.depth = 0
+    self.num_calls = 0
+    self.wrote_header = False
+
+  def instrument(self, controller, label, grammar_file):
+    """Record the calls to the legality methods of a controller."""
+    cls = controller.__class__
+    self.controllers[label] = {
+        'class': '%s.%s' % (cls.__module__, cls.__name__),
+        'grammar_file': grammar_file,
+        'use_ontology': controller.use_ontology,
+    }
+    for method in METHODS:
+      setattr(controller, method, self._wrap(getattr(controller, method), label, method))
+
+  def _wrap(self, fn, label, method):
+    def recorded(*args, **kwargs):
+      # Only record the outermost call, not those the controller makes itself.
+      if not self.recording or self.depth:
+        return fn(*args, **kwargs)
+      args = list(args)
+      action_list_index = None
+      if method == 'get_legal_action_list':
+        # action_all is the same for many calls, so it is written once.
+        action_list_index = self._get_action_list_index(args[-1])
+        args_before = copy.deepcopy(args[:-1])
+      else:
+        args_before = copy.deepcopy(args)
+      self.depth += 1
+      try:
+        result = fn(*args, **kwargs)
+      finally:
+        self.depth -= 1
+      args_after = None
+      if method == 'is_legal_action_then_read':
+        args_after = copy.deepcopy(args)
+      self._dump(('call', label, method, args_before, action_list_index, kwargs,
+                  copy.deepcopy(result), args_after))
+      self.num_calls += 1
+      return result
+    return recorded
+
+  def _get_action_list_index(self, action_all):
+    key = tuple(action_all)
+    if key not in self.action_list_indices:
+      self.action_list_indices[key] = len(self.action_list_indices)
+      self._dump(('action_list', self.action_list_indices[key], list(action_all)))
+    return self.action_list_indices[key]
+
+  def _write_header(self):
+    if not self.wrote_header:
+      self.wrote_header = True
+      pickle.dump({'format_version': FORMAT_VERSION, 'controllers': self.controllers},
+                  self.f, pickle.HIGHEST_PROTOCOL)
+
+  def _dump(self, record):
+    self._write_header()
+    pickle.dump(record, self.f, pickle.HIGHEST_PROTOCOL)
+
+  def begin(self, x_str):
+    """Called when the decode of an example starts."""
+    self._dump(('example', x_str))
+    self.recording = True
+
+  def end(self):
+    """Called when the decode of an example ends."""
+    self.recording = False
+
+  def close(self):
+    self._write_header()
+    self.f.close()
+
+def read(filename):
+  """Get the header of a trace, and an iterator over its records."""
+  f = open(filename, 'rb')
+  header = pickle.load(f)
+  if header['format_version'] > FORMAT_VERSION:
+    raise ValueError('%s has format version %d, newer than %d' % (
+        filename, header['format_version'], FORMAT_VERSION))
+  def records():
+    try:
+      while True:
+        yield pickle.load(f)
+    except EOFError:
+      f.close()
+  return header, records()
+
+def load_calls(filename):
+  """Read a trace into (header, calls), with action_all put back in the calls."""
+  header, records = read(filename)
+  action_lists = {}
+  calls = []
+  for record in records:
+    if record[0] == 'action_list':
+      action_lists[record[1]] = record[2]
+    elif record[0] == 'call':
+      _, label, method, args, action_list_index, kwargs, result, args_after = record
+      if action_list_index is not None:
+        args = args + [action_lists[action_list_index]]
+      calls.append((label, method, args, kwargs, result, args_after))
+  return header, calls
+
+def get_class(name):
+  module_name, class_name = name.rsplit('.', 1)
+  return getattr(importlib.import_module(module_name), class_name)
+
+def make_controllers(header, classes=None, grammar_files=None):
+  """Build the controllers of a trace, optionally with other classes or grammars."""
+  controllers = {}
+  for label, info in header['controllers'].items():
+    cls = get_class((classes or {}).get(label, info['class']))
+    grammar_file = (grammar_files or {}).get(label, info['grammar_file'])
+    controllers[label] = cls(grammar_file, info['use_ontology'])
+  return controllers
+
+def is_same(method, result, expected, args, args_after):
+  """Whether a replayed call gave exactly what the trace recorded.
+
+  A mask must have the same type (and dtype, for an array) and the same
+  values of the same types: a mask of 0/1 ints or floats where bools were
+  recorded is a difference, even though the decoder would pick the same
+  actions.
+  """
+  if method == 'get_legal_action_list':
+    return (type(result) == type(expected)
+            and getattr(result, 'dtype', None) == getattr(expected, 'dtype', None)
+            and list(result) == list(expected)
+            and [type(x) for x in result] == [type(x) for x in expected])
+  return tuple(result) == tuple(expected) and args == args_after
+
+def replay(calls, controllers, repeat=1):
+  """Run the calls of a trace on controllers.
+
+  Returns the calls and seconds per (label, method), and the indices of
+  the calls whose results differ from those recorded.
+  """
+  num_calls = collections.Counter()
+  seconds = collections.Counter()
+  mismatches = set()
+  for _ in range(repeat):
+    for i, (label, method, args, kwargs, expected, args_after) in enumerate(calls):
+      fn = getattr(controllers[label], method)
+      args_copy = copy.deepcopy(args)
+      t0 = time.time()
+      result = fn(*args_copy, **kwargs)
+      seconds[label, method] += time.time() - t0
+      num_calls[label, method] += 1
+      if not is_same(method, result, expected, args_copy, args_after):
+        mismatches.add(i)
+  return num_calls, seconds, sorted(mismatches)
+
+def parse_assignments(values):
+  return dict(value.split('=', 1) for value in values)
+
+def _parse_args():
+  parser = argparse.ArgumentParser(
+      description='Inspect or replay a trace of legality queries.')
+  parser.add_argument('command', choices=['info', 'replay'])
+  parser.add_argument('trace')
+  parser.add_argument('--repeat', type=int, default=1,
+                      help='Number of times to replay the trace (default = 1)')
+  parser.add_argument('--controller', action='append', default=[],
+                      help='label=module.Class, to replay on another implementation')
+  parser.add_argument('--grammar', action='append', default=[],
+                      help='label=path, to replay with another grammar file')
+  parser.add_argument('--show', type=int, default=5,
+                      help='Number of mismatched calls to print (default = 5)')
+  return parser.parse_args()
+
+def main():
+  args = _parse_args()
+  header, calls = load_calls(args.trace)
+  counts = collections.Counter((label, method) for label, method, _, _, _, _ in calls)
+  for label, info in sorted(header['controllers'].items()):
+    print('%s: %s (%s)' % (label, info['class'], info['grammar_file']))
+  if args.command == 'info':
+    for (label, method), n in sorted(counts.items()):
+      print('  %-40s %10d calls' % ('%s.%s' % (label, method), n))
+    return
+  controllers = make_controllers(header, parse_assignments(args.controller),
+                                 parse_assignments(args.grammar))
+  num_calls, seconds, mismatches = replay(calls, controllers, repeat=args.repeat)
+  for key in sorted(num_calls):
+    n = num_calls[key]
+    print('  %-40s %10d calls %10.3fs %8.2fus/call' % (
+        '%s.%s' % key, n, seconds[key], 1e6 * seconds[key] / n))
+  print('%d of %d calls differ from the trace' % (len(mismatches), len(calls)))
+  for i in mismatches[:args.show]:
+    label, method, call_args, _, expected, _ = calls[i]
+    print('  [%d] %s.%s%s' % (i, label, method, tuple(call_args[:3])))
+  if mismatches:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,132 @@
+"""A build cache for compiled lexicons.
+
+Building a lexicon means re-reading and re-parsing its source files
+(the ATIS DB tables, the CCG lexicon files), which is slow and happens every
+time get_lexicon() is called.  This module serializes the finished entries
+of a Lexicon or LexiconReplace (and the unique word map, for a Lexicon) to a
+binary file, and reloads them as long as none of the source files changed.
+
+Regex handlers are functions, so they are never serialized; callers that
+use them pass an add_handlers function that re-registers them after loading.
+"""
+import hashlib
+import os
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+
+CACHE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    'cache/lexicon')
+CACHE_VERSION = 1
+
+# Attributes that hold functions and must be rebuilt rather than serialized.
+UNSERIALIZED_FIELDS = ('handlers',)
+
+# Lexicons already loaded by this process, keyed by cache name.
+_LOADED = {}
+
+def file_hash(filename):
+  h = hashlib.sha1()
+  with open(filename, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 16), b''):
+      h.update(block)
+  return h.hexdigest()
+
+def get_source_info(filename):
+  """Return (mtime, size, sha1) for a source file."""
+  st = os.stat(filename)
+  return (st.st_mtime, st.st_size, file_hash(filename))
+
+def is_fresh(cached_sources, source_files):
+  """Check the recorded source info against the files on disk.
+
+  A matching mtime and size is trusted without re-hashing the file;
+  otherwise the file is only considered changed if its hash changed
+  (e.g. a fresh checkout touches mtimes but not contents).
+  """
+  if sorted(cached_sources) != sorted(source_files):
+    return False
+  for filename in source_files:
+    if not os.path.exists(filename):
+      return False
+    mtime, size, sha1 = cached_sources[filename]
+    st = os.stat(filename)
+    if st.st_mtime == mtime and st.st_size == size:
+      continue
+    if file_hash(filename) != sha1:
+      return False
+  return True
+
+def to_record(lex, source_files):
+  state = dict((k, v) for k, v in lex.__dict__.items()
+               if k not in UNSERIALIZED_FIELDS)
+  return {
+      'version': CACHE_VERSION,
+      'module': lex.__class__.__module__,
+      'class': lex.__class__.__name__,
+      'sources': dict((f, get_source_info(f)) for f in source_files),
+      'state': state,
+  }
+
+def from_record(record):
+  """Recreate the lexicon object; its constructor resets the handler list."""
+  module = __import__(record['module'])
+  lex = getattr(module, record['class'])()
+  lex.__dict__.update(record['state'])
+  return lex
+
+def read_cache(filename, source_files):
+  if not os.path.exists(filename):
+    return None
+  try:
+    with open(filename, 'rb') as f:
+      record = pickle.load(f)
+  except Exception as e:
+    print('Ignoring unreadable lexicon cache %s: %s' % (filename, e))
+    return None
+  if record.get('version') != CACHE_VERSION:
+    return None
+  if not is_fresh(record['sources'], source_files):
+    return None
+  return from_record(record)
+
+def write_cache(filename, lex, source_files):
+  """Write the cache to a temporary file, then rename it into place."""
+  dirname = os.path.dirname(filename)
+  if not os.path.isdir(dirname):
+    os.makedirs(dirname)
+  tmp_filename = '%s.tmp.%d' % (filename, os.getpid())
+  with open(tmp_filename, 'wb') as f:
+    pickle.dump(to_record(lex, source_files), f, pickle.HIGHEST_PROTOCOL)
+  os.rename(tmp_filename, filename)
+
+def load_or_build(name, source_files, build_fn, add_handlers_fn=None):
+  """Get a lexicon, from the cache if possible.
+
+  Args:
+    name: Name of the cache file (one per distinct lexicon).
+    source_files: Every file build_fn reads; any change invalidates the cache.
+    build_fn: Function with no arguments that builds the lexicon from scratch.
+    add_handlers_fn: Optional function that registers regex handlers
+        on a Lexicon, since these cannot be serialized.
+  Returns:
+    The lexicon.  Repeated calls in one process return the same object.
+  """
+  if name in _LOADED:
+    return _LOADED[name]
+  filename = os.path.join(CACHE_DIR, '%s.pkl' % name)
+  lex = read_cache(filename, source_files)
+  if lex is not None:
+    print('Loaded lexicon "%s" from cache %s' % (name, filename))
+  else:
+    lex = build_fn()
+    try:
+      write_cache(filename, lex, source_files)
+    except (IOError, OSError) as e:
+      print('Could not write lexicon cache %s: %s' % (filename, e))
+  if add_handlers_fn:
+    add_handlers_fn(lex)
+  _LOADED[name] = lex
+  return lex
@@ -1,6 +1,5 @@
 """Run tests on toy data for IRW models."""
 import argparse
-import cgi
 import collections
 import itertools
 import json
@@ -9,28 +8,47 @@ import numpy
 import os
 import random
 import re
+import shlex
 import sys
 import theano
 
 # Local imports
 import atislexicon
+import checkpoint
+import datacache
+from dataloader import TsvDataset
 import geolexicon
 from augmentation import Augmenter
+import convertorcache
+import decodeprofile
 import domains
+import evalresults
+import evaluator
+import legalitytrace
+import numpyinference
+import predictioncache
+import server
 from attention import AttentionModel
+from numpyinference import NumpyAttentionModel
 from example import Example
 import spec as specutil
+import theanoprofile
+import trainstate
 from vocabulary import Vocabulary
+from hashed_vocabulary import HashedVocabulary
 from action_vocabulary import ActionVocabulary
 from geoontology import GeoOntology
 from generalontology import GeneralOntology
 from atisontology import AtisOntology
 from atisgeneralontology import AtisGeneralOntology
 from geoaction2seq import action2seq as geo_action2seq
+from geoaction2seq import action2seq_from_state as geo_action2seq_from_state
 from atisaction2seq import action2seq as atis_action2seq
+from atisaction2seq import action2seq_from_state as atis_action2seq_from_state
 
 MODELS = collections.OrderedDict([
     ('attention', AttentionModel),
+    ('attention-numpy', NumpyAttentionModel),
 ])
 
 CONTROLLERS = collections.OrderedDict([
@@ -45,11 +63,20 @@ CONVERTORS = collections.OrderedDict([
     ('atisaction2seq', atis_action2seq)
 ])
 
+# Render a logical form from a finished derivation's controller state
+STATE_CONVERTORS = collections.OrderedDict([
+    ('geoaction2seq', geo_action2seq_from_state),
+    ('atisaction2seq', atis_action2seq_from_state)
+])
+
 VOCAB_TYPES = collections.OrderedDict([
     ('raw', lambda s, e, **kwargs: Vocabulary.from_sentences(
         s, e, **kwargs)),
     ('glove', lambda s, e, **kwargs: Vocabulary.from_sentences(
         s, e, use_glove=True, **kwargs)),
+    ('hashed', lambda s, e, **kwargs: HashedVocabulary.from_sentences(
+        s, e, num_buckets=OPTIONS.hash_buckets, num_hashes=OPTIONS.num_hashes,
+        **kwargs)),
     ('action', lambda d, s, stru_em, sem_em, **kwargs: ActionVocabulary.from_databases(
         d, s, stru_em, sem_em, **kwargs))
 ])
@@ -60,6 +87,12 @@ OPTIONS = None
 # Global statistics
 STATS = {}
 
+# Per-example evaluation results (see evalresults.py)
+RESULTS_WRITER = None
+
+# Legality queries made while decoding (see legalitytrace.py)
+TRACE_RECORDER = None
+
 def _parse_args():
   global OPTIONS
   parser = argparse.ArgumentParser(
@@ -106,6 +139,10 @@ def _parse_args():
   parser.add_argument('--input-vocab-type',
                       help='type of input vocabulary (options: [%s])' % (
                           ', '.join(VOCAB_TYPES)), default='raw')
+  parser.add_argument('--hash-buckets', type=int, default=65536,
+                      help='Number of embedding rows for a hashed input vocabulary.')
+  parser.add_argument('--num-hashes', type=int, default=1,
+                      help='Number of buckets each word is hashed to, for a hashed input vocabulary.')
   parser.add_argument('--output-vocab-type',
                       help='type of output vocabulary (options: [%s])' % (
                           ', '.join(VOCAB_TYPES)), default='action')
@@ -115,8 +152,31 @@ def _parse_args():
                       help='Use 32-bit floats (default is 64-bit/double precision).')
   parser.add_argument('--beam-size', '-k', type=int, default=0,
                       help='Use beam search with given beam size (default is greedy).')
+  parser.add_argument('--decode-time-limit-ms', type=float, default=0,
+                      help='Stop decoding an example after this long and return the best result so far '
+                      '(default = 0, no limit).')
+  parser.add_argument('--decode-step-limit', type=int, default=0,
+                      help='Stop decoding an example after this many decoder steps (default = 0, no limit).')
   parser.add_argument('--domain', default=None,
                       help='Domain for augmentation and evaluation (options: [geoquery,atis,overnight-${domain}])')
+  parser.add_argument('--denotation-cache-size', type=int, default=100000,
+                      help='Number of LF denotations to cache across evaluations (0 to disable).')
+  parser.add_argument('--denotation-cache-file', default=None,
+                      help='File to persist the denotation cache in across runs.')
+  parser.add_argument('--convertor-cache-size', type=int, default=100000,
+                      help='Number of action sequences whose logical forms are cached (0 to disable).')
+  parser.add_argument('--execute-all-derivations', action='store_true',
+                      help=('Execute every derivation in every beam, instead of '
+                            'only until one per example executes without error '
+                            '(which is the default with --local-evaluator or '
+                            '--evaluator-worker).'))
+  parser.add_argument('--local-evaluator', action='store_true',
+                      help=('Use the domain\'s in-process executor (geoquery) '
+                            'instead of its external evaluator binary.'))
+  parser.add_argument('--evaluator-worker', default=None,
+                      help=('Command of a persistent evaluator worker that speaks '
+                            'the line protocol of evaluator.py (default: the '
+                            'domain\'s own evaluator).'))
   parser.add_argument('--use-lexicon', action='store_true',
                       help='Use a lexicon for copying (should also supply --domain)')
   parser.add_argument('--augment', '-a',
@@ -137,25 +197,64 @@ def _parse_args():
   parser.add_argument('--general-grammar', help='Path to grammar for general.')
   parser.add_argument('--train-data', help='Path to training data.')
   parser.add_argument('--dev-data', help='Path to dev data.')
+  parser.add_argument('--data-cache-dir',
+                      help='Directory to cache preprocessed train/dev data in (default is no caching).')
   parser.add_argument('--dev-frac', type=float, default=0.0,
                       help='Take this fraction of train data as dev data.')
   parser.add_argument('--dev-seed', type=int, default=0,
                       help='RNG seed for the train/dev splits (default = 0)')
+  parser.add_argument('--num-shards', type=int, default=1,
+                      help='Split the training data into this many shards by line index (default = 1)')
+  parser.add_argument('--shard-index', type=int, default=0,
+                      help='Which shard of the training data this process reads (default = 0)')
   parser.add_argument('--model-seed', type=int, default=0,
                       help="RNG seed for the model's initialization and SGD ordering (default = 0)")
   parser.add_argument('--save-file', help='Path to save parameters.')
   parser.add_argument('--load-file', help='Path to load parameters, will ignore other passed arguments.')
+  parser.add_argument('--checkpoint-file',
+                      help='Path to write training checkpoints to (see trainstate.py).')
+  parser.add_argument('--checkpoint-every-examples', type=int, default=0,
+                      help='Write a checkpoint every this many examples (default = 0, never).')
+  parser.add_argument('--checkpoint-every-epochs', type=int, default=1,
+                      help='Write a checkpoint every this many epochs (default = 1).')
+  parser.add_argument('--resume', action='store_true',
+                      help='Resume training from --checkpoint-file.')
+  parser.add_argument('--export-numpy-file',
+                      help='Path to export parameters for the NumPy runtime (see numpyinference.py).')
   parser.add_argument('--stats-file', help='Path to save statistics (JSON format).')
+  parser.add_argument('--results-file',
+                      help='Path to save per-example evaluation results (JSON lines).')
+  parser.add_argument('--verbose-eval', action='store_true',
+                      help='Print per-example evaluation results and executed LFs.')
   parser.add_argument('--shell', action='store_true',
                       help='Start an interactive shell.')
   parser.add_argument('--server', action='store_true',
-                      help='Start an interactive web console (requires bottle).')
+                      help='Start a JSON prediction server.')
   parser.add_argument('--hostname', default='127.0.0.1', help='server hostname')
   parser.add_argument('--port', default=9001, type=int, help='server port')
+  parser.add_argument('--server-max-batch-size', type=int, default=16,
+                      help='Most queries the server decodes together (default = 16).')
+  parser.add_argument('--server-max-wait-ms', type=float, default=5.0,
+                      help='How long the server waits to fill a batch (default = 5).')
+  parser.add_argument('--server-workers', type=int, default=1,
+                      help='Number of server processes to fork (default = 1).')
+  parser.add_argument('--mmap-params',
+                      help='Checkpoint file that the server memory-maps parameters from, '
+                      'so that its workers share them; written first if needed.')
+  parser.add_argument('--server-top-k', type=int, default=10,
+                      help='Number of derivations the server returns per query (default = 10).')
+  parser.add_argument('--prediction-cache-size', type=int, default=10000,
+                      help='Most utterances whose predictions the server caches, 0 to disable (default = 10000).')
+  parser.add_argument('--prediction-cache-ttl', type=float, default=3600,
+                      help='Seconds before a cached prediction expires, 0 for never (default = 3600).')
   parser.add_argument('--theano-fast-compile', action='store_true',
                       help='Run Theano in fast compile mode.')
   parser.add_argument('--theano-profile', action='store_true',
-                      help='Turn on profiling in Theano.')
+                      help='Turn on profiling in Theano, and add the time per op class to the --stats-file.')
+  parser.add_argument('--profile-decoding', action='store_true',
+                      help='Time the phases of decoding and the ontology methods (see decodeprofile.py).')
+  parser.add_argument('--record-legality-trace',
+                      help='Path to record the legality queries made while decoding to (see legalitytrace.py).')
   parser.add_argument('--use-geoontology', '-usegeo', default=False,
                       help='use geo ontology for decoding.')
   parser.add_argument('--use-generalontology', '-usegen', default=False,
@@ -187,6 +286,12 @@ def _parse_args():
     print >> sys.stderr, 'Error: output_vocab_type must be in %s' % (
         ', '.join(VOCAB_TYPES))
     sys.exit(1)
+  if not 0 <= OPTIONS.shard_index < OPTIONS.num_shards:
+    print >> sys.stderr, 'Error: --shard-index must be in [0, --num-shards)'
+    sys.exit(1)
+  if OPTIONS.resume and not OPTIONS.checkpoint_file:
+    print >> sys.stderr, 'Error: --resume needs --checkpoint-file'
+    sys.exit(1)
   use_domain_ontology_count = 0
   if OPTIONS.use_geoontology:
       use_domain_ontology_count += 1
@@ -207,13 +312,9 @@ def configure_theano():
   if OPTIONS.theano_profile:
     theano.config.profile = True
 
-def load_dataset(filename, domain):
-  dataset = []
-  with open(filename) as f:
-    for line in f:
-      x, y = line.strip().split('\t')
-      dataset.append((x, y))
-  return dataset
+def load_dataset(filename, domain, dev_frac=0.0):
+  """Get a stream over the (x, y) records of a TSV file."""
+  return TsvDataset(filename, dev_frac=dev_frac, dev_seed=OPTIONS.dev_seed)
 
 def load_databases(filename, domain):
   databases = []
@@ -223,7 +324,7 @@ def load_databases(filename, domain):
   return databases
 
 def get_input_vocabulary(dataset):
-  sentences = [x[0] for x in dataset]
+  sentences = (x[0] for x in dataset)
   constructor = VOCAB_TYPES[OPTIONS.input_vocab_type]
   if OPTIONS.float32:
     return constructor(sentences, OPTIONS.input_embedding_dim,
@@ -272,19 +373,27 @@ def preprocess_data(domain_convertor, domain_controller, general_controller, mod
   out_vocabulary = model.out_vocabulary
   lexicon = model.lexicon
 
-  data = []
-  for raw_ex in raw:
-    x_str, y_str = raw_ex
-    y_str_lf = ' '.join(domain_convertor(y_str, domain_controller, general_controller))
-    ex = Example(x_str, y_str, y_str_lf, in_vocabulary, out_vocabulary, lexicon,
-                 reverse_input=OPTIONS.reverse_input)
-    data.append(ex)
-  return data
+  def preprocess():
+    data = []
+    for raw_ex in raw:
+      x_str, y_str = raw_ex
+      y_str_lf = ' '.join(domain_convertor(y_str, domain_controller, general_controller))
+      ex = Example(x_str, y_str, y_str_lf, in_vocabulary, out_vocabulary, lexicon,
+                   reverse_input=OPTIONS.reverse_input)
+      data.append(ex)
+    return data
+
+  if not OPTIONS.data_cache_dir:
+    return preprocess()
+  key = datacache.get_key(raw, in_vocabulary, out_vocabulary, lexicon,
+                          [OPTIONS.domain_grammar, OPTIONS.general_grammar],
+                          OPTIONS.domain_convertor, OPTIONS.reverse_input)
+  return datacache.load_or_preprocess(OPTIONS.data_cache_dir, key, preprocess)
 
 def get_spec(in_vocabulary, out_vocabulary, lexicon):
   kwargs = {'rnn_type': OPTIONS.rnn_type, 'step_rule': OPTIONS.step_rule}
   if OPTIONS.copy.startswith('attention'):
-    if OPTIONS.model == 'attention':
+    if issubclass(MODELS[OPTIONS.model], AttentionModel):
       kwargs['attention_copying'] = OPTIONS.copy
     else:
       print >> sys.stderr, "Can't use use attention-based copying without attention model"
@@ -301,113 +410,129 @@ def get_model(spec):
     model = constructor(spec, distract_num=OPTIONS.distract_num)
   return model
 
-def print_accuracy_metrics(name, is_correct_list, tokens_correct_list,
-                           x_len_list, y_len_list, denotation_correct_list):
-  # Overall metrics
-  num_examples = len(is_correct_list)
-  num_correct = sum(is_correct_list)
-  num_tokens_correct = sum(tokens_correct_list)
-  num_tokens = sum(y_len_list)
-  seq_accuracy = float(num_correct) / num_examples
-  token_accuracy = float(num_tokens_correct) / num_tokens
-
-  STATS[name] = {}
+def print_accuracy_metrics(name, metrics):
+  STATS[name] = metrics.to_stats()
 
   # Print sequence-level accuracy
-  STATS[name]['sentence'] = {
-      'correct': num_correct,
-      'total': num_examples,
-      'accuracy': seq_accuracy,
-  }
-  print 'Sequence-level accuracy: %d/%d = %g' % (num_correct, num_examples, seq_accuracy)
+  print 'Sequence-level accuracy: %d/%d = %g' % (
+      metrics.sentence.correct, metrics.sentence.total,
+      metrics.sentence.get_accuracy())
 
   # Print token-level accuracy
-  STATS[name]['token'] = {
-      'correct': num_tokens_correct,
-      'total': num_tokens,
-      'accuracy': token_accuracy,
-  }
-  print 'Token-level accuracy: %d/%d = %g' % (num_tokens_correct, num_tokens, token_accuracy)
+  print 'Token-level accuracy: %d/%d = %g' % (
+      metrics.token.correct, metrics.token.total, metrics.token.get_accuracy())
 
   # Print denotation-level accuracy
-  if denotation_correct_list:
-    denotation_correct = sum(denotation_correct_list)
-    denotation_accuracy = float(denotation_correct)/num_examples
-    STATS[name]['denotation'] = {
-        'correct': denotation_correct,
-        'total': num_examples,
-        'accuracy': denotation_accuracy
-    }
-    print 'Denotation-level accuracy: %d/%d = %g' % (denotation_correct, num_examples, denotation_accuracy)
+  if metrics.denotation is not None:
+    print 'Denotation-level accuracy: %d/%d = %g' % (
+        metrics.denotation.correct, metrics.denotation.total,
+        metrics.denotation.get_accuracy())
+
+def get_decode_limits():
+  """Keyword arguments bounding the time and steps spent per example."""
+  return {
+      'time_limit': OPTIONS.decode_time_limit_ms / 1000.0 if OPTIONS.decode_time_limit_ms else None,
+      'step_limit': OPTIONS.decode_step_limit or None,
+  }
 
 def decode(model, ex, domain_convertor, domain_controller, general_controller):
   if OPTIONS.beam_size == 0:
-    return model.decode_greedy(OPTIONS.domain, ex, domain_convertor, domain_controller, general_controller, max_len=100)
+    derivs = model.decode_greedy(OPTIONS.domain, ex, domain_convertor, domain_controller, general_controller, max_len=100,
+                                 **get_decode_limits())
   else:
-    return model.decode_beam(OPTIONS.domain, ex, domain_convertor, domain_controller, general_controller, beam_size=OPTIONS.beam_size)
+    derivs = model.decode_beam(OPTIONS.domain, ex, domain_convertor, domain_controller, general_controller, beam_size=OPTIONS.beam_size,
+                               state_convertor=STATE_CONVERTORS.get(OPTIONS.domain_convertor),
+                               **get_decode_limits())
+  return derivs
 
 def evaluate(name, model, domain_convertor, domain_controller, general_controller, dataset, domain=None):
-  """Evaluate the model. """
-  in_vocabulary = model.in_vocabulary
-  out_vocabulary = model.out_vocabulary
-
-  is_correct_list = []
-  tokens_correct_list = []
-  x_len_list = []
-  y_len_list = []
+  """Evaluate the model.
 
+  Metrics are accumulated as examples are scored.  Per-example results are
+  written to the --results-file, and printed only with --verbose-eval.
+  """
+  cache = None
   if domain:
     all_derivs = [decode(model, ex, domain_convertor, domain_controller, general_controller) for ex in dataset]
     true_answers = [ex.y_str for ex in dataset]
     true_answers_lf = [ex.y_str_lf for ex in dataset]
+    cache = getattr(domain, 'denotation_cache', None)
+    if cache is not None:
+      cache_stats = cache.get_stats()
     derivs, denotation_correct_list = domain.compare_answers(true_answers, true_answers_lf, all_derivs)
   else:
     derivs = [decode(model, ex, domain_convertor, domain_controller, general_controller)[0] for ex in dataset]
     denotation_correct_list = None
 
-  print('all_derivs size: ', len(all_derivs))
-  print('derivs size: ', len(derivs))
-  print('denotation_correct_list: ', len(denotation_correct_list))
-  print('dataset size: ', len(dataset))
-
+  metrics = evalresults.EvaluationMetrics()
   for i, ex in enumerate(dataset):
-    print 'Example %d' % i
-    print '  x         = "%s"' % ex.x_str
-    print '  y         = "%s"' % ex.y_str
-    if derivs[i] == None:
-        y_pred_toks = []
-        y_pred_str = ''
-        y_pred_str_lf = ''
-        y_copy_entity_list = []
-        p_list = []
+    if derivs[i] is None:
+      y_pred_toks = []
+      y_pred_str_lf = ''
+      y_copy_entity_list = []
+      p_list = []
+      truncated = False
     else:
-        y_pred_toks = derivs[i].y_toks
-        y_pred_str = ' '.join(y_pred_toks)
-        y_pred_toks_lf = derivs[i].y_toks_lf
-        y_pred_str_lf = ' '.join(y_pred_toks_lf)
-        y_copy_entity_list = derivs[i].copy_entity_list
-        p_list = derivs[i].p_list
+      y_pred_toks = derivs[i].y_toks
+      y_pred_str_lf = ' '.join(derivs[i].y_toks_lf)
+      y_copy_entity_list = derivs[i].copy_entity_list
+      p_list = derivs[i].p_list or []
+      truncated = derivs[i].truncated
+    y_pred_str = ' '.join(y_pred_toks)
 
     # Compute accuracy metrics
     is_correct = (y_pred_str == ex.y_str)
     tokens_correct = sum(a == b for a, b in zip(y_pred_toks, ex.y_toks))
-    is_correct_list.append(is_correct)
-    tokens_correct_list.append(tokens_correct)
-    x_len_list.append(len(ex.x_toks))
-    y_len_list.append(len(ex.y_toks))
-    print('copy entity list: ', y_copy_entity_list)
-    print('  y_pred (len = %s)    = "%s"' % (str(len(y_pred_str.split(' '))), y_pred_str))
-    print('  p_list (len = %s)    = ' % (str(len(p_list))) , p_list)
-    print('  y_lf      = "%s"' % ex.y_str_lf)
-    print('  y_pred_lf = "%s"' % y_pred_str_lf)
-    print('  sequence correct = %s' % is_correct)
-    print('  token accuracy = %d/%d = %g' % (
-        tokens_correct, len(ex.y_toks), float(tokens_correct) / len(ex.y_toks)))
-    if denotation_correct_list:
+    denotation_correct = None
+    if denotation_correct_list is not None:
       denotation_correct = denotation_correct_list[i]
-      print('  denotation correct = %s' % denotation_correct)
-  print_accuracy_metrics(name, is_correct_list, tokens_correct_list,
-                         x_len_list, y_len_list, denotation_correct_list)
+    metrics.add(is_correct, tokens_correct, len(ex.y_toks), denotation_correct)
+
+    if RESULTS_WRITER:
+      RESULTS_WRITER.write({
+          'split': name,
+          'index': i,
+          'x': ex.x_str,
+          'y': ex.y_str,
+          'y_pred': y_pred_str,
+          'y_lf': ex.y_str_lf,
+          'y_pred_lf': y_pred_str_lf,
+          'copy_entity_list': y_copy_entity_list,
+          'p_list': [float(p) for p in p_list],
+          'sequence_correct': is_correct,
+          'tokens_correct': int(tokens_correct),
+          'num_tokens': len(ex.y_toks),
+          'denotation_correct': denotation_correct,
+          'truncated': truncated,
+      })
+    if OPTIONS.verbose_eval:
+      print 'Example %d' % i
+      print '  x         = "%s"' % ex.x_str
+      print '  y         = "%s"' % ex.y_str
+      print('copy entity list: ', y_copy_entity_list)
+      print('  y_pred (len = %s)    = "%s"' % (str(len(y_pred_str.split(' '))), y_pred_str))
+      print('  p_list (len = %s)    = ' % (str(len(p_list))) , p_list)
+      print('  y_lf      = "%s"' % ex.y_str_lf)
+      print('  y_pred_lf = "%s"' % y_pred_str_lf)
+      print('  sequence correct = %s' % is_correct)
+      print('  token accuracy = %d/%d = %g' % (
+          tokens_correct, len(ex.y_toks), float(tokens_correct) / len(ex.y_toks)))
+      if denotation_correct is not None:
+        print('  denotation correct = %s' % denotation_correct)
+  if RESULTS_WRITER:
+    RESULTS_WRITER.flush()
+  print_accuracy_metrics(name, metrics)
+  if cache is not None:
+    hits = cache.hits - cache_stats['hits']
+    misses = cache.misses - cache_stats['misses']
+    if hits + misses > 0:
+      STATS[name]['denotation_cache'] = {
+          'hits': hits,
+          'misses': misses,
+          'hit_rate': float(hits) / (hits + misses),
+          'size': len(cache),
+      }
+      print 'Denotation cache hits: %d/%d' % (hits, hits + misses)
 
 def run_shell(model):
   print('==== Neural Network Semantic Parsing REPL ====')
@@ -425,87 +550,69 @@ def run_shell(model):
       print('  [p=%f] %s' % (prob, y_str))
     print('')
 
-def make_heatmap(x_str, y_str, attention_list, copy_list):
-  """Make an HTML heatmap of attention."""
-  def css_color(r, g, b):
-    """r, g, b are in 0-1, make """
-    r2 = int(r * 255)
-    g2 = int(g * 255)
-    b2 = int(b * 255)
-    return 'rgb(%d,%d,%d)' % (r2, g2, b2)
-
-  x_toks = [cgi.escape(w) for w in x_str.split(' ')] + ['EOS']
-  if y_str == '':
-    y_toks = ['EOS']
-  else:
-    y_toks = [cgi.escape(w) for w in y_str.split(' ')] + ['EOS']
-  lines = ['<table>', '<tr>', '<td/>']
-  for w in y_toks:
-    lines.append('<td>%s</td>' % w)
-  lines.append('</tr>')
-  for i, w in enumerate(x_toks):
-    lines.append('<tr>')
-    lines.append('<td>%s</td>' % w)
-    for j in range(len(y_toks)):
-      do_copy = copy_list[j]
-      if do_copy:
-        color = css_color(1 - attention_list[j][i], 1 - attention_list[j][i], 1)
-      else:
-        color = css_color(1, 1 - attention_list[j][i], 1 - attention_list[j][i])
-      lines.append('<td/ style="background-color: %s">' % color)
-    lines.append('</tr>')
-  lines.append('</table>')
-  return '\n'.join(lines)
-
-def run_server(model, hostname='127.0.0.1', port=9001):
-  import bottle
-  print '==== Neural Network Semantic Parsing Server ===='
-
-  app = bottle.Bottle()
-
-  @app.route('/debug')
-  def debug():
-    content = make_heatmap(
-        'what states border texas',
-        'answer ( A , ( state ( A ) , next_to ( A , B ) , const ( B , stateid ( texas ) ) ) )',
-        [[0.0, 0.25, 0.5, 0.75, 1.0]] * 29)
-    return bottle.template('main', prompt='Enter a new query', content=content)
-
-  @app.route('/post_query')
-  def post_query():
-    query = bottle.request.params.get('query')
-    print 'Received query: "%s"' % query
-    example = Example(query, '', model.in_vocabulary, model.out_vocabulary,
-                      model.lexicon, reverse_input=OPTIONS.reverse_input)
-    preds = decode(model, example)
-    lines = ['<b>Query: "%s"</b>' % query, '<ul>']
-    for i, deriv in enumerate(preds[:10]):
-      y_str = ' '.join(deriv.y_toks)
-      lines.append('<li> %d. [p=%f] %s' % (i, deriv.p, y_str))
-      lines.append(make_heatmap(query, y_str, deriv.attention_list, deriv.copy_list))
-    lines.append('</ul>')
-
-    content = '\n'.join(lines)
-    return bottle.template('main', prompt='Enter a new query', content=content)
-
-  @app.route('/')
-  def index():
-    return bottle.template('main', prompt='Enter a query', content='')
+def make_examples(model, queries):
+  return [Example(predictioncache.normalize_utterance(query), '', '',
+                  model.in_vocabulary, model.out_vocabulary,
+                  model.lexicon, reverse_input=OPTIONS.reverse_input)
+          for query in queries]
 
-  bottle.run(app, host=hostname, port=port)
+def get_prediction_cache(model):
+  """Cache predictions for the current spec and decoding settings."""
+  if OPTIONS.prediction_cache_size <= 0:
+    return None
+  current = {'spec': None, 'hash': None}
+  def get_context():
+    # Hash the parameters again only when another spec was loaded.
+    if model.spec is not current['spec']:
+      current['spec'] = model.spec
+      current['hash'] = predictioncache.get_spec_hash(model.spec)
+    return (current['hash'], OPTIONS.beam_size, OPTIONS.server_top_k)
+  return predictioncache.PredictionCache(
+      OPTIONS.prediction_cache_size, OPTIONS.prediction_cache_ttl,
+      context_fn=get_context)
+
+def run_server(model, domain_convertor, domain_controller, general_controller,
+               hostname='127.0.0.1', port=9001):
+  """Serve predictions, decoding the queries of a micro-batch together.
+
+  Only greedy decoding (beam size 0) is batched: with beam search, each
+  query of a batch is still decoded on its own.
+  """
+  print '==== Neural Network Semantic Parsing Server ===='
+  def predict_batch(queries):
+    examples = make_examples(model, queries)
+    if OPTIONS.beam_size == 0:
+      all_derivs = model.decode_greedy_batch(
+          OPTIONS.domain, examples, domain_convertor, domain_controller,
+          general_controller, max_len=100, **get_decode_limits())
+    else:
+      all_derivs = [decode(model, ex, domain_convertor, domain_controller, general_controller)
+                    for ex in examples]
+    return [[server.derivation_to_json(deriv) for deriv in derivs[:OPTIONS.server_top_k]]
+            for derivs in all_derivs]
+  if OPTIONS.mmap_params:
+    print >> sys.stderr, 'Memory-mapping parameters from %s' % OPTIONS.mmap_params
+    checkpoint.save_and_map_params(model.spec, OPTIONS.mmap_params)
+  if OPTIONS.server_workers > 1:
+    # Compile before forking, so that workers share the compiled functions.
+    model.setup_batch_decoder()
+  print 'Serving on http://%s:%d (POST /predict, GET /stats)' % (hostname, port)
+  server.run_server(predict_batch, hostname=hostname, port=port,
+                    max_batch_size=OPTIONS.server_max_batch_size,
+                    max_wait=OPTIONS.server_max_wait_ms / 1000.0,
+                    make_cache=lambda: get_prediction_cache(model),
+                    num_workers=OPTIONS.server_workers)
 
 def load_raw_all(domain=None):
   # Load train, and dev too if dev-frac was provided
-  random.seed(OPTIONS.dev_seed)
   if OPTIONS.train_data:
-    train_raw = load_dataset(OPTIONS.train_data, domain=domain)
+    train_raw = load_dataset(OPTIONS.train_data, domain=domain,
+                             dev_frac=OPTIONS.dev_frac)
     if OPTIONS.dev_frac > 0.0:
-      num_dev = int(round(len(train_raw) * OPTIONS.dev_frac))
-      random.shuffle(train_raw)
-      dev_raw = train_raw[:num_dev]
-      train_raw = train_raw[num_dev:]
-      print >> sys.stderr, 'Split dataset into %d train, %d dev examples' % (
-          len(train_raw), len(dev_raw))
+      # Each record goes to dev based on its hash (seeded by dev_seed)
+      train_raw, dev_raw = train_raw.split_train_dev()
+      print >> sys.stderr, 'Splitting dataset by hash, %g of examples to dev' % (
+          OPTIONS.dev_frac)
     else:
       dev_raw = None
   else:
@@ -514,7 +621,7 @@ def load_raw_all(domain=None):
 
   # Load dev data from separate file
   if OPTIONS.dev_data:
-    if dev_raw:
+    if dev_raw is not None:
       # Overwrite dev frac from before, if it existed
       print >> sys.stderr, 'WARNING: Replacing dev-frac dev data with dev-data'
     dev_raw = load_dataset(OPTIONS.dev_data, domain=domain)
@@ -524,7 +631,7 @@ def load_raw_all(domain=None):
 def get_augmenter(train_raw, domain):
   if OPTIONS.augment:
     aug_types = OPTIONS.augment.split('+')
-    augmenter = Augmenter(domain, train_raw, aug_types)
+    augmenter = Augmenter(domain, list(train_raw), aug_types)
     return augmenter
   else:
     return None
@@ -540,7 +647,10 @@ def get_lexicon():
   return None
 
 def init_spec(train_raw, domain, databases):
-  if OPTIONS.load_file:
+  if OPTIONS.resume:
+    print >> sys.stderr, 'Loading checkpoint from %s' % OPTIONS.checkpoint_file
+    spec = specutil.load(OPTIONS.checkpoint_file)
+  elif OPTIONS.load_file:
     print >> sys.stderr, 'Loading saved params from %s' % OPTIONS.load_file
     spec = specutil.load(OPTIONS.load_file)
   elif OPTIONS.train_data:
@@ -573,10 +683,26 @@ def write_stats():
     out.close()
 
 def run():
+  global RESULTS_WRITER, TRACE_RECORDER
   configure_theano()
+  if OPTIONS.results_file:
+    RESULTS_WRITER = evalresults.ResultsWriter(OPTIONS.results_file)
   domain = None
   if OPTIONS.domain:
     domain = domains.new(OPTIONS.domain)
+    domain.execute_all_derivations = OPTIONS.execute_all_derivations
+    domain.verbose = OPTIONS.verbose_eval
+    if OPTIONS.denotation_cache_size > 0:
+      domain.set_denotation_cache(evaluator.DenotationCache(
+          OPTIONS.denotation_cache_size, filename=OPTIONS.denotation_cache_file))
+    if OPTIONS.evaluator_worker:
+      domain.set_evaluator(evaluator.get_worker(shlex.split(OPTIONS.evaluator_worker)))
+    elif OPTIONS.local_evaluator:
+      local_evaluator = domain.new_local_evaluator()
+      if local_evaluator is None:
+        print >> sys.stderr, 'Domain %s has no in-process executor' % OPTIONS.domain
+        sys.exit(1)
+      domain.set_evaluator(local_evaluator)
   train_raw, dev_raw = load_raw_all(domain=domain)
   databases = load_databases(OPTIONS.domain_grammar, domain=domain)
   random.seed(OPTIONS.model_seed)
@@ -591,39 +717,80 @@ def run():
   domain_controller = constructor2(OPTIONS.domain_grammar, use_domain_ontology)
   constructor3 = CONVERTORS[OPTIONS.domain_convertor]
   domain_convertor = constructor3
-
-
-
-  if train_raw:
-    train_data = preprocess_data(domain_convertor, domain_controller, general_controller, model, train_raw)
+  if OPTIONS.convertor_cache_size > 0:
+    domain_convertor = convertorcache.MemoizedConvertor(
+        domain_convertor, OPTIONS.convertor_cache_size)
+  if OPTIONS.profile_decoding:
+    model.profiler = decodeprofile.DecodeProfiler()
+    model.profiler.instrument(general_controller, 'general')
+    model.profiler.instrument(domain_controller, 'domain')
+  if OPTIONS.record_legality_trace:
+    TRACE_RECORDER = legalitytrace.TraceRecorder(OPTIONS.record_legality_trace)
+    TRACE_RECORDER.instrument(general_controller, 'general', OPTIONS.general_grammar)
+    TRACE_RECORDER.instrument(domain_controller, 'domain', OPTIONS.domain_grammar)
+    model.trace_recorder = TRACE_RECORDER
+
+
+
+  if train_raw is not None:
+    # The vocabulary and the augmenter see every shard; only the examples
+    # trained on are sharded.
+    train_shard = train_raw.get_shard(OPTIONS.shard_index, OPTIONS.num_shards)
+    train_data = preprocess_data(domain_convertor, domain_controller, general_controller, model, train_shard)
     random.seed(OPTIONS.model_seed)
     dev_data = None
-    if dev_raw:
+    if dev_raw is not None:
       dev_data = preprocess_data(domain_convertor, domain_controller, general_controller, model, dev_raw)
     augmenter = get_augmenter(train_raw, domain)
+    checkpointer = None
+    if OPTIONS.checkpoint_file:
+      checkpointer = trainstate.TrainingCheckpointer(
+          OPTIONS.checkpoint_file, every_examples=OPTIONS.checkpoint_every_examples,
+          every_epochs=OPTIONS.checkpoint_every_epochs)
+    resume_state = None
+    if OPTIONS.resume:
+      resume_state = trainstate.load(OPTIONS.checkpoint_file)
     model.train(train_data, T=OPTIONS.num_epochs, eta=OPTIONS.learning_rate,
                 dev_data=dev_data, l2_reg=OPTIONS.lambda_reg,
                 distract_prob=OPTIONS.distract_prob,
                 distract_num=OPTIONS.distract_num,
                 concat_prob=OPTIONS.concat_prob, concat_num=OPTIONS.concat_num,
-                augmenter=augmenter, aug_frac=OPTIONS.aug_frac)
+                augmenter=augmenter, aug_frac=OPTIONS.aug_frac,
+                checkpointer=checkpointer, resume_state=resume_state)
 
   if OPTIONS.save_file:
     print >> sys.stderr, 'Saving parameters...'
     spec.save(OPTIONS.save_file)
+  if OPTIONS.export_numpy_file:
+    print >> sys.stderr, 'Exporting parameters for NumPy...'
+    numpyinference.export_spec(spec, OPTIONS.export_numpy_file)
 
   evaluate_train_flag = False
-  if train_raw and evaluate_train_flag:
+  if train_raw is not None and evaluate_train_flag:
     evaluate_train(model, domain_convertor, domain_controller, general_controller, train_data, domain=domain)
-  if dev_raw:
+  if dev_raw is not None:
     evaluate_dev(model, domain_convertor, domain_controller, general_controller, dev_raw, domain=domain)
 
+  if isinstance(domain_convertor, convertorcache.MemoizedConvertor):
+    STATS['convertor_cache'] = domain_convertor.get_stats()
+  if model.profiler is not None:
+    STATS['decode_profile'] = model.profiler.to_stats()
+  if OPTIONS.theano_profile:
+    STATS['theano_profile'] = theanoprofile.get_stats(model)
   write_stats()
+  if RESULTS_WRITER:
+    RESULTS_WRITER.close()
+  if TRACE_RECORDER:
+    print >> sys.stderr, 'Recorded %d legality queries to %s' % (
+        TRACE_RECORDER.num_calls, OPTIONS.record_legality_trace)
+    TRACE_RECORDER.close()
+    model.trace_recorder = None
 
   if OPTIONS.shell:
     run_shell(model)
   elif OPTIONS.server:
-    run_server(model, hostname=OPTIONS.hostname, port=OPTIONS.port)
+    run_server(model, domain_convertor, domain_controller, general_controller,
+               hostname=OPTIONS.hostname, port=OPTIONS.port)
 
 def main():
   _parse_args()
@@ -0,0 +1,298 @@
+"""End-to-end benchmark of setting up, decoding with and training a model.
+
+Builds a small randomly initialized AttentionModel for each domain, with
+the real output vocabulary (read from the domain grammar) and controllers,
+and measures:
+  - setup: seconds to build the spec and to compile the model;
+  - encode: latency of _encode, in milliseconds;
+  - decode: examples/sec of greedy decoding and of beam search for each
+    beam size, and how many decodes raised, did not reach an end action
+    (random models often do not) or could not be rendered as a logical
+    form;
+  - train: examples/sec of SGD steps;
+  - peak RSS, in MB.  Each domain runs in a process of its own, forked
+    from one that has only imported the modules, so that its peak is not
+    that of the domains before it; start_rss_mb is the RSS it starts with.
+Nothing is read but the repository's grammars and lexicons: utterances
+are made of phrases of the lexicon, and training targets are random
+action sequences that the controllers accept.  The results are written
+as JSON, e.g.
+    python modelbench.py --domains geoquery atis -o bench.json
+so that runs on different commits can be compared.  Run it on the CPU
+(THEANO_FLAGS=device=cpu) for comparable numbers.
+"""
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import time
+import numpy
+import theano
+
+import checkpoint
+from action_vocabulary import ActionVocabulary
+from attention import AttentionModel
+from convert import GRAMMAR_DIR, setup_atis, setup_geo
+from convertbench import Quiet
+from example import Example
+from geoaction2seq import action2seq as geo_action2seq
+from geoaction2seq import action2seq_from_state as geo_action2seq_from_state
+from atisaction2seq import action2seq as atis_action2seq
+from atisaction2seq import action2seq_from_state as atis_action2seq_from_state
+from vocabulary import Vocabulary
+
+LEXICON_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'lexicon')
+
+# domain -> (domain grammar, lexicon, controller setup, convertor, state convertor)
+DOMAINS = collections.OrderedDict([
+    ('geoquery', ('geo.grammar', 'geo-lexicon-for-copy.txt', setup_geo,
+                  geo_action2seq, geo_action2seq_from_state)),
+    ('atis', ('atis.grammar', 'atis-lexicon-raw.txt', setup_atis,
+              atis_action2seq, atis_action2seq_from_state)),
+])
+
+# Random action sequences to try per training example
+MAX_SAMPLE_TRIES = 20
+
+def read_phrases(filename):
+  """The phrases of a lexicon file (phrase :- NP : entity)."""
+  phrases = []
+  with open(filename) as f:
+    for line in f:
+      if ':-' in line:
+        phrase = ' '.join(line.split(':-')[0].split())
+        if phrase:
+          phrases.append(phrase)
+  return phrases
+
+def make_utterances(phrases, num, length, rng):
+  """Make num utterances of about length words out of lexicon phrases."""
+  utterances = []
+  for _ in range(num):
+    words = []
+    while len(words) < length:
+      words.extend(rng.choice(phrases).split(' '))
+    utterances.append(' '.join(words[:length]))
+  return utterances
+
+def sample_action_seq(domain, out_vocabulary, domain_controller, general_controller, rng, max_len=40):
+  """A random action sequence that the controllers accept, or None.
+
+  Each step picks an action type (add_type_node, add_edge, ...) among
+  those with a legal action, then one of its legal actions, so that the
+  many entities do not crowd out the rest.
+  """
+  action_all = out_vocabulary.get_action_list()
+  pre_action_class = 'start'
+  pre_arg_list = []
+  pre_action = ''
+  fun_trace_list = []
+  state = [{}, {}, {}, {}, {}, {}, {}]
+  actions = []
+  for _ in range(max_len):
+    args = [pre_action_class, pre_arg_list, pre_action] + state + [fun_trace_list, action_all]
+    legal_gen = general_controller.get_legal_action_list(*args)
+    legal_dom = domain_controller.get_legal_action_list(*args)
+    by_type = collections.defaultdict(list)
+    for i, (g, d) in enumerate(zip(legal_gen, legal_dom)):
+      if g and d:
+        by_type[action_all[i].split(':-:')[0]].append(i)
+    if not by_type:
+      return None
+    y = rng.choice(by_type[rng.choice(sorted(by_type))])
+    action = action_all[y]
+    actions.append(action)
+    _, pre_action_class, pre_arg_list, pre_action, fun_trace_list = \
+        general_controller.is_legal_action_then_read(
+            pre_action_class, pre_arg_list, action, pre_action, *(state + [fun_trace_list]))
+    if out_vocabulary.action_is_end(domain, y):
+      return actions
+  return None
+
+def get_stats(seconds):
+  """Summary of a list of latencies, in milliseconds."""
+  ms = numpy.array(seconds) * 1000.0
+  return {'mean_ms': float(numpy.mean(ms)), 'median_ms': float(numpy.median(ms)),
+          'p90_ms': float(numpy.percentile(ms, 90)), 'num': len(ms)}
+
+def get_rate(num, seconds):
+  return {'examples_per_sec': num / max(seconds, 1e-9), 'seconds': seconds, 'num': num}
+
+def get_peak_rss_mb():
+  # ru_maxrss is in kilobytes on Linux
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def time_decodes(examples, decode_fn, end_actions):
+  """Time decode_fn on each example, counting the decodes that went wrong.
+
+  The benchmark measures throughput, so a decode that raises is counted
+  rather than stopping the run.
+  """
+  counts = collections.Counter()
+  t0 = time.time()
+  for ex in examples:
+    try:
+      derivs = decode_fn(ex)
+    except Exception:
+      counts['failed'] += 1
+      continue
+    if not derivs or not derivs[0].y_toks or derivs[0].y_toks[-1] not in end_actions:
+      counts['unterminated'] += 1
+    elif not derivs[0].y_toks_lf:
+      counts['unrendered'] += 1
+  results = get_rate(len(examples), time.time() - t0)
+  for key in ('failed', 'unterminated', 'unrendered'):
+    results[key] = counts[key]
+  return results
+
+def run_domain(domain, args):
+  grammar, lexicon_file, setup, convertor, state_convertor = DOMAINS[domain]
+  rng = random.Random(args.seed)
+  numpy.random.seed(args.seed)
+  results = {'domain': domain, 'start_rss_mb': get_peak_rss_mb()}
+  float_type = numpy.float32 if args.float32 else numpy.float64
+
+  # Setup: vocabularies and spec, then compiling the model
+  t0 = time.time()
+  with Quiet():
+    domain_controller, general_controller = setup(args.grammar_dir)
+  with open(os.path.join(args.grammar_dir, grammar)) as f:
+    databases = f.readlines()
+  phrases = read_phrases(os.path.join(LEXICON_DIR, lexicon_file))
+  utterances = make_utterances(phrases, max(args.num_decode, args.num_train),
+                               args.utterance_length, rng)
+  t1 = time.time()
+  with Quiet():
+    in_vocabulary = Vocabulary.from_sentences(utterances, args.input_embedding_dim,
+                                              float_type=float_type)
+    out_vocabulary = ActionVocabulary.from_databases(
+        domain, databases, args.output_embedding_dim, args.output_embedding_dim,
+        float_type=float_type)
+  spec = AttentionModel.get_spec_class()(
+      in_vocabulary, out_vocabulary, None, args.hidden_size,
+      rnn_type=args.rnn_type, step_rule=args.step_rule)
+  t2 = time.time()
+  model = AttentionModel(spec, float_type=float_type)
+  t3 = time.time()
+  results['setup'] = {'controllers_seconds': t1 - t0, 'spec_seconds': t2 - t1,
+                      'compile_seconds': t3 - t2}
+  results['vocabulary'] = {'input_size': in_vocabulary.size(),
+                           'output_size': out_vocabulary.size(),
+                           'output_all_size': out_vocabulary.all_size()}
+
+  # Decoding (of utterances with no target)
+  examples = [Example(x, '', '', in_vocabulary, out_vocabulary, None)
+              for x in utterances[:args.num_decode]]
+  latencies = []
+  for ex in examples:
+    t0 = time.time()
+    model._encode(ex.x_inds)
+    latencies.append(time.time() - t0)
+  results['encode'] = get_stats(latencies)
+  results['decode'] = collections.OrderedDict()
+  end_actions = set(action for i, action in enumerate(out_vocabulary.get_action_list())
+                    if out_vocabulary.action_is_end(domain, i))
+  with Quiet():
+    results['decode']['greedy'] = time_decodes(
+        examples, lambda ex: model.decode_greedy(domain, ex, convertor, domain_controller,
+                                                 general_controller, max_len=args.max_len),
+        end_actions)
+    for beam_size in args.beam_sizes:
+      results['decode']['beam_%d' % beam_size] = time_decodes(
+          examples, lambda ex: model.decode_beam(domain, ex, convertor, domain_controller,
+                                                 general_controller, beam_size=beam_size,
+                                                 max_len=args.max_len,
+                                                 state_convertor=state_convertor),
+          end_actions)
+
+  # Training (on random targets that the controllers accept)
+  train_data = []
+  with Quiet():
+    for x in utterances[:args.num_train]:
+      for _ in range(MAX_SAMPLE_TRIES):
+        actions = sample_action_seq(domain, out_vocabulary, domain_controller, general_controller, rng)
+        if actions:
+          train_data.append(Example(x, ' '.join(actions), '', in_vocabulary, out_vocabulary, None))
+          break
+  if train_data:
+    with Quiet():
+      t0 = time.time()
+      for ex in train_data:
+        model.sgd_step(ex, args.learning_rate, 0.0)
+      results['train'] = get_rate(len(train_data), time.time() - t0)
+    results['train']['mean_target_length'] = float(numpy.mean([len(ex.y_inds) for ex in train_data]))
+  results['peak_rss_mb'] = get_peak_rss_mb()
+  return results
+
+def run_domain_in_child(domain, args):
+  """Run run_domain in a forked process, and get its results."""
+  receiver, sender = multiprocessing.Pipe(duplex=False)
+  def run():
+    sender.send(run_domain(domain, args))
+  proc = multiprocessing.Process(target=run)
+  proc.start()
+  sender.close()
+  try:
+    results = receiver.recv()
+  except EOFError:
+    results = None
+  proc.join()
+  if results is None:
+    raise RuntimeError('Benchmarking %s failed (exit code %s)' % (domain, proc.exitcode))
+  return results
+
+def _parse_args():
+  parser = argparse.ArgumentParser(
+      description='Benchmark model setup, encoding, decoding and training.')
+  parser.add_argument('--domains', nargs='+', default=list(DOMAINS), choices=list(DOMAINS))
+  parser.add_argument('--num-decode', type=int, default=20,
+                      help='Number of utterances to encode and decode (default = 20)')
+  parser.add_argument('--num-train', type=int, default=50,
+                      help='Number of SGD steps to time (default = 50)')
+  parser.add_argument('--beam-sizes', type=lambda s: [int(x) for x in s.split(',')],
+                      default=[1, 5, 10], help='Comma-separated beam sizes (default = 1,5,10)')
+  parser.add_argument('--max-len', type=int, default=40,
+                      help='Most actions to decode (default = 40)')
+  parser.add_argument('--utterance-length', type=int, default=10,
+                      help='Words per utterance (default = 10)')
+  parser.add_argument('--hidden-size', type=int, default=64)
+  parser.add_argument('--input-embedding-dim', type=int, default=32)
+  parser.add_argument('--output-embedding-dim', type=int, default=32,
+                      help='Dimension of the output structure and semantic embeddings')
+  parser.add_argument('--rnn-type', default='lstm')
+  parser.add_argument('--step-rule', default='simple')
+  parser.add_argument('--learning-rate', type=float, default=0.1)
+  parser.add_argument('--float32', action='store_true')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--grammar-dir', default=GRAMMAR_DIR,
+                      help='Directory with the .grammar files')
+  parser.add_argument('--output', '-o', help='File to write the JSON results to (default is stdout)')
+  return parser.parse_args()
+
+def main():
+  args = _parse_args()
+  theano.config.mode = 'FAST_RUN'
+  theano.config.linker = 'cvm'
+  results = {
+      'code_version': checkpoint.get_code_version(),
+      'theano_device': theano.config.device,
+      'options': vars(args),
+      'domains': [],
+  }
+  for domain in args.domains:
+    sys.stderr.write('Benchmarking %s...\n' % domain)
+    results['domains'].append(run_domain_in_child(domain, args))
+  out = json.dumps(results, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(out + '\n')
+  else:
+    print(out)
+
+if __name__ == '__main__':
+  main()
@@ -10,12 +10,40 @@ from theano.ifelse import ifelse
 from theano import tensor as T
 import time
 
+import trainstate
 from example import Example
 from vocabulary import Vocabulary
 
 CLIP_THRESH = 3.0  # Clip gradient if norm is larger than this
 NESTEROV_MU = 0.95  # mu for Nesterov momentum
 
+class DecodingBudget(object):
+  """A limit on the time and/or number of decoder steps for one example.
+
+  Decoders check expired() as they go and, once it is True, return the
+  best result they have so far, marked as truncated.
+  """
+  def __init__(self, time_limit=None, step_limit=None, clock=time.time):
+    self.clock = clock
+    self.deadline = clock() + time_limit if time_limit else None
+    self.step_limit = step_limit
+    self.steps = 0
+
+  @classmethod
+  def create(cls, time_limit=None, step_limit=None):
+    """Get a budget, or None if there is no limit."""
+    if not time_limit and not step_limit:
+      return None
+    return cls(time_limit=time_limit, step_limit=step_limit)
+
+  def spend(self, steps=1):
+    self.steps += steps
+
+  def expired(self):
+    if self.step_limit and self.steps >= self.step_limit:
+      return True
+    return self.deadline is not None and self.clock() >= self.deadline
+
 class NeuralModel(object):
   """A generic continuous neural sequence-to-sequence model.
 
@@ -56,6 +84,8 @@ class NeuralModel(object):
               value=numpy.zeros_like(p.get_value()))
           for p in self.params]
     self.all_shared = spec.get_all_shared()
+    self.profiler = None  # A DecodeProfiler, to time decoding
+    self.trace_recorder = None  # A legalitytrace.TraceRecorder, to record legality queries
 
     self.setup()
     print >> sys.stderr, 'Setup complete.'
@@ -84,15 +114,15 @@ class NeuralModel(object):
     print('copy_toks: ', ex.copy_toks)
     #print('x_inds: %s' % ex.x_inds)
     #print('y_inds: %s' % ex.y_inds)
-    #print('y_in_x_inds: %s' % ex.y_in_x_inds)
+    #print('y_in_x_inds: %s' % ex.get_y_in_x_inds())
     if distractors:
       for ex_d in distractors:
         print 'd: %s' % ex_d.x_str
       x_inds_d_all = [ex_d.x_inds for ex_d in distractors]
       info = self._backprop_distract(
-          ex.x_inds, ex.y_inds, eta, ex.y_in_x_inds, l2_reg, *x_inds_d_all)
+          ex.x_inds, ex.y_inds, eta, ex.get_y_in_x_inds(), l2_reg, *x_inds_d_all)
     else:
-      info = self._backprop(ex.x_inds, ex.y_inds, eta, ex.y_in_x_inds, l2_reg)
+      info = self._backprop(ex.x_inds, ex.y_inds, eta, ex.get_y_in_x_inds(), l2_reg)
     p_y_seq = info[0]
     objective = info[1]
     print 'P(y_i): %s' % p_y_seq
@@ -117,25 +147,46 @@ class NeuralModel(object):
 
   def train(self, dataset, eta=0.1, T=[], verbose=False, dev_data=None,
             l2_reg=0.0, distract_num = 0, distract_prob=0.0,
-            concat_num=1, concat_prob=0.0, augmenter=None, aug_frac=0.0):
-    # train with SGD (batch size = 1)
+            concat_num=1, concat_prob=0.0, augmenter=None, aug_frac=0.0,
+            checkpointer=None, resume_state=None):
+    """Train with SGD (batch size = 1).
+
+    checkpointer is an optional trainstate.TrainingCheckpointer, and
+    resume_state a state read by trainstate.load() to continue from.
+    """
     cur_lr = eta
     max_iters = sum(T)
     lr_changes = set([sum(T[:i]) for i in range(1, len(T))])
-    for it in range(max_iters):
+    orig_dataset = list(dataset)
+    ex_ids = dict((id(ex), i) for i, ex in enumerate(orig_dataset))
+    start_it = 0
+    skip_examples = 0
+    total_nll = 0.0
+    if resume_state:
+      start_it = resume_state['epoch']
+      skip_examples = resume_state['example']
+      total_nll = resume_state['total_nll']
+      cur_lr = resume_state['lr']
+      dataset[:] = [orig_dataset[i] for i in resume_state['order']]
+      trainstate.restore(self, resume_state)
+      print >> sys.stderr, 'Resuming at epoch %d, example %d' % (start_it, skip_examples)
+    for it in range(start_it, max_iters):
       t0 = time.time()
+      epoch_state = trainstate.get_epoch_state(
+          it, cur_lr, [ex_ids[id(ex)] for ex in dataset])
       if it in lr_changes:
         # Halve the learning rate
         cur_lr = 0.5 * cur_lr
-      total_nll = 0.0
+      if it > start_it or not skip_examples:
+        total_nll = 0.0
       random.shuffle(dataset)
       cur_dataset = dataset
       if augmenter:
         # Do data augmentation on the fly
         aug_num = int(round(aug_frac * len(dataset)))
         aug_exs = [Example(
-            x, y, dataset[0].input_vocab, dataset[0].output_vocab, 
-            dataset[0].lex, reverse_input=dataset[0].reverse_input)
+            x, y, '', self.in_vocabulary, self.out_vocabulary,
+            self.lexicon, reverse_input=dataset[0].reverse_input)
             for x, y in augmenter.sample(aug_num)]
         cur_dataset = cur_dataset + aug_exs
         random.shuffle(cur_dataset)
@@ -150,26 +201,39 @@ class NeuralModel(object):
               ex.x_str for ex in cur_exs)
           new_y_str = (' ' + Vocabulary.END_OF_SENTENCE + ' ').join(
               ex.y_str for ex in cur_exs)
-          new_ex = Example(new_x_str, new_y_str, dataset[0].input_vocab,
-                           dataset[0].output_vocab, dataset[0].lex,
+          new_ex = Example(new_x_str, new_y_str, '', self.in_vocabulary,
+                           self.out_vocabulary, self.lexicon,
                            reverse_input=dataset[0].reverse_input)
           concat_exs.append(new_ex)
         cur_dataset = concat_exs + normal_exs
         random.shuffle(cur_dataset)
 
-      for ex in cur_dataset:
+      for i, ex in enumerate(cur_dataset):
         do_distract = distract_num > 0 and random.random() < distract_prob
         if do_distract:
           distractors = random.sample(dataset, distract_num)
+        if it == start_it and i < skip_examples:
+          # Trained on before resuming; only the random draws are replayed.
+          continue
+        if do_distract:
           nll = self.sgd_step(ex, cur_lr, l2_reg, distractors=distractors)
         else:
           nll = self.sgd_step(ex, cur_lr, l2_reg)
           total_nll += nll
+        if checkpointer:
+          epoch_state['example'] = i + 1
+          epoch_state['total_nll'] = total_nll
+          checkpointer.on_example(self, epoch_state)
       dev_nll = 0.0
       if dev_data:
         for ex in dev_data:
-          dev_nll += self._get_nll(ex.x_inds, ex.y_inds, ex.y_in_x_inds)
+          dev_nll += self._get_nll(ex.x_inds, ex.y_inds, ex.get_y_in_x_inds())
       #self.on_train_epoch(it)
       t1 = time.time()
       print 'NeuralModel.train(): iter %d (lr = %g): train obj = %g, dev nll = %g (%g seconds)' % (
           it, cur_lr, total_nll, dev_nll, t1 - t0)
+      if checkpointer:
+        checkpointer.on_epoch(self, trainstate.get_epoch_state(
+            it + 1, cur_lr, [ex_ids[id(ex)] for ex in dataset]))
+    if checkpointer:
+      checkpointer.wait()
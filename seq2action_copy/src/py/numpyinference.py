@@ -0,0 +1,262 @@
+"""A NumPy implementation of the test-time functions of AttentionModel.
+
+Decoding only needs three functions, _encode, _decoder_write and
+_decoder_step, but compiling them with theano takes most of the start-up
+time of a server.  NumpyAttentionRuntime computes the same things with
+NumPy from the spec's parameter values:
+  - encode(x_inds) -> (dec_init_state, annotations)
+  - decoder_write(annotations, h_prev) -> (write_dist, c_t, alpha)
+  - decoder_step(y_t, c_prev, h_prev) -> h_t
+for LSTM, GRU and vanilla RNN layers, with or without attention-based
+copying.  NumpyAttentionModel is an AttentionModel that uses them instead
+of compiling anything (--model attention-numpy); it can decode, not train.
+
+The parameters can also be exported to a flat file (an uncompressed .npz
+of named arrays plus a JSON header) and loaded from it, without a spec:
+    python numpyinference.py export spec_file params.npz
+    python numpyinference.py check spec_file [params.npz]
+The second one compiles the theano functions and reports the largest
+difference from the NumPy runtime over random inputs.
+"""
+import json
+import sys
+import time
+import numpy
+
+from attention import AttentionModel
+
+EXPORT_VERSION = 1
+META_KEY = '__meta__'
+
+def get_layer_arrays(prefix, layer):
+  return dict(('%s.%s' % (prefix, p.name), p.get_value()) for p in layer.params)
+
+def export_arrays(spec):
+  """Get the arrays and header describing an AttentionSpec."""
+  arrays = {}
+  for prefix in ('fwd_encoder', 'bwd_encoder', 'decoder'):
+    arrays.update(get_layer_arrays(prefix, getattr(spec, prefix)))
+  arrays['writer.w_out'] = spec.writer.w_out.get_value()
+  arrays['w_enc_to_dec'] = spec.w_enc_to_dec.get_value()
+  arrays['w_attention'] = spec.w_attention.get_value()
+  in_vocab = spec.in_vocabulary
+  arrays['in_vocabulary.emb_mat'] = in_vocab.emb_mat.get_value()
+  out_vocab = spec.out_vocabulary
+  arrays['out_vocabulary.structure_emb_mat'] = out_vocab.structure_emb_mat.get_value()
+  arrays['out_vocabulary.semantic_emb_mat'] = out_vocab.semantic_emb_mat.get_value()
+  arrays['out_vocabulary.index_matrix'] = out_vocab.index_matrix.get_value()
+  meta = {
+      'version': EXPORT_VERSION,
+      'rnn_type': spec.rnn_type,
+      'hidden_size': spec.hidden_size,
+      'attention_copying': bool(spec.attention_copying),
+      # Rows of zeros appended to w_out, one per entity action.
+      'num_constant_rows': spec.writer.ew,
+      # Set for a HashedVocabulary, whose indices pack several buckets.
+      'in_num_buckets': getattr(in_vocab, 'num_buckets', 0),
+      'in_num_hashes': getattr(in_vocab, 'num_hashes', 1),
+  }
+  return arrays, meta
+
+def export_spec(spec, filename):
+  arrays, meta = export_arrays(spec)
+  arrays[META_KEY] = numpy.array(json.dumps(meta, sort_keys=True))
+  with open(filename, 'wb') as f:
+    numpy.savez(f, **arrays)
+
+def sigmoid(x):
+  return 1.0 / (1.0 + numpy.exp(-x))
+
+def softmax(x):
+  e = numpy.exp(x - numpy.max(x))
+  return e / e.sum()
+
+class NumpyAttentionRuntime(object):
+  """The test-time functions of AttentionModel, in NumPy."""
+  def __init__(self, arrays, meta):
+    if meta.get('version') != EXPORT_VERSION:
+      raise ValueError('Unsupported export version %s' % meta.get('version'))
+    self.arrays = arrays
+    self.rnn_type = meta['rnn_type']
+    self.nh = meta['hidden_size']
+    self.attention_copying = meta['attention_copying']
+    self.in_num_buckets = meta['in_num_buckets']
+    self.in_num_hashes = meta['in_num_hashes']
+    self.in_emb_mat = arrays['in_vocabulary.emb_mat']
+    self.structure_emb_mat = arrays['out_vocabulary.structure_emb_mat']
+    self.semantic_emb_mat = arrays['out_vocabulary.semantic_emb_mat']
+    self.index_matrix = arrays['out_vocabulary.index_matrix']
+    self.w_enc_to_dec = arrays['w_enc_to_dec']
+    self.w_attention = arrays['w_attention']
+    w_out = arrays['writer.w_out']
+    self.w_write = numpy.concatenate(
+        [w_out, numpy.zeros((meta['num_constant_rows'], w_out.shape[1]), dtype=w_out.dtype)])
+    self.fwd_encoder = self.get_layer('fwd_encoder')
+    self.bwd_encoder = self.get_layer('bwd_encoder')
+    self.decoder = self.get_layer('decoder')
+
+  @classmethod
+  def from_spec(cls, spec):
+    arrays, meta = export_arrays(spec)
+    return cls(arrays, meta)
+
+  @classmethod
+  def load(cls, filename):
+    with numpy.load(filename) as data:
+      arrays = dict((k, data[k]) for k in data.files)
+    meta = json.loads(str(arrays.pop(META_KEY)))
+    return cls(arrays, meta)
+
+  def get_layer(self, prefix):
+    start = len(prefix) + 1
+    return dict((k[start:], v) for k, v in self.arrays.items()
+                if k.startswith(prefix + '.'))
+
+  def rnn_step(self, layer, x, h_prev):
+    """Same as the step() of LSTMLayer, GRULayer or VanillaRNNLayer."""
+    if self.rnn_type == 'lstm':
+      c_prev, h_prev = h_prev[:self.nh], h_prev[self.nh:]
+      i_t = sigmoid(x.dot(layer['wi']) + h_prev.dot(layer['ui']))
+      f_t = sigmoid(x.dot(layer['wf']) + h_prev.dot(layer['uf']))
+      o_t = sigmoid(x.dot(layer['wo']) + h_prev.dot(layer['uo']))
+      c_tilde_t = numpy.tanh(x.dot(layer['wc']) + h_prev.dot(layer['uc']))
+      c_t = f_t * c_prev + i_t * c_tilde_t
+      h_t = o_t * numpy.tanh(c_t)
+      return numpy.concatenate([c_t, h_t])
+    elif self.rnn_type == 'gru':
+      z_t = sigmoid(x.dot(layer['wz']) + h_prev.dot(layer['uz']))
+      r_t = sigmoid(x.dot(layer['wr']) + h_prev.dot(layer['ur']))
+      h_tilde_t = sigmoid(x.dot(layer['w']) + r_t * h_prev.dot(layer['u']))
+      return z_t * h_prev + (1 - z_t) * h_tilde_t
+    elif self.rnn_type == 'vanillarnn':
+      return sigmoid(h_prev.dot(layer['u_h']) + x.dot(layer['u_x']))
+    raise Exception('Unrecognized rnn_type %s' % self.rnn_type)
+
+  def get_h_for_write(self, h):
+    if self.rnn_type == 'lstm':
+      return h[self.nh:]
+    return h
+
+  def get_input_embedding(self, i):
+    if not self.in_num_buckets:
+      return self.in_emb_mat[i]
+    i = int(i)
+    emb = self.in_emb_mat[i % self.in_num_buckets]
+    for j in range(1, self.in_num_hashes):
+      emb = emb + self.in_emb_mat[(i // (self.in_num_buckets ** j)) % self.in_num_buckets]
+    return emb
+
+  def get_output_embedding(self, i):
+    structure_i, semantic_i = self.index_matrix[i]
+    return numpy.concatenate([self.structure_emb_mat[structure_i],
+                              self.semantic_emb_mat[semantic_i]])
+
+  def encode(self, x_inds):
+    embs = [self.get_input_embedding(i) for i in x_inds]
+    fwd_states = []
+    h = self.fwd_encoder['h0']
+    for x in embs:
+      h = self.rnn_step(self.fwd_encoder, x, h)
+      fwd_states.append(h)
+    bwd_states = []
+    h = self.bwd_encoder['h0']
+    for x in reversed(embs):
+      h = self.rnn_step(self.bwd_encoder, x, h)
+      bwd_states.append(h)
+    enc_last_state = numpy.concatenate([fwd_states[-1], bwd_states[-1]])
+    dec_init_state = numpy.tanh(self.w_enc_to_dec.dot(enc_last_state))
+    annotations = numpy.concatenate(
+        [numpy.array(fwd_states), numpy.array(bwd_states[::-1])], axis=1)
+    return dec_init_state, annotations
+
+  def decoder_write(self, annotations, h_prev):
+    h_for_write = self.get_h_for_write(h_prev)
+    scores = annotations.dot(self.w_attention.T).dot(h_for_write)
+    alpha = softmax(scores)
+    c_t = alpha.dot(annotations)
+    write_scores = self.w_write.dot(numpy.concatenate([h_for_write, c_t]))
+    if self.attention_copying:
+      write_scores = numpy.concatenate([write_scores, scores])
+    return softmax(write_scores), c_t, alpha
+
+  def decoder_step(self, y_t, c_prev, h_prev):
+    input_t = numpy.concatenate([self.get_output_embedding(y_t), c_prev])
+    return self.rnn_step(self.decoder, input_t, h_prev)
+
+class NumpyAttentionModel(AttentionModel):
+  """An AttentionModel that decodes with NumpyAttentionRuntime.
+
+  Nothing is compiled, so it starts quickly, but it cannot be trained.
+  """
+  def setup(self):
+    self.set_runtime(NumpyAttentionRuntime.from_spec(self.spec))
+
+  def set_runtime(self, runtime):
+    self.runtime = runtime
+    self._encode = runtime.encode
+    self._decoder_write = runtime.decoder_write
+    self._decoder_step = runtime.decoder_step
+
+  def setup_batch_decoder(self):
+    pass
+
+  def decode_greedy_batch(self, domain, examples, domain_convertor, domain_controller, general_controller, max_len=100,
+                          time_limit=None, step_limit=None):
+    # NumPy gains nothing from stepping examples together.
+    return [self.decode_greedy(domain, ex, domain_convertor, domain_controller,
+                               general_controller, max_len=max_len,
+                               time_limit=time_limit, step_limit=step_limit)
+            for ex in examples]
+
+  def sgd_step(self, ex, eta, l2_reg, distractors=None):
+    raise NotImplementedError('NumpyAttentionModel can only decode; train with --model attention')
+
+def check_parity(model, runtime, num_inputs=20, max_x_len=15, num_steps=10, seed=0):
+  """Largest absolute difference between theano and NumPy outputs.
+
+  Runs both on random inputs, feeding each decoder its own greedy
+  predictions, and compares every output of every function.
+  """
+  rng = numpy.random.RandomState(seed)
+  in_size = model.in_vocabulary.size()
+  max_diff = 0.0
+  def diff(a, b):
+    return float(numpy.max(numpy.abs(numpy.asarray(a) - numpy.asarray(b))))
+  for _ in range(num_inputs):
+    x_inds = rng.randint(in_size, size=rng.randint(1, max_x_len + 1))
+    h_t, annotations = model._encode(x_inds)
+    h_t_np, annotations_np = runtime.encode(x_inds)
+    max_diff = max(max_diff, diff(h_t, h_t_np), diff(annotations, annotations_np))
+    for _ in range(num_steps):
+      write_dist, c_t, alpha = model._decoder_write(annotations, h_t)
+      outputs_np = runtime.decoder_write(annotations, h_t)
+      max_diff = max([max_diff] + [diff(a, b) for a, b in zip((write_dist, c_t, alpha), outputs_np)])
+      y_t = numpy.argmax(write_dist[:model.out_vocabulary.all_size()])
+      new_h_t = model._decoder_step(y_t, c_t, h_t)
+      max_diff = max(max_diff, diff(new_h_t, runtime.decoder_step(y_t, c_t, h_t)))
+      h_t = new_h_t
+  return max_diff
+
+def main():
+  if len(sys.argv) < 3 or sys.argv[1] not in ('export', 'check'):
+    print('Usage: %s export spec_file params.npz' % sys.argv[0])
+    print('       %s check spec_file [params.npz]' % sys.argv[0])
+    sys.exit(1)
+  import spec as specutil
+  spec = specutil.load(sys.argv[2])
+  if sys.argv[1] == 'export':
+    export_spec(spec, sys.argv[3])
+    return
+  t0 = time.time()
+  if len(sys.argv) > 3:
+    runtime = NumpyAttentionRuntime.load(sys.argv[3])
+  else:
+    runtime = NumpyAttentionRuntime.from_spec(spec)
+  print('NumPy runtime ready in %.3fs' % (time.time() - t0))
+  t0 = time.time()
+  model = AttentionModel(spec)
+  print('Theano model compiled in %.3fs' % (time.time() - t0))
+  print('Max absolute difference: %g' % check_parity(model, runtime))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,124 @@
+"""A cache of predictions for repeated utterances, in front of decoding.
+
+Served queries repeat a lot, so the top-k derivations of each utterance are
+kept in a bounded LRU map whose entries also expire after a TTL.  Keys are
+the normalized utterance together with a context: the hash of the model
+checkpoint and the decoding settings (e.g. beam size).  The context is read
+from context_fn; when it changes (e.g. a new spec was loaded), every entry
+is dropped.
+"""
+import collections
+import sys
+import threading
+import time
+
+import checkpoint
+
+def normalize_utterance(utterance):
+  """Lowercase and collapse whitespace, so trivial variants share an entry."""
+  return ' '.join(utterance.lower().split())
+
+def get_spec_hash(spec):
+  """Hash the values of all of a spec's shared variables."""
+  return '%s:%s' % (spec.__class__.__name__, checkpoint.get_checksum(spec))
+
+def estimate_size(obj):
+  """Rough number of bytes used by a cached value (JSON-like objects)."""
+  size = sys.getsizeof(obj)
+  if isinstance(obj, dict):
+    for k, v in obj.items():
+      size += estimate_size(k) + estimate_size(v)
+  elif isinstance(obj, (list, tuple)):
+    for x in obj:
+      size += estimate_size(x)
+  return size
+
+class PredictionCache(object):
+  """A thread-safe LRU + TTL map from utterance to predictions."""
+  def __init__(self, max_size, ttl, context_fn=lambda: None, clock=time.time):
+    """Create a PredictionCache.
+
+    Args:
+      max_size: Most utterances to keep.
+      ttl: Seconds after which an entry expires (None or 0 for never).
+      context_fn: Function returning the current context (hashable).
+      clock: Function returning the current time in seconds.
+    """
+    self.max_size = max_size
+    self.ttl = ttl
+    self.context_fn = context_fn
+    self.clock = clock
+    self.lock = threading.Lock()
+    self.entries = collections.OrderedDict()  # key -> (expiry, size, value)
+    self.context = None
+    self.num_bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self.expirations = 0
+    self.invalidations = 0
+
+  def get_context(self):
+    """Get the current context, dropping all entries if it changed."""
+    context = self.context_fn()
+    with self.lock:
+      if context != self.context:
+        if self.entries:
+          self.invalidations += 1
+        self.entries.clear()
+        self.num_bytes = 0
+        self.context = context
+    return context
+
+  def get(self, utterance):
+    """Get the cached predictions of an utterance, or None."""
+    context = self.get_context()
+    key = (normalize_utterance(utterance), context)
+    with self.lock:
+      entry = self.entries.pop(key, None)
+      if entry is not None and self.ttl and entry[0] <= self.clock():
+        self.num_bytes -= entry[1]
+        self.expirations += 1
+        entry = None
+      if entry is None:
+        self.misses += 1
+        return None
+      self.entries[key] = entry
+      self.hits += 1
+      return entry[2]
+
+  def put(self, utterance, value, context):
+    """Cache value, unless the context changed since it was computed."""
+    key = (normalize_utterance(utterance), context)
+    size = estimate_size(value)
+    expiry = self.clock() + self.ttl if self.ttl else None
+    with self.lock:
+      if context != self.context:
+        return
+      old = self.entries.pop(key, None)
+      if old is not None:
+        self.num_bytes -= old[1]
+      self.entries[key] = (expiry, size, value)
+      self.num_bytes += size
+      while len(self.entries) > self.max_size:
+        _, (_, old_size, _) = self.entries.popitem(last=False)
+        self.num_bytes -= old_size
+
+  def clear(self):
+    with self.lock:
+      self.entries.clear()
+      self.num_bytes = 0
+
+  def get_stats(self):
+    with self.lock:
+      total = self.hits + self.misses
+      return {
+          'hits': self.hits,
+          'misses': self.misses,
+          'hit_rate': float(self.hits) / total if total else 0.0,
+          'size': len(self.entries),
+          'max_size': self.max_size,
+          'ttl': self.ttl,
+          'memory_bytes': self.num_bytes,
+          'expirations': self.expirations,
+          'invalidations': self.invalidations,
+      }
@@ -0,0 +1,393 @@
+"""A JSON prediction server that decodes concurrent queries in micro-batches.
+
+Each HTTP request is handled on its own thread, which puts its query on a
+queue and waits.  A single batching thread (the only one that touches the
+model) takes the first waiting query, then keeps collecting queries until
+it has max_batch_size of them or max_wait seconds have passed since the
+first one arrived, and decodes them all with one call to predict_fn.
+
+Endpoints:
+  POST /predict  body {"query": "what states border texas"}
+                 returns {"query": ..., "derivations": [...], "latency_ms": ...}
+  GET  /stats    returns latency percentiles, throughput and batch sizes,
+                 and prediction cache statistics if there is a cache.
+
+With a PredictionCache, queries it has predictions for are answered right
+away, without waiting for a batch.
+
+With several workers, the server forks after the model is loaded, and each
+worker process accepts connections on the same socket (see serve_workers).
+
+The server can be started in the background on localhost, e.g. for tests:
+    server = start_server(predict_fn, port=0)
+    ... POST to http://127.0.0.1:%d/predict % server.server_port ...
+    server.stop()
+"""
+import collections
+import gc
+import json
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+try:
+  import Queue as queue
+except ImportError:
+  import queue
+try:
+  from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+  from SocketServer import ThreadingMixIn
+except ImportError:
+  from http.server import BaseHTTPRequestHandler, HTTPServer
+  from socketserver import ThreadingMixIn
+
+def derivation_to_json(deriv):
+  """The parts of a Derivation that are returned to clients."""
+  record = {
+      'y_toks': list(deriv.y_toks),
+      'y_lf': deriv.y_toks_lf,
+      'p': float(deriv.p),
+  }
+  if deriv.p_list is not None:
+    record['p_list'] = [float(p) for p in deriv.p_list]
+  if getattr(deriv, 'truncated', False):
+    record['truncated'] = True
+  return record
+
+def percentile(sorted_values, q):
+  """Nearest-rank percentile of an already sorted list."""
+  if not sorted_values:
+    return 0.0
+  rank = int(round(q / 100.0 * (len(sorted_values) - 1)))
+  return sorted_values[rank]
+
+class LatencyStats(object):
+  """Latency and throughput over the most recent requests."""
+  def __init__(self, window_size=10000):
+    self.lock = threading.Lock()
+    self.requests = collections.deque(maxlen=window_size)  # (end time, latency)
+    self.batch_sizes = collections.deque(maxlen=window_size)
+    self.num_requests = 0
+    self.num_errors = 0
+    self.num_batches = 0
+
+  def add_batch(self, latencies, end_time, error=False):
+    with self.lock:
+      for latency in latencies:
+        self.requests.append((end_time, latency))
+      self.batch_sizes.append(len(latencies))
+      self.num_requests += len(latencies)
+      self.num_batches += 1
+      if error:
+        self.num_errors += len(latencies)
+
+  def add_cached(self, latency, end_time):
+    """A request answered from the cache, outside of any batch."""
+    with self.lock:
+      self.requests.append((end_time, latency))
+      self.num_requests += 1
+
+  def get_stats(self):
+    with self.lock:
+      requests = list(self.requests)
+      batch_sizes = list(self.batch_sizes)
+      stats = {
+          'num_requests': self.num_requests,
+          'num_errors': self.num_errors,
+          'num_batches': self.num_batches,
+      }
+    latencies = sorted(latency for _, latency in requests)
+    stats['p50_ms'] = 1000 * percentile(latencies, 50)
+    stats['p99_ms'] = 1000 * percentile(latencies, 99)
+    if len(requests) > 1:
+      elapsed = requests[-1][0] - (requests[0][0] - requests[0][1])
+      stats['throughput'] = len(requests) / elapsed if elapsed > 0 else 0.0
+    else:
+      stats['throughput'] = 0.0
+    if batch_sizes:
+      stats['mean_batch_size'] = float(sum(batch_sizes)) / len(batch_sizes)
+    else:
+      stats['mean_batch_size'] = 0.0
+    return stats
+
+class _PendingQuery(object):
+  __slots__ = ('query', 'start_time', 'done', 'result', 'error')
+  def __init__(self, query):
+    self.query = query
+    self.start_time = time.time()
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+class MicroBatcher(object):
+  """Gathers queries from many threads into batches for predict_fn.
+
+  predict_fn maps a list of queries to a list of results, one per query.
+  It is only ever called from the batching thread.  If cache is given,
+  results are looked up in it first and stored in it after decoding.
+  """
+  def __init__(self, predict_fn, max_batch_size=16, max_wait=0.005, cache=None):
+    self.predict_fn = predict_fn
+    self.max_batch_size = max_batch_size
+    self.max_wait = max_wait
+    self.cache = cache
+    self.stats = LatencyStats()
+    self.queue = queue.Queue()
+    self.closed = False
+    self.thread = threading.Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def submit(self, query):
+    """Decode one query; blocks until its batch is done."""
+    if self.closed:
+      raise RuntimeError('MicroBatcher is closed')
+    if self.cache is not None:
+      start_time = time.time()
+      result = self.cache.get(query)
+      if result is not None:
+        end_time = time.time()
+        self.stats.add_cached(end_time - start_time, end_time)
+        return result
+    pending = _PendingQuery(query)
+    self.queue.put(pending)
+    pending.done.wait()
+    if pending.error is not None:
+      raise pending.error
+    return pending.result
+
+  def _next_batch(self):
+    first = self.queue.get()
+    if first is None:
+      return None
+    batch = [first]
+    deadline = first.start_time + self.max_wait
+    while len(batch) < self.max_batch_size:
+      timeout = deadline - time.time()
+      try:
+        if timeout > 0:
+          pending = self.queue.get(timeout=timeout)
+        else:
+          pending = self.queue.get_nowait()
+      except queue.Empty:
+        break
+      if pending is None:
+        # Finish this batch, then stop.
+        self.queue.put(None)
+        break
+      batch.append(pending)
+    return batch
+
+  def _run(self):
+    while True:
+      batch = self._next_batch()
+      if batch is None:
+        return
+      error = None
+      if self.cache is not None:
+        context = self.cache.get_context()
+      try:
+        results = self.predict_fn([pending.query for pending in batch])
+      except Exception as e:
+        error = e
+      end_time = time.time()
+      for i, pending in enumerate(batch):
+        if error is None:
+          pending.result = results[i]
+          if self.cache is not None:
+            self.cache.put(pending.query, results[i], context)
+        else:
+          pending.error = error
+        pending.done.set()
+      self.stats.add_batch([end_time - pending.start_time for pending in batch],
+                           end_time, error=error is not None)
+
+  def get_stats(self):
+    stats = self.stats.get_stats()
+    stats['max_batch_size'] = self.max_batch_size
+    stats['max_wait_ms'] = 1000 * self.max_wait
+    stats['queue_size'] = self.queue.qsize()
+    if self.cache is not None:
+      stats['cache'] = self.cache.get_stats()
+    return stats
+
+  def close(self):
+    if not self.closed:
+      self.closed = True
+      self.queue.put(None)
+      self.thread.join()
+
+class PredictionRequestHandler(BaseHTTPRequestHandler):
+  def log_message(self, format, *args):
+    pass  # One line per query is too much under load
+
+  def send_json(self, code, record):
+    body = json.dumps(record).encode('utf-8')
+    self.send_response(code)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    if self.path == '/stats':
+      self.send_json(200, self.server.get_stats())
+    else:
+      self.send_json(404, {'error': 'Unknown path %s' % self.path})
+
+  def do_POST(self):
+    if self.path != '/predict':
+      self.send_json(404, {'error': 'Unknown path %s' % self.path})
+      return
+    try:
+      length = int(self.headers.get('Content-Length', 0))
+      record = json.loads(self.rfile.read(length).decode('utf-8'))
+      query = record['query']
+    except (ValueError, KeyError, TypeError):
+      self.send_json(400, {'error': 'Expected a JSON object with a "query"'})
+      return
+    start_time = time.time()
+    try:
+      derivations = self.server.batcher.submit(query)
+    except Exception as e:
+      self.send_json(500, {'error': str(e)})
+      return
+    self.send_json(200, {
+        'query': query,
+        'derivations': derivations,
+        'latency_ms': 1000 * (time.time() - start_time),
+    })
+
+class PredictionServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+  def __init__(self, address, batcher=None):
+    HTTPServer.__init__(self, address, PredictionRequestHandler)
+    self.batcher = batcher
+    self.serve_thread = None
+
+  def get_stats(self):
+    stats = self.batcher.get_stats()
+    stats['pid'] = os.getpid()
+    stats['memory'] = get_memory_stats()
+    return stats
+
+  def stop(self):
+    if self.serve_thread is not None:
+      self.shutdown()
+      self.serve_thread.join()
+    self.server_close()
+    self.batcher.close()
+
+def get_memory_stats(pid='self'):
+  """Resident memory of a process, split into shared and private pages.
+
+  Only available on Linux; None elsewhere.
+  """
+  sizes = collections.defaultdict(int)
+  try:
+    with open('/proc/%s/smaps_rollup' % pid) as f:
+      for line in f:
+        fields = line.split()
+        if len(fields) == 3 and fields[2] == 'kB':
+          sizes[fields[0].rstrip(':')] = 1024 * int(fields[1])
+  except (IOError, OSError):
+    return None
+  return {
+      'rss_bytes': sizes['Rss'],
+      'pss_bytes': sizes['Pss'],
+      'shared_bytes': sizes['Shared_Clean'] + sizes['Shared_Dirty'],
+      'private_bytes': sizes['Private_Clean'] + sizes['Private_Dirty'],
+  }
+
+def start_server(predict_fn, hostname='127.0.0.1', port=9001,
+                 max_batch_size=16, max_wait=0.005, cache=None):
+  """Start serving in a background thread and return the server.
+
+  With port=0, a free port is picked; it is in server.server_port.
+  """
+  batcher = MicroBatcher(predict_fn, max_batch_size=max_batch_size,
+                         max_wait=max_wait, cache=cache)
+  server = PredictionServer((hostname, port), batcher)
+  server.serve_thread = threading.Thread(target=server.serve_forever)
+  server.serve_thread.daemon = True
+  server.serve_thread.start()
+  return server
+
+def _run_worker(server, make_batcher):
+  """Body of a forked worker; never returns."""
+  code = 0
+  try:
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    server.batcher = make_batcher()
+    server.serve_forever()
+  except (KeyboardInterrupt, SystemExit):
+    pass
+  except Exception:
+    traceback.print_exc()
+    code = 1
+  finally:
+    os._exit(code)
+
+def serve_workers(server, make_batcher, num_workers):
+  """Fork num_workers processes that all accept on the server's socket.
+
+  Everything built before this call (parameters, compiled theano
+  functions, grammars, vocabularies) is shared copy-on-write between the
+  workers; with parameters memory-mapped from a checkpoint (see
+  checkpoint.save_and_map_params) even a worker that touches them does not
+  copy them.  Each worker then starts its own batching thread (threads do
+  not survive fork) from make_batcher, so each has its own batches, cache
+  and /stats.
+  """
+  if hasattr(gc, 'freeze'):
+    # Keep the collector from writing to (and so copying) shared objects.
+    gc.freeze()
+  # Workers race to accept each connection; the losers must not block.
+  server.socket.setblocking(False)
+  pids = []
+  for _ in range(num_workers):
+    pid = os.fork()
+    if pid == 0:
+      _run_worker(server, make_batcher)
+    pids.append(pid)
+  print('Started %d workers: %s' % (num_workers, ' '.join(str(pid) for pid in pids)))
+  try:
+    for pid in pids:
+      os.waitpid(pid, 0)
+  except KeyboardInterrupt:
+    for pid in pids:
+      try:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+      except OSError:
+        pass
+  finally:
+    server.server_close()
+
+def run_server(predict_fn, hostname='127.0.0.1', port=9001,
+               max_batch_size=16, max_wait=0.005, make_cache=None,
+               num_workers=1):
+  """Serve until interrupted.
+
+  make_cache, if given, creates the PredictionCache of a process.  With
+  num_workers > 1, forks that many workers (see serve_workers), and each
+  one gets its own cache.
+  """
+  def make_batcher():
+    return MicroBatcher(predict_fn, max_batch_size=max_batch_size,
+                        max_wait=max_wait,
+                        cache=make_cache() if make_cache else None)
+  if num_workers > 1:
+    serve_workers(PredictionServer((hostname, port)), make_batcher, num_workers)
+    return
+  server = PredictionServer((hostname, port), make_batcher())
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    server.batcher.close()
@@ -2,6 +2,7 @@
 import numpy
 import dill as pickle
 
+import checkpoint
 from gru import GRULayer
 from lstm import LSTMLayer
 from vanillarnn import VanillaRNNLayer
@@ -88,10 +89,12 @@ class Spec(object):
     raise Exception('Unrecognized rnn_type %s' % self.rnn_type)
 
   def save(self, filename):
-    """Save the parameters to a filename."""
-    with open(filename, 'w') as f:
-      pickle.dump(self, f)
+    """Save the parameters to a filename, as a checkpoint (see checkpoint.py)."""
+    checkpoint.save(self, filename)
 
 def load(filename):
-  with open(filename) as f:
+  """Load a checkpoint, or a spec pickled by older versions of save()."""
+  if checkpoint.is_checkpoint(filename):
+    return checkpoint.load(filename)
+  with open(filename, 'rb') as f:
     return pickle.load(f)
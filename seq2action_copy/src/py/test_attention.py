@@ -0,0 +1,86 @@
+"""Tests of the greedy decoding of AttentionModel under a budget."""
+import os
+import unittest
+import numpy
+try:
+  import theano
+except ImportError:
+  theano = None
+
+ONTOLOGY_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    'ontology')
+SENTENCES = [
+    'what states border texas',
+    'what is the capital of ohio',
+    'how many rivers are in colorado',
+    'which state has the largest population',
+]
+HIDDEN_SIZE = 8
+EMBEDDING_DIM = 6
+MAX_LEN = 40
+
+@unittest.skipIf(theano is None, 'Needs theano')
+class GreedyBudgetTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    import convert
+    from action_vocabulary import ActionVocabulary
+    from attention import AttentionModel
+    from example import Example
+    from vocabulary import Vocabulary
+    numpy.random.seed(0)
+    in_vocabulary = Vocabulary.from_sentences(SENTENCES, EMBEDDING_DIM)
+    with open(os.path.join(ONTOLOGY_DIR, 'geo.grammar')) as f:
+      databases = f.readlines()
+    out_vocabulary = ActionVocabulary.from_databases(
+        'geoquery', databases, EMBEDDING_DIM, EMBEDDING_DIM)
+    spec = AttentionModel.get_spec_class()(
+        in_vocabulary, out_vocabulary, None, HIDDEN_SIZE)
+    cls.model = AttentionModel(spec)
+    cls.domain_controller, cls.general_controller = convert.setup_geo(ONTOLOGY_DIR)
+    cls.examples = [Example(s, '', '', in_vocabulary, out_vocabulary, None)
+                    for s in SENTENCES]
+
+  def decode(self, ex, convertor=None, **kwargs):
+    import geoaction2seq
+    return self.model.decode_greedy(
+        'geoquery', ex, convertor or geoaction2seq.action2seq, self.domain_controller,
+        self.general_controller, max_len=MAX_LEN, **kwargs)
+
+  def test_step_limit(self):
+    for ex in self.examples:
+      derivs = self.decode(ex, step_limit=1)
+      self.assertEqual(len(derivs), 1)
+      deriv = derivs[0]
+      self.assertTrue(deriv.truncated)
+      self.assertTrue(1 <= len(deriv.y_toks) <= MAX_LEN)
+      self.assertIsInstance(deriv.y_toks_lf, list)
+
+  def test_time_limit_before_first_step(self):
+    deriv = self.decode(self.examples[0], time_limit=1e-9)[0]
+    self.assertTrue(deriv.truncated)
+    self.assertIsInstance(deriv.y_toks_lf, list)
+
+  def test_convertor_failure(self):
+    def convertor(action_seq, domain_controller, general_controller):
+      raise KeyError('node')
+    deriv = self.decode(self.examples[0], convertor=convertor, step_limit=1)[0]
+    self.assertTrue(deriv.truncated)
+    self.assertEqual(deriv.y_toks_lf, [])
+
+  def test_batch_matches_greedy(self):
+    import geoaction2seq
+    for step_limit in (1, 3, None):
+      batch = self.model.decode_greedy_batch(
+          'geoquery', self.examples, geoaction2seq.action2seq, self.domain_controller,
+          self.general_controller, max_len=MAX_LEN, step_limit=step_limit)
+      for ex, derivs in zip(self.examples, batch):
+        expected = self.decode(ex, step_limit=step_limit)[0]
+        self.assertEqual(derivs[0].y_toks, expected.y_toks)
+        self.assertEqual(derivs[0].y_toks_lf, expected.y_toks_lf)
+        self.assertEqual(derivs[0].truncated, expected.truncated)
+        self.assertAlmostEqual(derivs[0].p, expected.p)
+
+if __name__ == '__main__':
+  unittest.main()
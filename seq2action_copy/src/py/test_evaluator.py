@@ -0,0 +1,101 @@
+"""Tests of PipeEvaluator against the stand-in worker of evaluator.py."""
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import unittest
+
+import evaluator
+
+EVALUATOR_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'evaluator.py')
+TIMEOUT = 30
+TABLE = [
+    ('answer(A,state(A))', '{stateid(alaska), stateid(texas)}'),
+    ('answer(A,river(A))', '{riverid(rio grande)}'),
+    ('answer(A,lake(A))', '{}'),
+]
+
+class PipeEvaluatorTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    table_file = os.path.join(self.tmpdir, 'answers.tsv')
+    with open(table_file, 'w') as f:
+      for request, denotation in TABLE:
+        f.write('%s\t%s\n' % (request, denotation))
+    self.command = [sys.executable, EVALUATOR_FILE, 'table', table_file, 'UNKNOWN']
+    self.evaluator = evaluator.PipeEvaluator(self.command)
+
+  def tearDown(self):
+    self.evaluator.close()
+    shutil.rmtree(self.tmpdir)
+
+  def test_order(self):
+    requests = [r for r, _ in TABLE] * 3 + ['answer(A,city(A))', TABLE[0][0]]
+    expected = [d for _, d in TABLE] * 3 + ['UNKNOWN', TABLE[0][1]]
+    self.assertEqual(list(self.evaluator.execute(requests)), expected)
+    # The same worker answers later calls.
+    pid = self.evaluator.proc.pid
+    self.assertEqual(list(self.evaluator.execute(reversed(requests))), expected[::-1])
+    self.assertEqual(self.evaluator.proc.pid, pid)
+
+  def test_empty(self):
+    self.assertEqual(list(self.evaluator.execute([])), [])
+
+  def test_request_on_several_lines(self):
+    self.assertEqual(list(self.evaluator.execute(['answer(A,\nstate(A))', TABLE[1][0]])),
+                     ['UNKNOWN', TABLE[1][1]])
+
+  def test_streaming(self):
+    # The second request is only made once the first has been answered.
+    answered = threading.Event()
+    timed_out = []
+    def requests():
+      yield TABLE[0][0]
+      if not answered.wait(TIMEOUT):
+        timed_out.append(True)
+      yield TABLE[1][0]
+    denotations = self.evaluator.execute(requests())
+    self.assertEqual(next(denotations), TABLE[0][1])
+    answered.set()
+    self.assertEqual(list(denotations), [TABLE[1][1]])
+    self.assertEqual(timed_out, [])
+
+  def test_stop_early(self):
+    denotations = self.evaluator.execute([r for r, _ in TABLE])
+    self.assertEqual(next(denotations), TABLE[0][1])
+    denotations.close()
+    # The unread responses were drained, so the next call is in sync.
+    self.assertEqual(list(self.evaluator.execute([TABLE[2][0]])), [TABLE[2][1]])
+
+  def test_worker_death(self):
+    denotations = self.evaluator.execute([r for r, _ in TABLE] * 100)
+    self.assertEqual(next(denotations), TABLE[0][1])
+    self.evaluator.proc.send_signal(signal.SIGKILL)
+    self.evaluator.proc.wait()
+    with self.assertRaises(IOError):
+      list(denotations)
+    # The next call starts a new worker.
+    self.assertEqual(list(self.evaluator.execute([TABLE[1][0]])), [TABLE[1][1]])
+
+  def test_worker_that_cannot_start(self):
+    # Without a table, the stand-in prints its usage and exits.
+    broken = evaluator.PipeEvaluator([sys.executable, EVALUATOR_FILE])
+    try:
+      with self.assertRaises(IOError):
+        list(broken.execute([TABLE[0][0]]))
+    finally:
+      broken.close()
+
+  def test_get_worker(self):
+    worker = evaluator.get_worker(self.command)
+    try:
+      self.assertIs(evaluator.get_worker(list(self.command)), worker)
+      self.assertEqual(list(worker.execute([TABLE[0][0]])), [TABLE[0][1]])
+    finally:
+      evaluator.close_workers()
+    self.assertIsNone(worker.proc)
+
+if __name__ == '__main__':
+  unittest.main()
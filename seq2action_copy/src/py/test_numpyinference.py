@@ -0,0 +1,76 @@
+"""Tests that the NumPy runtime computes what the theano functions do."""
+import os
+import unittest
+import numpy
+try:
+  import theano
+except ImportError:
+  theano = None
+
+GEO_GRAMMAR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    'ontology/geo.grammar')
+SENTENCES = [
+    'what states border texas',
+    'what is the capital of ohio',
+    'how many rivers are in colorado',
+    'which state has the largest population',
+]
+HIDDEN_SIZE = 8
+EMBEDDING_DIM = 6
+NUM_STEPS = 5
+TOLERANCE = 1e-6
+
+@unittest.skipIf(theano is None, 'Needs theano')
+class ParityTest(unittest.TestCase):
+  def make_model(self, rnn_type, attention_copying=False):
+    from action_vocabulary import ActionVocabulary
+    from attention import AttentionModel
+    from vocabulary import Vocabulary
+    numpy.random.seed(0)
+    in_vocabulary = Vocabulary.from_sentences(SENTENCES, EMBEDDING_DIM)
+    with open(GEO_GRAMMAR) as f:
+      databases = f.readlines()
+    out_vocabulary = ActionVocabulary.from_databases(
+        'geoquery', databases, EMBEDDING_DIM, EMBEDDING_DIM)
+    spec = AttentionModel.get_spec_class()(
+        in_vocabulary, out_vocabulary, None, HIDDEN_SIZE, rnn_type=rnn_type,
+        attention_copying=attention_copying)
+    return AttentionModel(spec)
+
+  def check(self, rnn_type, attention_copying=False):
+    import numpyinference
+    model = self.make_model(rnn_type, attention_copying=attention_copying)
+    runtime = numpyinference.NumpyAttentionRuntime.from_spec(model.spec)
+    rng = numpy.random.RandomState(0)
+    for x_len in (1, 4, 9):
+      x_inds = rng.randint(model.in_vocabulary.size(), size=x_len)
+      h_t, annotations = model._encode(x_inds)
+      for a, b in zip((h_t, annotations), runtime.encode(x_inds)):
+        numpy.testing.assert_allclose(a, b, atol=TOLERANCE)
+      for _ in range(NUM_STEPS):
+        outputs = model._decoder_write(annotations, h_t)
+        for a, b in zip(outputs, runtime.decoder_write(annotations, h_t)):
+          numpy.testing.assert_allclose(a, b, atol=TOLERANCE)
+        write_dist, c_t, alpha = outputs
+        y_t = numpy.argmax(write_dist[:model.out_vocabulary.all_size()])
+        new_h_t = model._decoder_step(y_t, c_t, h_t)
+        numpy.testing.assert_allclose(new_h_t, runtime.decoder_step(y_t, c_t, h_t),
+                                      atol=TOLERANCE)
+        h_t = new_h_t
+    self.assertLess(numpyinference.check_parity(model, runtime, num_inputs=3), TOLERANCE)
+
+  def test_lstm(self):
+    self.check('lstm')
+
+  def test_gru(self):
+    self.check('gru')
+
+  def test_vanillarnn(self):
+    self.check('vanillarnn')
+
+  def test_attention_copying(self):
+    self.check('lstm', attention_copying='attention')
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,132 @@
+"""Tests of the forked server workers and their memory-mapped parameters."""
+import gc
+import json
+import os
+import select
+import shutil
+import signal
+import tempfile
+import threading
+import unittest
+import numpy
+
+import checkpoint
+import server
+
+NUM_WORKERS = 3
+NUM_PARAMS = 4
+PARAM_SHAPE = (1024, 1024)  # 8MB of float64 each
+TIMEOUT = 60
+
+class ArrayParam(object):
+  """An array with the get_value/set_value of a theano shared variable."""
+  def __init__(self, value, name):
+    self.value = value
+    self.name = name
+
+  def get_value(self, borrow=False):
+    return self.value if borrow else self.value.copy()
+
+  def set_value(self, value, borrow=False):
+    self.value = value if borrow else value.copy()
+
+class ArraySpec(object):
+  """A spec with nothing but parameters."""
+  def __init__(self, num_params, shape):
+    rng = numpy.random.RandomState(0)
+    self.names = ['w%d' % i for i in range(num_params)]
+    for name in self.names:
+      setattr(self, name, ArrayParam(rng.uniform(size=shape), name))
+
+  def get_all_shared(self):
+    return [getattr(self, name) for name in self.names]
+
+def touch(spec):
+  """Read every page of every parameter."""
+  return sum(float(numpy.asarray(p.get_value(borrow=True)).sum())
+             for p in spec.get_all_shared())
+
+def read_exactly(fd, n):
+  data = b''
+  while len(data) < n:
+    ready, _, _ = select.select([fd], [], [], TIMEOUT)
+    if not ready:
+      raise AssertionError('Timed out waiting for the workers')
+    chunk = os.read(fd, n - len(data))
+    if not chunk:
+      raise AssertionError('A worker exited early')
+    data += chunk
+  return data
+
+@unittest.skipUnless(hasattr(os, 'fork') and server.get_memory_stats() is not None,
+                     'Needs fork and /proc/<pid>/smaps_rollup')
+class ServeWorkersMemoryTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+    if hasattr(gc, 'unfreeze'):
+      gc.unfreeze()
+
+  def test_workers_share_mapped_params(self):
+    spec = ArraySpec(NUM_PARAMS, PARAM_SHAPE)
+    param_bytes = sum(p.get_value(borrow=True).nbytes for p in spec.get_all_shared())
+    filename = os.path.join(self.tmpdir, 'params')
+    checkpoint.save_and_map_params(spec, filename)
+    self.assertTrue(all(isinstance(p.get_value(borrow=True), numpy.memmap)
+                        for p in spec.get_all_shared()))
+    # Mapped again without writing, since the checkpoint holds the same values.
+    mtime = os.path.getmtime(filename)
+    checkpoint.save_and_map_params(spec, filename)
+    self.assertEqual(os.path.getmtime(filename), mtime)
+    total = touch(spec)
+
+    ready_r, ready_w = os.pipe()
+    go_r, go_w = os.pipe()
+    report_r, report_w = os.pipe()
+    def make_batcher():
+      # Runs in each worker: read all the parameters, wait until every
+      # worker has, then report how much memory that took.
+      before = server.get_memory_stats()
+      worker_total = touch(spec)
+      os.write(ready_w, b'.')
+      os.read(go_r, 1)
+      after = server.get_memory_stats()
+      report = {'pid': os.getpid(), 'total': worker_total,
+                'before': before, 'after': after}
+      os.write(report_w, (json.dumps(report) + '\n').encode('utf-8'))
+      return server.MicroBatcher(lambda queries: [[] for _ in queries])
+    prediction_server = server.PredictionServer(('127.0.0.1', 0))
+    thread = threading.Thread(target=server.serve_workers,
+                              args=(prediction_server, make_batcher, NUM_WORKERS))
+    thread.daemon = True
+    thread.start()
+    reports = []
+    try:
+      read_exactly(ready_r, NUM_WORKERS)
+      os.write(go_w, b'.' * NUM_WORKERS)
+      lines = b''
+      while lines.count(b'\n') < NUM_WORKERS:
+        lines += read_exactly(report_r, 1)
+      reports = [json.loads(line.decode('utf-8')) for line in lines.splitlines()]
+    finally:
+      for report in reports:
+        os.kill(report['pid'], signal.SIGTERM)
+      thread.join(TIMEOUT)
+      for fd in (ready_r, ready_w, go_r, go_w, report_r, report_w):
+        os.close(fd)
+    self.assertFalse(thread.is_alive())
+    self.assertEqual(len(set(report['pid'] for report in reports)), NUM_WORKERS)
+    for report in reports:
+      self.assertAlmostEqual(report['total'], total)
+      before = report['before']
+      after = report['after']
+      # No worker copies the parameters, and each one accounts for about
+      # its share of them (the parent and every worker map them).
+      self.assertLess(after['private_bytes'] - before['private_bytes'], 0.1 * param_bytes)
+      self.assertLess(after['pss_bytes'] - before['pss_bytes'],
+                      1.5 * param_bytes / (NUM_WORKERS + 1))
+
+if __name__ == '__main__':
+  unittest.main()
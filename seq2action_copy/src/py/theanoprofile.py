@@ -0,0 +1,58 @@
+"""Theano profiles of a model's compiled functions, as run statistics.
+
+With theano.config.profile set (--theano-profile), every compiled
+function keeps a ProfileStats, but theano only prints them to stderr at
+exit, one function at a time.  get_stats() collects the profiles of a
+model's functions and sums their time per op class (Elemwise, Dot, Scan,
+...), so that runs with different rnn_type, hidden sizes or copy settings
+can be compared from their --stats-file JSON.
+"""
+import collections
+
+# Functions of an AttentionModel, in the order they are compiled.  Those
+# a model does not have (e.g. the batch decoder, before it is set up) are
+# left out.
+FUNCTIONS = ('_encode', '_decoder_step', '_decoder_write', '_get_nll', '_backprop',
+             '_get_nll_distract', '_backprop_distract',
+             '_encode_batch', '_decoder_write_batch', '_decoder_step_batch')
+
+def get_profiles(model):
+  """Get (name, ProfileStats) of each profiled function of a model."""
+  profiles = []
+  for name in FUNCTIONS:
+    profile = getattr(getattr(model, name, None), 'profile', None)
+    if profile:
+      profiles.append((name, profile))
+  return profiles
+
+def get_class_name(op_class):
+  return getattr(op_class, '__name__', str(op_class))
+
+def get_stats(model):
+  """Per-function totals, and the time spent in each op class over all of them."""
+  functions = collections.OrderedDict()
+  op_classes = collections.defaultdict(lambda: {'seconds': 0.0, 'calls': 0, 'apply_nodes': 0})
+  for name, profile in get_profiles(model):
+    class_time = profile.class_time()
+    class_callcount = profile.class_callcount()
+    class_nodes = profile.class_nodes()
+    functions[name] = {
+        'calls': profile.fct_callcount,
+        'seconds': profile.fct_call_time,
+        'vm_seconds': profile.vm_call_time,
+        'compile_seconds': profile.compile_time,
+        'op_classes': dict((get_class_name(c), t) for c, t in class_time.items()),
+    }
+    for c, t in class_time.items():
+      stats = op_classes[get_class_name(c)]
+      stats['seconds'] += t
+      stats['calls'] += class_callcount.get(c, 0)
+      stats['apply_nodes'] += class_nodes.get(c, 0)
+  total = sum(stats['seconds'] for stats in op_classes.values())
+  for stats in op_classes.values():
+    stats['fraction'] = stats['seconds'] / total if total else 0.0
+  return {
+      'functions': functions,
+      'op_classes': dict(op_classes),
+      'op_seconds': total,
+  }
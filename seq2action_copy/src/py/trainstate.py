@@ -0,0 +1,136 @@
+"""Periodic checkpoints of training, and resuming from them.
+
+A training checkpoint is a checkpoint (see checkpoint.py) of the spec with
+the rest of the training state added:
+  - tensors 'train.grad_cache.<param>': the optimizer caches (adagrad and
+    rmsprop squared gradients, Nesterov velocities);
+  - tensor 'train.numpy_rng.key' and metadata 'train_state': the epoch,
+    the learning rate, the order of the training examples and the states
+    of the random and numpy.random generators, all as of the start of the
+    epoch, and the number of examples of the epoch already trained on.
+NeuralModel.train() resumes from this by restoring the start of the
+epoch and replaying the random draws of the examples already trained on,
+so a resumed run makes the same updates as an uninterrupted one.
+
+TrainingCheckpointer copies the parameters and caches (which is fast) and
+writes the checkpoint in a background thread while training goes on.
+"""
+import random
+import sys
+import threading
+import time
+import numpy
+
+import checkpoint
+
+GRAD_CACHE_PREFIX = 'train.grad_cache.'
+NUMPY_RNG_KEY = 'train.numpy_rng.key'
+
+def get_rng_state():
+  """Get the states of random and numpy.random, as JSON and an array."""
+  version, internal_state, gauss_next = random.getstate()
+  name, key, pos, has_gauss, cached_gaussian = numpy.random.get_state()
+  state = {
+      'random': [version, list(internal_state), gauss_next],
+      'numpy_random': [name, int(pos), int(has_gauss), float(cached_gaussian)],
+  }
+  return state, numpy.array(key)
+
+def set_rng_state(state, numpy_key):
+  version, internal_state, gauss_next = state['random']
+  random.setstate((version, tuple(internal_state), gauss_next))
+  name, pos, has_gauss, cached_gaussian = state['numpy_random']
+  numpy.random.set_state((str(name), numpy.asarray(numpy_key), pos, has_gauss, cached_gaussian))
+
+def get_epoch_state(epoch, lr, order):
+  """The state of training at the start of an epoch.
+
+  order lists the indices (in the original training set) of the training
+  examples, in their current order.
+  """
+  rng, numpy_rng_key = get_rng_state()
+  return {'epoch': epoch, 'lr': lr, 'order': order, 'rng': rng,
+          'numpy_rng_key': numpy_rng_key, 'example': 0, 'total_nll': 0.0}
+
+def get_grad_cache_names(model):
+  """Names of the model's grad caches, after the parameters they belong to."""
+  names = dict((id(param), name) for name, param in checkpoint.get_named_params(model.spec))
+  return [GRAD_CACHE_PREFIX + names[id(p)] for p in model.params]
+
+class TrainingCheckpointer(object):
+  """Writes a training checkpoint every N examples and/or every N epochs."""
+  def __init__(self, filename, every_examples=0, every_epochs=1):
+    self.filename = filename
+    self.every_examples = every_examples
+    self.every_epochs = every_epochs
+    self.num_examples = 0
+    self.thread = None
+    self.error = None
+
+  def on_example(self, model, state):
+    """Called after each example (state['example'] counts those done)."""
+    self.num_examples += 1
+    if self.every_examples and self.num_examples % self.every_examples == 0:
+      self.save(model, state)
+
+  def on_epoch(self, model, state):
+    """Called after each epoch, with the state of the start of the next."""
+    if self.every_epochs and state['epoch'] % self.every_epochs == 0:
+      self.save(model, state)
+
+  def save(self, model, state):
+    """Snapshot the model and write it in the background."""
+    self.wait()
+    values = dict((name, numpy.array(param.get_value(borrow=True)))
+                  for name, param in checkpoint.get_named_params(model.spec))
+    extra_arrays = [(NUMPY_RNG_KEY, state['numpy_rng_key'])]
+    if hasattr(model, 'grad_cache'):
+      extra_arrays.extend(
+          (name, numpy.array(c.get_value(borrow=True)))
+          for name, c in zip(get_grad_cache_names(model), model.grad_cache))
+    metadata = dict((k, v) for k, v in state.items() if k != 'numpy_rng_key')
+    self.thread = threading.Thread(
+        target=self._write, args=(model.spec, values, extra_arrays, metadata))
+    self.thread.start()
+
+  def _write(self, spec, values, extra_arrays, metadata):
+    try:
+      t0 = time.time()
+      checkpoint.save(spec, self.filename, named_values=values,
+                      extra_arrays=extra_arrays, extra_metadata={'train_state': metadata})
+      sys.stderr.write('Wrote checkpoint %s (epoch %d, example %d) in %.2fs\n' % (
+          self.filename, metadata['epoch'], metadata['example'], time.time() - t0))
+    except Exception as e:
+      self.error = e
+
+  def wait(self):
+    """Wait for the checkpoint being written, if any."""
+    if self.thread:
+      self.thread.join()
+      self.thread = None
+    if self.error:
+      error, self.error = self.error, None
+      raise error
+
+def restore(model, state):
+  """Restore the optimizer caches and random generators of a state."""
+  if hasattr(model, 'grad_cache'):
+    for name, c in zip(get_grad_cache_names(model), model.grad_cache):
+      c.set_value(state['grad_cache'][name])
+  set_rng_state(state['rng'], state['numpy_rng_key'])
+
+def load(filename):
+  """Read the training state of a checkpoint written by TrainingCheckpointer.
+
+  Returns a dict with the metadata of the state, plus 'numpy_rng_key' and
+  'grad_cache' (a dict from name to array).
+  """
+  reader = checkpoint.CheckpointReader(filename)
+  if 'train_state' not in reader.metadata:
+    raise ValueError('%s has no training state' % filename)
+  state = dict(reader.metadata['train_state'])
+  state['numpy_rng_key'] = reader.get_tensor(NUMPY_RNG_KEY, mmap_mode=None)
+  state['grad_cache'] = dict(
+      (name, reader.get_tensor(name, mmap_mode=None))
+      for name in reader.names() if name.startswith(GRAD_CACHE_PREFIX))
+  return state
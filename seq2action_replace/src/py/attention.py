@@ -238,7 +238,7 @@ class AttentionModel(NeuralModel):
       p_y_t = write_dist[y_t]
       p_y_seq.append(p_y_t)
       p *= p_y_t
-      if self.out_vocabulary.action_is_end(y_t):
+      if self.out_vocabulary.action_is_end(domain, y_t):
         break_flag = True
       y_tok = self.out_vocabulary.get_action(y_t)
       if y_t >= self.out_vocabulary.all_size():
@@ -0,0 +1,328 @@
+"""A checkpoint format of named parameter arrays with JSON metadata.
+
+A checkpoint is one file:
+  - MAGIC, then the length of a JSON header, then the header: the format
+    version, metadata (spec class, hyperparameters such as rnn_type and
+    step_rule, hashes of the vocabularies, code version) and the name,
+    dtype, shape and offset of every tensor;
+  - the bytes of every tensor, each aligned to ALIGNMENT, so that they can
+    be memory-mapped;
+  - a small pickle of the spec in which every shared variable is replaced
+    by the name of its tensor.  The vocabularies and the lexicon are plain
+    Python objects, so they are still pickled, but no array is.  This
+    skeleton has a version of its own (SKELETON_VERSION).  If it cannot be
+    unpickled, e.g. because a class it refers to has changed, load() says
+    so with a ValueError; the tensors can still be read by name, or set in
+    a spec built by the current code with load_into().
+
+Tensors can be read by name (CheckpointReader.get_tensor) without theano
+or the pickle.  load() rebuilds a spec whose shared variables hold
+copy-on-write memory maps of the file, so arrays are only read from disk
+when used; load_into() sets some or all of the tensors of a checkpoint in
+an existing spec.  spec.load() reads both checkpoints and the old dill
+pickles, and
+    python checkpoint.py convert old_params new_params
+converts the latter, while
+    python checkpoint.py info params
+prints the metadata and tensors of a checkpoint.
+"""
+import hashlib
+import io
+import json
+import os
+import struct
+import subprocess
+import sys
+import dill as pickle
+import numpy
+
+MAGIC = b'S2ACKPT\n'
+FORMAT_VERSION = 1
+# Bump when the classes pickled in the skeleton (specs, vocabularies,
+# lexicons) change so that older skeletons no longer unpickle into them.
+SKELETON_VERSION = 1
+ALIGNMENT = 64
+HEADER_LENGTH_FORMAT = '<Q'
+
+def is_shared(obj):
+  return hasattr(obj, 'get_value') and hasattr(obj, 'set_value')
+
+def get_named_params(spec):
+  """Name every shared variable of a spec by its attribute path.
+
+  For example, the 'wi' matrix of the spec's fwd_encoder is named
+  'fwd_encoder.wi'.  Variables that cannot be found this way are named
+  after their position.  Returns a list of (name, shared variable).
+  """
+  paths = {}
+  def visit(obj, prefix, depth):
+    for attr, value in sorted(vars(obj).items()):
+      if is_shared(value):
+        paths.setdefault(id(value), prefix + attr)
+      elif depth > 0 and hasattr(value, '__dict__') and not isinstance(value, type):
+        visit(value, prefix + attr + '.', depth - 1)
+  visit(spec, '', 2)
+  named_params = []
+  used = set()
+  for i, param in enumerate(spec.get_all_shared()):
+    name = paths.get(id(param))
+    if name is None or name in used:
+      name = 'param%03d.%s' % (i, param.name)
+    used.add(name)
+    named_params.append((name, param))
+  return named_params
+
+def get_vocab_hash(vocab):
+  if vocab is None:
+    return None
+  if hasattr(vocab, 'num_buckets'):
+    tokens = ['<hashed>', str(vocab.num_buckets), str(vocab.num_hashes)]
+  elif hasattr(vocab, 'get_action_list'):
+    tokens = vocab.get_action_list()
+  else:
+    tokens = vocab.word_list
+  h = hashlib.sha1()
+  for tok in tokens:
+    h.update(tok.encode('utf-8') if not isinstance(tok, bytes) else tok)
+    h.update(b'\n')
+  return h.hexdigest()
+
+_CODE_VERSION = {}
+
+def get_code_version():
+  """The git commit of the source tree, if there is one.
+
+  Looked up once per process, since checkpoints may be saved every few
+  examples while training.
+  """
+  if 'commit' not in _CODE_VERSION:
+    try:
+      with open(os.devnull, 'w') as devnull:
+        out = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=devnull,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+      _CODE_VERSION['commit'] = out.decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+      _CODE_VERSION['commit'] = None
+  return _CODE_VERSION['commit']
+
+def get_metadata(spec):
+  hyperparams = {}
+  for k, v in vars(spec).items():
+    if isinstance(v, (bool, int, float, type(u''), type(''))):
+      hyperparams[k] = v
+  return {
+      'spec_class': spec.__class__.__name__,
+      'hyperparams': hyperparams,
+      'vocab_hashes': {
+          'in_vocabulary': get_vocab_hash(getattr(spec, 'in_vocabulary', None)),
+          'out_vocabulary': get_vocab_hash(getattr(spec, 'out_vocabulary', None)),
+      },
+      'code_version': get_code_version(),
+  }
+
+class _SkeletonPickler(pickle.Pickler):
+  """Pickles shared variables as (tensor name, variable name)."""
+  def __init__(self, f, named_params):
+    pickle.Pickler.__init__(self, f, pickle.HIGHEST_PROTOCOL)
+    self.ids = dict((id(param), (name, param.name)) for name, param in named_params)
+
+  def persistent_id(self, obj):
+    return self.ids.get(id(obj))
+
+class _SkeletonUnpickler(pickle.Unpickler):
+  def __init__(self, f, load_shared):
+    pickle.Unpickler.__init__(self, f)
+    self.load_shared = load_shared
+
+  def persistent_load(self, pid):
+    return self.load_shared(pid)
+
+def pad(f):
+  f.write(b'\0' * (-f.tell() % ALIGNMENT))
+
+def write(filename, arrays, metadata=None, skeleton=b''):
+  """Write named arrays (a list of (name, array)) to a checkpoint file.
+
+  The file is written next to filename and renamed into place, so a
+  reader never sees a partial checkpoint.
+  """
+  arrays = [(name, numpy.asarray(a)) for name, a in arrays]
+  tensors = []
+  offset = 0
+  for name, a in arrays:
+    offset += -offset % ALIGNMENT
+    tensors.append({'name': name, 'dtype': a.dtype.str, 'shape': list(a.shape),
+                    'offset': offset, 'nbytes': int(a.nbytes)})
+    offset += a.nbytes
+  offset += -offset % ALIGNMENT
+  header = {
+      'format_version': FORMAT_VERSION,
+      'metadata': metadata or {},
+      'tensors': tensors,
+      'skeleton': {'offset': offset, 'nbytes': len(skeleton), 'version': SKELETON_VERSION},
+  }
+  header_bytes = json.dumps(header, sort_keys=True).encode('utf-8')
+  tmp_filename = '%s.tmp.%d' % (filename, os.getpid())
+  try:
+    with open(tmp_filename, 'wb') as f:
+      f.write(MAGIC)
+      f.write(struct.pack(HEADER_LENGTH_FORMAT, len(header_bytes)))
+      f.write(header_bytes)
+      pad(f)
+      for name, a in arrays:
+        pad(f)
+        f.write(numpy.ascontiguousarray(a).tobytes())
+      pad(f)
+      f.write(skeleton)
+    os.rename(tmp_filename, filename)
+  finally:
+    if os.path.exists(tmp_filename):
+      os.remove(tmp_filename)
+
+def save(spec, filename, named_values=None):
+  """Save a spec as a checkpoint.
+
+  named_values optionally gives the arrays to write instead of the current
+  values of the spec's shared variables (a dict from name to array, e.g. a
+  snapshot taken earlier).
+  """
+  named_params = get_named_params(spec)
+  arrays = []
+  for name, param in named_params:
+    if named_values is not None:
+      arrays.append((name, named_values[name]))
+    else:
+      arrays.append((name, param.get_value(borrow=True)))
+  f = io.BytesIO()
+  _SkeletonPickler(f, named_params).dump(spec)
+  write(filename, arrays, get_metadata(spec), f.getvalue())
+
+def is_checkpoint(filename):
+  with open(filename, 'rb') as f:
+    return f.read(len(MAGIC)) == MAGIC
+
+class CheckpointReader(object):
+  """Reads the header of a checkpoint, and its tensors on demand."""
+  def __init__(self, filename):
+    self.filename = filename
+    with open(filename, 'rb') as f:
+      if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('%s is not a checkpoint' % filename)
+      size = struct.calcsize(HEADER_LENGTH_FORMAT)
+      header_length = struct.unpack(HEADER_LENGTH_FORMAT, f.read(size))[0]
+      header = json.loads(f.read(header_length).decode('utf-8'))
+    if header['format_version'] > FORMAT_VERSION:
+      raise ValueError('%s has format version %d, newer than %d' % (
+          filename, header['format_version'], FORMAT_VERSION))
+    start = len(MAGIC) + size + header_length
+    self.data_offset = start + (-start % ALIGNMENT)
+    self.metadata = header['metadata']
+    self.tensors = [(t['name'], t) for t in header['tensors']]
+    self.tensor_info = dict(self.tensors)
+    self.skeleton_info = header['skeleton']
+
+  def names(self):
+    return [name for name, _ in self.tensors]
+
+  def get_tensor(self, name, mmap_mode='r'):
+    """Get a tensor, memory-mapped unless mmap_mode is None."""
+    info = self.tensor_info[name]
+    dtype = numpy.dtype(str(info['dtype']))
+    shape = tuple(info['shape'])
+    offset = self.data_offset + info['offset']
+    if mmap_mode is None or info['nbytes'] == 0:
+      with open(self.filename, 'rb') as f:
+        f.seek(offset)
+        data = f.read(info['nbytes'])
+      return numpy.frombuffer(data, dtype=dtype).reshape(shape).copy()
+    return numpy.memmap(self.filename, dtype=dtype, mode=mmap_mode,
+                        offset=offset, shape=shape)
+
+  def iter_tensors(self, mmap_mode='r'):
+    for name in self.names():
+      yield name, self.get_tensor(name, mmap_mode=mmap_mode)
+
+  def load_spec(self, mmap_mode='c'):
+    """Rebuild the spec.
+
+    With the default mmap_mode 'c' (copy-on-write), tensors are read when
+    first used and changes to them are never written back to the file.
+    """
+    import theano
+    # Checkpoints written before skeletons had versions have version 1.
+    version = self.skeleton_info.get('version', 1)
+    if version != SKELETON_VERSION:
+      raise ValueError(
+          '%s has skeleton version %d, but this code reads version %d; '
+          'set its tensors in a new spec with load_into() instead' % (
+              self.filename, version, SKELETON_VERSION))
+    with open(self.filename, 'rb') as f:
+      f.seek(self.data_offset + self.skeleton_info['offset'])
+      skeleton = f.read(self.skeleton_info['nbytes'])
+    shared = {}
+    def load_shared(pid):
+      name, param_name = pid
+      if name not in shared:
+        shared[name] = theano.shared(
+            value=self.get_tensor(name, mmap_mode=mmap_mode), name=param_name, borrow=True)
+      return shared[name]
+    try:
+      return _SkeletonUnpickler(io.BytesIO(skeleton), load_shared).load()
+    except Exception as e:
+      raise ValueError(
+          'Cannot unpickle the spec of %s, saved by code version %s (%s: %s); '
+          'set its tensors in a new spec with load_into() instead' % (
+              self.filename, self.metadata.get('code_version'), type(e).__name__, e))
+
+def load(filename, mmap_mode='c'):
+  return CheckpointReader(filename).load_spec(mmap_mode=mmap_mode)
+
+def load_into(spec, filename, names=None, mmap_mode=None):
+  """Set tensors of a checkpoint in an existing spec (partial loading).
+
+  Args:
+    spec: the spec to update.
+    filename: the checkpoint.
+    names: the tensors to set (all those in both, if None).
+    mmap_mode: how to map the tensors; by default they are read into memory.
+  Returns:
+    The names of the tensors that were set.
+  """
+  reader = CheckpointReader(filename)
+  params = dict(get_named_params(spec))
+  if names is None:
+    names = [name for name in reader.names() if name in params]
+  for name in names:
+    value = reader.get_tensor(name, mmap_mode=mmap_mode)
+    current = params[name].get_value(borrow=True)
+    if value.shape != current.shape:
+      raise ValueError('Tensor %s has shape %s in %s, but %s in the spec' % (
+          name, value.shape, filename, current.shape))
+    params[name].set_value(value, borrow=True)
+  return names
+
+def convert(old_filename, new_filename):
+  """Convert a spec pickled by an older spec.save() into a checkpoint."""
+  with open(old_filename, 'rb') as f:
+    spec = pickle.load(f)
+  save(spec, new_filename)
+
+def print_info(filename):
+  reader = CheckpointReader(filename)
+  print(json.dumps(reader.metadata, indent=2, sort_keys=True))
+  for name, info in reader.tensors:
+    print('%-40s %-6s %s' % (name, info['dtype'], tuple(info['shape'])))
+
+def main():
+  if len(sys.argv) == 4 and sys.argv[1] == 'convert':
+    convert(sys.argv[2], sys.argv[3])
+  elif len(sys.argv) == 3 and sys.argv[1] == 'info':
+    print_info(sys.argv[2])
+  else:
+    print('Usage: %s convert old_params new_params' % sys.argv[0])
+    print('       %s info params' % sys.argv[0])
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
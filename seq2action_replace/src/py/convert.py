@@ -0,0 +1,234 @@
+"""Convert TSV datasets between logical forms and action sequences.
+
+One command line for the dataset converters, instead of their main()s with
+hard-coded IN_DIR/OUT_DIR:
+    python convert.py geoaction2seq action0/ -o seq1 -j 8
+Inputs are .tsv files or directories of them.  The lines of each input are
+sent in chunks to a pool of worker processes, each of which builds its own
+controllers (or lexicon) once, and are written back in input order to a
+temporary file that replaces the output file when the input is done.
+Examples that fail to convert are left out of the output and listed, with
+their error, in <output>.failures.
+"""
+import argparse
+import collections
+import glob
+import importlib
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+
+from atisgeneralontology import AtisGeneralOntology
+from atisontology import AtisOntology
+from generalontology import GeneralOntology
+from geoontology import GeoOntology
+
+GRAMMAR_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'ontology')
+
+def parse_entity_lex(entity_lex_str):
+  """Parse 'ent0:=:state:::texas:=:state ...' into a dict."""
+  entity_lex = {}
+  if entity_lex_str:
+    for item in entity_lex_str.split(' '):
+      entity, entity_name = item.split(':::')[:2]
+      entity_lex[entity] = entity_name
+  return entity_lex
+
+def setup_geo(grammar_dir):
+  return (GeoOntology(os.path.join(grammar_dir, 'geo.grammar'), True),
+          GeneralOntology(os.path.join(grammar_dir, 'general.grammar'), True))
+
+def setup_atis(grammar_dir):
+  return (AtisOntology(os.path.join(grammar_dir, 'atis.grammar'), True),
+          AtisGeneralOntology(os.path.join(grammar_dir, 'atis-general.grammar'), True))
+
+def setup_lexicon(grammar_dir):
+  import geolexiconreplace
+  return geolexiconreplace.get_lexicon()
+
+def convert_seq2action(module, fields, context):
+  return [fields[0], ' '.join(module.seq2action(fields[1]))]
+
+def convert_geoaction2seq(module, fields, context):
+  geo_controller, general_controller = context
+  entity_lex = parse_entity_lex(fields[2] if len(fields) > 2 else '')
+  y = module.action2seq(fields[1], geo_controller, general_controller, entity_lex_map=entity_lex)
+  return [fields[0], ' '.join(y)]
+
+def convert_atisaction2seq(module, fields, context):
+  atis_controller, general_controller = context
+  # Like atisaction2seq.process(), which ignores the entity lexicon column.
+  y = module.action2seq(fields[1], atis_controller, general_controller, entity_lex_map={})
+  return [fields[0], ' '.join(y)]
+
+def convert_geo880entity(module, fields, context):
+  return list(module.convert_example(fields[0], fields[1], context))
+
+# name -> (module, setup function returning the context, conversion function)
+# The modules are only imported by the workers of their converter, since
+# they are not all written for the same python version.
+CONVERTERS = collections.OrderedDict([
+    ('geoseq2action', ('geoseq2action', None, convert_seq2action)),
+    ('atisseq2action', ('atisseq2action', None, convert_seq2action)),
+    ('geoaction2seq', ('geoaction2seq', setup_geo, convert_geoaction2seq)),
+    ('atisaction2seq', ('atisaction2seq', setup_atis, convert_atisaction2seq)),
+    ('geo880entity', ('geo880entity', setup_lexicon, convert_geo880entity)),
+])
+
+# State of a worker process, set by init_worker().
+_WORKER = {}
+
+def init_worker(name, grammar_dir, verbose):
+  # An exception here would make the pool start new workers forever, so it
+  # is kept and raised by convert_chunk() instead.
+  try:
+    module_name, setup, convert = CONVERTERS[name]
+    _WORKER['module'] = importlib.import_module(module_name)
+    _WORKER['convert'] = convert
+    _WORKER['context'] = setup(grammar_dir) if setup else None
+    _WORKER['verbose'] = verbose
+  except Exception:
+    _WORKER['error'] = traceback.format_exc()
+
+def convert_chunk(chunk):
+  """Convert a list of (line_num, line).
+
+  Returns a list of (line_num, output line, error), where error is None
+  on success and output line is the input line otherwise.
+  """
+  if 'error' in _WORKER:
+    raise RuntimeError('Could not set up the converter:\n%s' % _WORKER['error'])
+  module = _WORKER['module']
+  convert = _WORKER['convert']
+  context = _WORKER['context']
+  stdout = sys.stdout
+  if not _WORKER['verbose']:
+    # The converters print every intermediate step.
+    sys.stdout = open(os.devnull, 'w')
+  results = []
+  try:
+    for line_num, line in chunk:
+      try:
+        out_fields = convert(module, line.split('\t'), context)
+        results.append((line_num, '\t'.join(out_fields), None))
+      except Exception as e:
+        results.append((line_num, line, '%s: %s' % (type(e).__name__, e)))
+  finally:
+    if sys.stdout is not stdout:
+      sys.stdout.close()
+      sys.stdout = stdout
+  return results
+
+def read_chunks(f, chunk_size):
+  chunk = []
+  for line_num, line in enumerate(f, 1):
+    line = line.strip()
+    if not line:
+      continue
+    chunk.append((line_num, line))
+    if len(chunk) == chunk_size:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+
+def write_atomically(filename, lines):
+  tmp_filename = '%s.tmp.%d' % (filename, os.getpid())
+  try:
+    with open(tmp_filename, 'w') as f:
+      for line in lines:
+        f.write(line + '\n')
+    os.rename(tmp_filename, filename)
+  finally:
+    if os.path.exists(tmp_filename):
+      os.remove(tmp_filename)
+
+def convert_file(in_filename, out_filename, map_fn, chunk_size):
+  """Convert one file; returns (num examples, num failures)."""
+  counts = {'examples': 0, 'failures': 0}
+  failures = []
+  def get_lines(results):
+    for chunk in results:
+      for line_num, out_line, error in chunk:
+        counts['examples'] += 1
+        if error is None:
+          yield out_line
+        else:
+          counts['failures'] += 1
+          failures.append('%d\t%s\t%s' % (line_num, error, out_line))
+  with open(in_filename) as f:
+    write_atomically(out_filename, get_lines(map_fn(convert_chunk, read_chunks(f, chunk_size))))
+  failures_filename = out_filename + '.failures'
+  if failures:
+    write_atomically(failures_filename, failures)
+  elif os.path.exists(failures_filename):
+    os.remove(failures_filename)
+  return counts['examples'], counts['failures']
+
+def get_input_files(paths):
+  filenames = []
+  for path in paths:
+    if os.path.isdir(path):
+      filenames.extend(sorted(glob.glob(os.path.join(path, '*.tsv'))))
+    else:
+      filenames.append(path)
+  return filenames
+
+def _parse_args():
+  parser = argparse.ArgumentParser(
+      description='Convert TSV datasets between logical forms and action sequences.')
+  parser.add_argument('converter', choices=list(CONVERTERS))
+  parser.add_argument('inputs', nargs='+', help='.tsv files or directories of them')
+  parser.add_argument('-o', '--out-dir', required=True, help='Directory to write outputs to')
+  parser.add_argument('-j', '--processes', type=int, default=multiprocessing.cpu_count(),
+                      help='Number of worker processes (1 converts in this process)')
+  parser.add_argument('--chunk-size', type=int, default=64,
+                      help='Examples sent to a worker at a time')
+  parser.add_argument('--grammar-dir', default=GRAMMAR_DIR,
+                      help='Directory with the .grammar files')
+  parser.add_argument('--verbose', action='store_true',
+                      help='Keep what the converters print')
+  return parser.parse_args()
+
+def main():
+  args = _parse_args()
+  filenames = get_input_files(args.inputs)
+  if not os.path.exists(args.out_dir):
+    os.makedirs(args.out_dir)
+  initargs = (args.converter, args.grammar_dir, args.verbose)
+  pool = None
+  if args.processes > 1:
+    pool = multiprocessing.Pool(args.processes, initializer=init_worker, initargs=initargs)
+    map_fn = pool.imap  # Keeps the order of the chunks.
+  else:
+    init_worker(*initargs)
+    map_fn = getattr(itertools, 'imap', map)
+  total_examples = 0
+  total_failures = 0
+  t0 = time.time()
+  try:
+    for filename in filenames:
+      out_filename = os.path.join(args.out_dir, os.path.basename(filename))
+      t1 = time.time()
+      num_examples, num_failures = convert_file(filename, out_filename, map_fn, args.chunk_size)
+      elapsed = time.time() - t1
+      print('%s: %d examples, %d failed, %.1f examples/s' % (
+          out_filename, num_examples, num_failures, num_examples / max(elapsed, 1e-6)))
+      total_examples += num_examples
+      total_failures += num_failures
+  finally:
+    if pool:
+      pool.close()
+      pool.join()
+  elapsed = time.time() - t0
+  print('Total: %d files, %d examples, %d failed, %.1f examples/s' % (
+      len(filenames), total_examples, total_failures, total_examples / max(elapsed, 1e-6)))
+  if total_failures:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,62 @@
+"""Memoization of the domain convertors (action sequence -> logical form).
+
+A convertor such as geoaction2seq.action2seq is a pure function of the
+action sequence, the two controllers (i.e. the grammars) and, for the
+replace variant, the entity lexicon map.  It is called for every example
+on every preprocessing pass and for every finished derivation at every
+evaluation, and many of those action sequences repeat, so
+MemoizedConvertor keeps the logical forms in a bounded LRU map.
+
+Controllers are part of the key by identity, so a convertor shared by
+controllers built from different grammars never mixes their results.
+"""
+import collections
+
+def get_kwargs_key(kwargs):
+  """A hashable key for keyword arguments whose values may be dicts."""
+  key = []
+  for name in sorted(kwargs):
+    value = kwargs[name]
+    if isinstance(value, dict):
+      value = tuple(sorted(value.items()))
+    key.append((name, value))
+  return tuple(key)
+
+class MemoizedConvertor(object):
+  """Wraps a convertor with a bounded LRU map from its arguments to its output."""
+  def __init__(self, convertor, max_size):
+    self.convertor = convertor
+    self.max_size = max_size
+    self.entries = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def __len__(self):
+    return len(self.entries)
+
+  def __call__(self, action_seq, domain_controller, general_controller, **kwargs):
+    key = (action_seq, domain_controller, general_controller, get_kwargs_key(kwargs))
+    value = self.entries.pop(key, None)
+    if value is not None:
+      self.hits += 1
+    else:
+      self.misses += 1
+      value = tuple(self.convertor(action_seq, domain_controller, general_controller, **kwargs))
+    self.entries[key] = value
+    while len(self.entries) > self.max_size:
+      self.entries.popitem(last=False)
+    # A new list each time, as callers may modify it.
+    return list(value)
+
+  def clear(self):
+    self.entries.clear()
+
+  def get_stats(self):
+    total = self.hits + self.misses
+    return {
+        'hits': self.hits,
+        'misses': self.misses,
+        'hit_rate': float(self.hits) / total if total else 0.0,
+        'size': len(self.entries),
+        'max_size': self.max_size,
+    }
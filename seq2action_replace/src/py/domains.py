@@ -1,11 +1,11 @@
 """A domain defines domain-specific processing."""
 import os
 import re
-import subprocess
 import sys
-import tempfile
 
 import atislexicon
+import evaluator
+import geoexecutor
 
 class Domain(object):
   """A semantic parsing domain. 
@@ -15,6 +15,12 @@ class Domain(object):
   By default, the methods here do the most generic thing.
   """
   DEFAULT_TRAIN_FILE = None
+  # If False and the evaluator is persistent, compare_answers only executes
+  # the derivations it needs to (see executes_lazily).
+  execute_all_derivations = False
+  # If True, print every executed request and compared denotation.
+  verbose = False
+
   def __init__(self):
     """Run some preprocessing of the dataset."""
     self.lex = None
@@ -57,6 +63,47 @@ class Domain(object):
   def compare_answers(self, true_answers, true_answers_lf, all_derivs):
     pass
 
+  def new_evaluator(self):
+    """Create the default evaluator for compare_answers."""
+    raise NotImplementedError
+
+  def new_local_evaluator(self):
+    """Create an in-process evaluator, or None if the domain has none."""
+    return None
+
+  def get_evaluator(self):
+    """Get the evaluator used by compare_answers."""
+    if getattr(self, 'evaluator', None) is None:
+      self.set_evaluator(self.new_evaluator())
+    return self.evaluator
+
+  def set_evaluator(self, ev):
+    """Use the given evaluator (e.g. a persistent worker) from now on."""
+    cache = getattr(self, 'denotation_cache', None)
+    if cache is not None:
+      ev = evaluator.CachingEvaluator(ev, cache)
+    self.evaluator = ev
+
+  def execute(self, requests):
+    """Print the requests and return the list of their denotations."""
+    if self.verbose:
+      for line in requests:
+        print line
+    return list(self.get_evaluator().execute(requests))
+
+  def executes_lazily(self):
+    """Whether compare_answers should use pick_derivations_lazily.
+
+    Each of its rounds is a call to the evaluator, and a BatchEvaluator
+    starts a process (a JVM for overnight) per call, so without a
+    persistent evaluator one call for all the derivations is cheaper.
+    """
+    return not self.execute_all_derivations and self.get_evaluator().persistent
+
+  def set_denotation_cache(self, cache):
+    """Only execute LFs missing from cache; call before set_evaluator()."""
+    self.denotation_cache = cache
+
 class GeoqueryDomain(Domain):
   DEFAULT_TRAIN_FILE = os.path.join( 
       os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
@@ -231,38 +278,53 @@ class GeoqueryDomain(Domain):
   def is_error(self, d):
     return 'FAILED' in d or 'Join failed syntactically' in d
 
+  def parse_evaluator_output(self, msg):
+    return [self.get_denotation(line)
+            for line in msg.split('\n')
+            if line.startswith('        Example')]
+
+  def new_evaluator(self):
+    return evaluator.BatchEvaluator(['evaluator/geoquery'], '.dlog',
+                                    self.parse_evaluator_output)
+
+  def new_local_evaluator(self):
+    # Opt-in until it agrees with evaluator/geoquery on the gold LFs
+    # (python geoexecutor.py compare ...).
+    return evaluator.LocalEvaluator(geoexecutor.get_executor().execute,
+                                    name='geoexecutor')
+
+  def get_request(self, lf):
+    return '_parse([query], %s).' % self.format_lf(lf)
+
   def compare_answers(self, true_answers, true_answers_lf, all_derivs):
-    all_derivs_lf = [' '.join(d.y_toks_lf) for x in all_derivs for d in x]
-    all_lfs = ([self.format_lf(s) for s in true_answers_lf] + [self.format_lf(s) for s in all_derivs_lf])
-    tf_lines = ['_parse([query], %s).' % lf for lf in all_lfs]
-    tf = tempfile.NamedTemporaryFile(suffix='.dlog')
-    for line in tf_lines:
-      print >>tf, line
-      print line
-    tf.flush()
-    msg = subprocess.check_output(['evaluator/geoquery', tf.name])
-    tf.close()
-    denotations = [self.get_denotation(line)
-                   for line in msg.split('\n')
-                   if line.startswith('        Example')]
-    true_dens = denotations[:len(true_answers)]
-    all_pred_dens = denotations[len(true_answers):]
-
-    print('denotations size: ', len(denotations))
-    print('true_dens size: ', len(true_dens))
-    print('all_pred_dens size: ', len(all_pred_dens))
-    print('all_derivs size: ', len(all_derivs))
-
-    # Find the top-scoring derivation that executed without error
-    derivs, pred_dens = pick_derivations(true_dens, all_pred_dens, all_derivs,
-                                         self.is_error)
-
-    print('pred_dens size: ', len(pred_dens))
+    true_requests = [self.get_request(s) for s in true_answers_lf]
+    if not self.executes_lazily():
+      all_derivs_lf = [' '.join(d.y_toks_lf) for x in all_derivs for d in x]
+      tf_lines = true_requests + [self.get_request(s) for s in all_derivs_lf]
+      denotations = self.execute(tf_lines)
+      true_dens = denotations[:len(true_answers)]
+      all_pred_dens = denotations[len(true_answers):]
+
+      if self.verbose:
+        print('denotations size: ', len(denotations))
+        print('true_dens size: ', len(true_dens))
+        print('all_pred_dens size: ', len(all_pred_dens))
+        print('all_derivs size: ', len(all_derivs))
+
+      # Find the top-scoring derivation that executed without error
+      derivs, pred_dens = pick_derivations(true_dens, all_pred_dens, all_derivs,
+                                           self.is_error)
+    else:
+      true_dens, derivs, pred_dens = pick_derivations_lazily(
+          true_requests, all_derivs,
+          lambda d: self.get_request(' '.join(d.y_toks_lf)),
+          self.execute, self.is_error)
 
     self.print_failures(true_dens, 'gold')
     self.print_failures(pred_dens, 'predicted')
-    for t, p in zip(true_dens, pred_dens):
-      print '%s: %s == %s' % (t == p, t, p)
+    if self.verbose:
+      for t, p in zip(true_dens, pred_dens):
+        print '%s: %s == %s' % (t == p, t, p)
     return derivs, [t == p for t, p in zip(true_dens, pred_dens)]
 
 def pick_derivations(true_dens, all_pred_dens, all_derivs, is_error_fn):
@@ -290,6 +352,61 @@ def pick_derivations(true_dens, all_pred_dens, all_derivs, is_error_fn):
     cur_start += len(deriv_set)
   return (derivs, pred_dens)
 
+def pick_derivations_lazily(true_requests, all_derivs, get_request, execute_fn,
+                            is_error_fn):
+  """Pick the same derivations as pick_derivations, executing fewer of them.
+
+  Executes the gold requests and the top derivation of every example, then,
+  round by round, the next derivation of only those examples whose latest
+  derivation failed to execute.
+
+  Args:
+    true_requests: Requests for the gold LFs.
+    all_derivs: List of beams (lists of derivations), one per example.
+    get_request: Function mapping a derivation to its request.
+    execute_fn: Function mapping a list of requests to their denotations.
+    is_error_fn: Function telling whether a denotation is an error.
+  Returns:
+    (true_dens, derivs, pred_dens).
+  """
+  derivs = [None] * len(all_derivs)
+  pred_dens = [None] * len(all_derivs)
+  pending = []
+  for i, deriv_set in enumerate(all_derivs):
+    if len(deriv_set) == 0:
+      print('Empty deriv set!')
+      pred_dens[i] = 'Empty denotation because of empty deriv!'
+    else:
+      pending.append(i)
+  true_dens = None
+  rank = 0
+  num_executed = 0
+  while true_dens is None or pending:
+    requests = [get_request(all_derivs[i][rank]) for i in pending]
+    num_executed += len(requests)
+    if true_dens is None:
+      denotations = execute_fn(list(true_requests) + requests)
+      true_dens = denotations[:len(true_requests)]
+      denotations = denotations[len(true_requests):]
+    else:
+      denotations = execute_fn(requests)
+    still_pending = []
+    for i, d in zip(pending, denotations):
+      if rank == 0:
+        # Default to first derivation
+        derivs[i] = all_derivs[i][0]
+        pred_dens[i] = d
+      if not is_error_fn(d):
+        derivs[i] = all_derivs[i][rank]
+        pred_dens[i] = d
+      elif rank + 1 < len(all_derivs[i]):
+        still_pending.append(i)
+    pending = still_pending
+    rank += 1
+  print('Executed %d of %d derivations in %d rounds' % (
+      num_executed, sum(len(x) for x in all_derivs), rank))
+  return true_dens, derivs, pred_dens
+
 class AtisDomain(Domain):
   DEFAULT_TRAIN_FILE = os.path.join( 
       os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
@@ -415,26 +532,33 @@ class OvernightDomain(Domain):
   def is_error(self, d):
     return 'BADJAVA' in d or 'ERROR' in d or d == 'null'
 
+  def parse_evaluator_output(self, msg):
+    return [line.split('\t')[1] for line in msg.split('\n')
+            if line.startswith('targetValue\t')]
+
+  def new_evaluator(self):
+    return evaluator.BatchEvaluator(['evaluator/overnight', self.subdomain],
+                                    '.examples', self.parse_evaluator_output)
+
   def compare_answers(self, true_answers, true_answers_lf, all_derivs):
-    all_lfs = ([self.format_lf(s) for s in true_answers] +
-               [self.format_lf(' '.join(d.y_toks))
-                for x in all_derivs for d in x])
-    tf_lines = all_lfs
-    tf = tempfile.NamedTemporaryFile(suffix='.examples')
-    for line in tf_lines:
-      print >> tf, line
-      print line
-    tf.flush()
-    msg = subprocess.check_output(['evaluator/overnight', self.subdomain, tf.name])
-    tf.close()
-    denotations = [line.split('\t')[1] for line in msg.split('\n')
-                   if line.startswith('targetValue\t')]
-    true_dens = denotations[:len(true_answers)]
-    all_pred_dens = denotations[len(true_answers):]
-    derivs, pred_dens = pick_derivations(true_dens, all_pred_dens, all_derivs,
-                                         self.is_error)
-    for t, p in zip(true_dens, pred_dens):
-      print '%s: %s == %s' % (t == p, t, p)
+    true_requests = [self.format_lf(s) for s in true_answers]
+    if not self.executes_lazily():
+      all_lfs = (true_requests +
+                 [self.format_lf(' '.join(d.y_toks))
+                  for x in all_derivs for d in x])
+      denotations = self.execute(all_lfs)
+      true_dens = denotations[:len(true_answers)]
+      all_pred_dens = denotations[len(true_answers):]
+      derivs, pred_dens = pick_derivations(true_dens, all_pred_dens, all_derivs,
+                                           self.is_error)
+    else:
+      true_dens, derivs, pred_dens = pick_derivations_lazily(
+          true_requests, all_derivs,
+          lambda d: self.format_lf(' '.join(d.y_toks)),
+          self.execute, self.is_error)
+    if self.verbose:
+      for t, p in zip(true_dens, pred_dens):
+        print '%s: %s == %s' % (t == p, t, p)
     return derivs, [t == p for t, p in zip(true_dens, pred_dens)]
 
   def clean_name(self, name):
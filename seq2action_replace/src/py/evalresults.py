@@ -0,0 +1,70 @@
+"""Streaming accumulation and output of evaluation results.
+
+Evaluation used to print about ten lines per example and keep parallel
+lists of per-example results until the end.  Instead, each example's
+result is added to an EvaluationMetrics accumulator (constant memory) and
+optionally written as one JSON record per line to a results file.
+"""
+import json
+
+class Accuracy(object):
+  """Running count of correct out of total."""
+  def __init__(self):
+    self.correct = 0
+    self.total = 0
+
+  def add(self, correct, total=1):
+    self.correct += int(correct)
+    self.total += total
+
+  def get_accuracy(self):
+    if self.total == 0:
+      return 0.0
+    return float(self.correct) / self.total
+
+  def to_stats(self):
+    return {
+        'correct': self.correct,
+        'total': self.total,
+        'accuracy': self.get_accuracy(),
+    }
+
+class EvaluationMetrics(object):
+  """Sequence-, token- and (optionally) denotation-level accuracy."""
+  def __init__(self):
+    self.sentence = Accuracy()
+    self.token = Accuracy()
+    self.denotation = None
+
+  def add(self, is_correct, tokens_correct, num_tokens, denotation_correct=None):
+    self.sentence.add(is_correct)
+    self.token.add(tokens_correct, num_tokens)
+    if denotation_correct is not None:
+      if self.denotation is None:
+        self.denotation = Accuracy()
+      self.denotation.add(denotation_correct)
+
+  def to_stats(self):
+    stats = {
+        'sentence': self.sentence.to_stats(),
+        'token': self.token.to_stats(),
+    }
+    if self.denotation is not None:
+      stats['denotation'] = self.denotation.to_stats()
+    return stats
+
+class ResultsWriter(object):
+  """Writes one JSON record per line to a buffered file."""
+  def __init__(self, filename, buffer_size=1 << 20):
+    self.filename = filename
+    self.out = open(filename, 'w', buffer_size)
+
+  def write(self, record):
+    self.out.write(json.dumps(record, sort_keys=True))
+    self.out.write('\n')
+
+  def flush(self):
+    self.out.flush()
+
+  def close(self):
+    self.out.close()
@@ -0,0 +1,317 @@
+"""Evaluators that execute logical forms and return their denotations.
+
+An Evaluator takes an iterable of requests (one per logical form, in the
+format the domain's executor expects) and yields one denotation per request,
+in order.  There are three kinds:
+  - BatchEvaluator: writes all requests to a temporary file and runs an
+      executor command over it, once per call.
+  - PipeEvaluator: talks to a persistent worker process, started once per
+      process, over its stdin/stdout.
+  - LocalEvaluator: calls a Python function; no process at all.
+A CachingEvaluator wraps any of these with a DenotationCache, so that only
+requests it has not seen before are executed.
+
+The worker protocol is line-delimited: the worker reads one request per line
+from stdin and, for each one, writes exactly one denotation line to stdout,
+in the same order, flushing after each response.  Requests are written as
+they come out of the iterable (e.g. as examples are decoded), while a
+separate thread keeps writing so that the pipes never fill up.
+
+Running this file is a Python stand-in for a worker, e.g. for tests:
+    python evaluator.py table answers.tsv [default_denotation]
+answers every request found in the first column of answers.tsv with the
+second column, and every other request with default_denotation.
+"""
+import atexit
+import collections
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+try:
+  import Queue as queue
+except ImportError:
+  import queue
+
+DENOTATION_CACHE_VERSION = 1
+
+def encode_request(request):
+  """Requests and responses must fit on one line."""
+  return request.replace('\r', ' ').replace('\n', ' ')
+
+class Evaluator(object):
+  """Executes requests and returns their denotations."""
+  # True if a call costs little more than its requests (no process to start).
+  persistent = False
+
+  def execute(self, requests):
+    """Yield the denotation of each request in order."""
+    raise NotImplementedError
+
+  def get_name(self):
+    """Identify the executor, so cached denotations are not mixed up."""
+    return self.__class__.__name__
+
+  def get_stats(self):
+    """Get statistics to report, if any."""
+    return None
+
+  def close(self):
+    pass
+
+class BatchEvaluator(Evaluator):
+  """Runs an executor command over a file of requests, once per call."""
+  def __init__(self, command, suffix, parse_output):
+    """Create a BatchEvaluator.
+
+    Args:
+      command: Command line (a list); the file name is appended to it.
+      suffix: Suffix for the temporary file.
+      parse_output: Function mapping the command's stdout to
+          the list of denotations.
+    """
+    self.command = command
+    self.suffix = suffix
+    self.parse_output = parse_output
+
+  def get_name(self):
+    return ' '.join(self.command)
+
+  def execute(self, requests):
+    tf = tempfile.NamedTemporaryFile(suffix=self.suffix, mode='w')
+    for request in requests:
+      tf.write(encode_request(request) + '\n')
+    tf.flush()
+    msg = subprocess.check_output(self.command + [tf.name])
+    tf.close()
+    return iter(self.parse_output(msg))
+
+class PipeEvaluator(Evaluator):
+  """Talks to a persistent worker process over the line protocol."""
+  persistent = True
+
+  def __init__(self, command):
+    self.command = command
+    self.proc = None
+    self.lock = threading.Lock()
+
+  def get_name(self):
+    return ' '.join(self.command)
+
+  def start(self):
+    if self.proc is None or self.proc.poll() is not None:
+      self.proc = subprocess.Popen(self.command, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE, bufsize=1,
+                                   universal_newlines=True)
+
+  def execute(self, requests):
+    with self.lock:
+      self.start()
+      # One True per request written, then None once all are written.
+      pending = queue.Queue()
+      errors = []
+      def write_requests():
+        try:
+          for request in requests:
+            self.proc.stdin.write(encode_request(request) + '\n')
+            self.proc.stdin.flush()
+            pending.put(True)
+        except Exception as e:
+          errors.append(e)
+        finally:
+          pending.put(None)
+      writer = threading.Thread(target=write_requests)
+      writer.daemon = True
+      writer.start()
+      done = False
+      try:
+        while pending.get() is not None:
+          line = self.proc.stdout.readline()
+          if not line:
+            raise IOError('Evaluator worker %s exited with code %s' % (
+                ' '.join(self.command), self.proc.poll()))
+          yield line.rstrip('\n')
+        done = True
+      finally:
+        if not done:
+          # The caller stopped early: read the responses to the requests
+          # already sent, so the next call starts in sync.
+          while pending.get() is not None:
+            self.proc.stdout.readline()
+      writer.join()
+      if errors:
+        raise errors[0]
+
+  def close(self):
+    if self.proc is not None and self.proc.poll() is None:
+      self.proc.stdin.close()
+      self.proc.wait()
+    self.proc = None
+
+class LocalEvaluator(Evaluator):
+  """Calls a Python function on each request."""
+  persistent = True
+
+  def __init__(self, execute_fn, name=None):
+    self.execute_fn = execute_fn
+    self.name = name
+
+  def get_name(self):
+    return self.name or Evaluator.get_name(self)
+
+  def execute(self, requests):
+    for request in requests:
+      yield self.execute_fn(request)
+
+class DenotationCache(object):
+  """A bounded LRU map from (executor name, request) to denotation.
+
+  If filename is given, the cache is loaded from it when created and can be
+  written back with save(), so denotations are reused across runs.
+  """
+  def __init__(self, max_size, filename=None):
+    self.max_size = max_size
+    self.filename = filename
+    self.entries = collections.OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.dirty = False
+    if filename and os.path.exists(filename):
+      self.load()
+
+  def __len__(self):
+    return len(self.entries)
+
+  def get(self, key):
+    """Get a cached denotation (marking it recently used), or None."""
+    if key not in self.entries:
+      self.misses += 1
+      return None
+    self.hits += 1
+    value = self.entries.pop(key)
+    self.entries[key] = value
+    return value
+
+  def put(self, key, value):
+    if key in self.entries:
+      del self.entries[key]
+    self.entries[key] = value
+    while len(self.entries) > self.max_size:
+      self.entries.popitem(last=False)
+    self.dirty = True
+
+  def get_stats(self):
+    total = self.hits + self.misses
+    return {
+        'hits': self.hits,
+        'misses': self.misses,
+        'hit_rate': float(self.hits) / total if total else 0.0,
+        'size': len(self.entries),
+    }
+
+  def load(self):
+    try:
+      with open(self.filename, 'rb') as f:
+        record = pickle.load(f)
+    except Exception as e:
+      sys.stderr.write('Ignoring unreadable denotation cache %s: %s\n' % (
+          self.filename, e))
+      return
+    if record.get('version') != DENOTATION_CACHE_VERSION:
+      return
+    for key, value in record['entries']:
+      self.put(key, value)
+    self.dirty = False
+
+  def save(self):
+    """Write the cache to a temporary file, then rename it into place."""
+    if not self.filename or not self.dirty:
+      return
+    dirname = os.path.dirname(os.path.abspath(self.filename))
+    if not os.path.isdir(dirname):
+      os.makedirs(dirname)
+    tmp_filename = '%s.tmp.%d' % (self.filename, os.getpid())
+    with open(tmp_filename, 'wb') as f:
+      pickle.dump({'version': DENOTATION_CACHE_VERSION,
+                   'entries': list(self.entries.items())},
+                  f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_filename, self.filename)
+    self.dirty = False
+
+class CachingEvaluator(Evaluator):
+  """Executes only the requests missing from a DenotationCache."""
+  def __init__(self, evaluator, cache):
+    self.evaluator = evaluator
+    self.cache = cache
+    self.persistent = evaluator.persistent
+
+  def get_name(self):
+    return self.evaluator.get_name()
+
+  def execute(self, requests):
+    name = self.evaluator.get_name()
+    requests = list(requests)
+    denotations = {}
+    misses = []
+    for request in requests:
+      if request in denotations:
+        continue
+      denotation = self.cache.get((name, request))
+      if denotation is None:
+        misses.append(request)
+        denotations[request] = None
+      else:
+        denotations[request] = denotation
+    if misses:
+      for request, denotation in zip(misses, self.evaluator.execute(misses)):
+        denotations[request] = denotation
+        self.cache.put((name, request), denotation)
+      self.cache.save()
+    return iter([denotations[request] for request in requests])
+
+  def get_stats(self):
+    return self.cache.get_stats()
+
+  def close(self):
+    self.cache.save()
+    self.evaluator.close()
+
+# Persistent workers of this process, keyed by command.
+_WORKERS = {}
+
+def get_worker(command):
+  """Get the PipeEvaluator for a command, starting it on first use."""
+  key = tuple(command)
+  if key not in _WORKERS:
+    _WORKERS[key] = PipeEvaluator(list(command))
+  return _WORKERS[key]
+
+def close_workers():
+  for worker in _WORKERS.values():
+    worker.close()
+  _WORKERS.clear()
+
+atexit.register(close_workers)
+
+def serve(execute_fn, fin=sys.stdin, fout=sys.stdout):
+  """Run the worker side of the protocol until fin is closed."""
+  for line in iter(fin.readline, ''):
+    fout.write(encode_request(execute_fn(line.rstrip('\n'))) + '\n')
+    fout.flush()
+
+def main():
+  if len(sys.argv) < 3 or sys.argv[1] != 'table':
+    sys.stderr.write('Usage: %s table answers.tsv [default_denotation]\n' % sys.argv[0])
+    sys.exit(1)
+  default = sys.argv[3] if len(sys.argv) > 3 else 'null'
+  with open(sys.argv[2]) as f:
+    table = dict(line.rstrip('\n').split('\t', 1) for line in f if '\t' in line)
+  serve(lambda request: table.get(request, default))
+
+if __name__ == '__main__':
+  main()
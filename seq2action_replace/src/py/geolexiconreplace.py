@@ -8,6 +8,7 @@ import re
 import sys
 
 from lexiconreplace import LexiconReplace
+import lexiconcache
 
 LEXICON_DIR = os.path.join(
     os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'lexicon')
@@ -81,8 +82,13 @@ def get_ccg_lexicon():
   lexicon.add_entries(entries)
   return lexicon
 
+def get_cached_ccg_lexicon():
+  return lexiconcache.load_or_build(
+      'geo-replace-ccg', [os.path.join(LEXICON_DIR, 'geo-lexicon-for-replace.txt')],
+      get_ccg_lexicon)
+
 def get_lexicon(basename='', newname=''):
-  return get_ccg_lexicon()
+  return get_cached_ccg_lexicon()
   #return get_lexicon_from_raw_lexicon_then_write(basename, newname)
 
 def extract_entity_from_action(action):
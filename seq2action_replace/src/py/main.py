@@ -9,6 +9,7 @@ import numpy
 import os
 import random
 import re
+import shlex
 import sys
 import theano
 
@@ -16,7 +17,10 @@ import theano
 import atislexicon
 import geolexicon
 from augmentation import Augmenter
+import convertorcache
 import domains
+import evalresults
+import evaluator
 from attention import AttentionModel
 from example import Example
 import spec as specutil
@@ -61,6 +65,9 @@ OPTIONS = None
 # Global statistics
 STATS = {}
 
+# Per-example evaluation results (see evalresults.py)
+RESULTS_WRITER = None
+
 def _parse_args():
   global OPTIONS
   parser = argparse.ArgumentParser(
@@ -116,6 +123,24 @@ def _parse_args():
                       help='Use beam search with given beam size (default is greedy).')
   parser.add_argument('--domain', default=None,
                       help='Domain for augmentation and evaluation (options: [geoquery,atis,overnight-${domain}])')
+  parser.add_argument('--denotation-cache-size', type=int, default=100000,
+                      help='Number of LF denotations to cache across evaluations (0 to disable).')
+  parser.add_argument('--denotation-cache-file', default=None,
+                      help='File to persist the denotation cache in across runs.')
+  parser.add_argument('--convertor-cache-size', type=int, default=100000,
+                      help='Number of action sequences whose logical forms are cached (0 to disable).')
+  parser.add_argument('--execute-all-derivations', action='store_true',
+                      help=('Execute every derivation in every beam, instead of '
+                            'only until one per example executes without error '
+                            '(which is the default with --local-evaluator or '
+                            '--evaluator-worker).'))
+  parser.add_argument('--local-evaluator', action='store_true',
+                      help=('Use the domain\'s in-process executor (geoquery) '
+                            'instead of its external evaluator binary.'))
+  parser.add_argument('--evaluator-worker', default=None,
+                      help=('Command of a persistent evaluator worker that speaks '
+                            'the line protocol of evaluator.py (default: the '
+                            'domain\'s own evaluator).'))
   parser.add_argument('--augment', '-a',
                       help=('Options for augmentation.  Format: '
                             '"nesting+entity+concat2".'))
@@ -143,6 +168,10 @@ def _parse_args():
   parser.add_argument('--save-file', help='Path to save parameters.')
   parser.add_argument('--load-file', help='Path to load parameters, will ignore other passed arguments.')
   parser.add_argument('--stats-file', help='Path to save statistics (JSON format).')
+  parser.add_argument('--results-file',
+                      help='Path to save per-example evaluation results (JSON lines).')
+  parser.add_argument('--verbose-eval', action='store_true',
+                      help='Print per-example evaluation results and executed LFs.')
   parser.add_argument('--shell', action='store_true', 
                       help='Start an interactive shell.')
   parser.add_argument('--server', action='store_true', 
@@ -315,44 +344,23 @@ def get_model(spec):
     model = constructor(spec, distract_num=OPTIONS.distract_num)
   return model
 
-def print_accuracy_metrics(name, is_correct_list, tokens_correct_list,
-                           x_len_list, y_len_list, denotation_correct_list):
-  # Overall metrics
-  num_examples = len(is_correct_list)
-  num_correct = sum(is_correct_list)
-  num_tokens_correct = sum(tokens_correct_list)
-  num_tokens = sum(y_len_list)
-  seq_accuracy = float(num_correct) / num_examples
-  token_accuracy = float(num_tokens_correct) / num_tokens
-
-  STATS[name] = {}
+def print_accuracy_metrics(name, metrics):
+  STATS[name] = metrics.to_stats()
 
   # Print sequence-level accuracy
-  STATS[name]['sentence'] = {
-      'correct': num_correct,
-      'total': num_examples,
-      'accuracy': seq_accuracy,
-  }
-  print 'Sequence-level accuracy: %d/%d = %g' % (num_correct, num_examples, seq_accuracy)
+  print 'Sequence-level accuracy: %d/%d = %g' % (
+      metrics.sentence.correct, metrics.sentence.total,
+      metrics.sentence.get_accuracy())
 
   # Print token-level accuracy
-  STATS[name]['token'] = {
-      'correct': num_tokens_correct,
-      'total': num_tokens,
-      'accuracy': token_accuracy,
-  }
-  print 'Token-level accuracy: %d/%d = %g' % (num_tokens_correct, num_tokens, token_accuracy)
+  print 'Token-level accuracy: %d/%d = %g' % (
+      metrics.token.correct, metrics.token.total, metrics.token.get_accuracy())
 
   # Print denotation-level accuracy
-  if denotation_correct_list:
-    denotation_correct = sum(denotation_correct_list)
-    denotation_accuracy = float(denotation_correct)/num_examples
-    STATS[name]['denotation'] = {
-        'correct': denotation_correct,
-        'total': num_examples,
-        'accuracy': denotation_accuracy
-    }
-    print 'Denotation-level accuracy: %d/%d = %g' % (denotation_correct, num_examples, denotation_accuracy)
+  if metrics.denotation is not None:
+    print 'Denotation-level accuracy: %d/%d = %g' % (
+        metrics.denotation.correct, metrics.denotation.total,
+        metrics.denotation.get_accuracy())
 
 def decode(model, ex, domain_convertor, domain_controller, general_controller):
   if OPTIONS.beam_size == 0:
@@ -361,71 +369,90 @@ def decode(model, ex, domain_convertor, domain_controller, general_controller):
     return model.decode_beam(OPTIONS.domain, ex, domain_convertor, domain_controller, general_controller, beam_size=OPTIONS.beam_size)
 
 def evaluate(name, model, domain_convertor, domain_controller, general_controller, dataset, domain=None):
-  """Evaluate the model. """
-  in_vocabulary = model.in_vocabulary
-  out_vocabulary = model.out_vocabulary
-
-  is_correct_list = []
-  tokens_correct_list = []
-  x_len_list = []
-  y_len_list = []
+  """Evaluate the model.
 
+  Metrics are accumulated as examples are scored.  Per-example results are
+  written to the --results-file, and printed only with --verbose-eval.
+  """
+  cache = None
   if domain:
     all_derivs = [decode(model, ex, domain_convertor, domain_controller, general_controller) for ex in dataset]
     true_answers = [ex.y_str for ex in dataset]
     true_answers_lf = [ex.y_str_lf for ex in dataset]
+    cache = getattr(domain, 'denotation_cache', None)
+    if cache is not None:
+      cache_stats = cache.get_stats()
     derivs, denotation_correct_list = domain.compare_answers(true_answers, true_answers_lf, all_derivs)
   else:
     derivs = [decode(model, ex, domain_convertor, domain_controller, general_controller)[0] for ex in dataset]
     denotation_correct_list = None
 
-  print('derivs size: ', len(derivs))
-  print('denotation_correct_list: ', len(denotation_correct_list))
-  print('dataset size: ', len(dataset))
-
+  metrics = evalresults.EvaluationMetrics()
   for i, ex in enumerate(dataset):
-    print 'Example %d' % i
-    print '  x         = "%s"' % ex.x_str
-    print '  y         = "%s"' % ex.y_str
-    if derivs[i] == None:
-        y_pred_toks = []
-        y_pred_str = ''
-        y_pred_str_lf = ''
-        p_list = []
-        entity_lex = {}
+    if derivs[i] is None:
+      y_pred_toks = []
+      y_pred_str_lf = ''
+      entity_lex = {}
+      p_list = []
     else:
-        y_pred_toks = derivs[i].y_toks
-        y_pred_str = ' '.join(y_pred_toks)
-        y_pred_toks_lf = derivs[i].y_toks_lf
-        y_pred_str_lf = ' '.join(y_pred_toks_lf)
-        p_list = derivs[i].p_list
-        entity_lex = derivs[i].entity_lex_map
+      y_pred_toks = derivs[i].y_toks
+      y_pred_str_lf = ' '.join(derivs[i].y_toks_lf)
+      entity_lex = derivs[i].entity_lex_map
+      p_list = derivs[i].p_list
+    y_pred_str = ' '.join(y_pred_toks)
 
     # Compute accuracy metrics
     is_correct = (y_pred_str == ex.y_str)
     tokens_correct = sum(a == b for a, b in zip(y_pred_toks, ex.y_toks))
-    is_correct_list.append(is_correct)
-    tokens_correct_list.append(tokens_correct)
-    x_len_list.append(len(ex.x_toks))
-    y_len_list.append(len(ex.y_toks))
-    y_str_for_query = ex.y_str_lf.replace('_', '').replace(' ', '')
-    y_pred_str_for_query = y_pred_str_lf.replace('_', '').replace(' ', '')
-
-    print('  y_pred (len = %s)    = "%s"' % (str(len(y_pred_str.split(' '))), y_pred_str))
-    print('  p_list (len = %s)    = ' % (str(len(p_list))) , p_list)
-    print('  y_lf      = "%s"' % ex.y_str_lf)
-    print('  y_pred_lf = "%s"' % y_pred_str_lf)
-    #print('  y_str_for_query = "%s"' % y_str_for_query)
-    #print('  y_pred_str_for_query = "%s"' % y_pred_str_for_query)
-    print('  entity_lex = "%s"' % entity_lex)
-    print('  sequence correct = %s' % is_correct)
-    print('  token accuracy = %d/%d = %g' % (
-        tokens_correct, len(ex.y_toks), float(tokens_correct) / len(ex.y_toks)))
-    if denotation_correct_list:
+    denotation_correct = None
+    if denotation_correct_list is not None:
       denotation_correct = denotation_correct_list[i]
-      print('  denotation correct = %s' % denotation_correct)
-  print_accuracy_metrics(name, is_correct_list, tokens_correct_list,
-                         x_len_list, y_len_list, denotation_correct_list)
+    metrics.add(is_correct, tokens_correct, len(ex.y_toks), denotation_correct)
+
+    if RESULTS_WRITER:
+      RESULTS_WRITER.write({
+          'split': name,
+          'index': i,
+          'x': ex.x_str,
+          'y': ex.y_str,
+          'y_pred': y_pred_str,
+          'y_lf': ex.y_str_lf,
+          'y_pred_lf': y_pred_str_lf,
+          'entity_lex': entity_lex,
+          'p_list': [float(p) for p in p_list],
+          'sequence_correct': is_correct,
+          'tokens_correct': int(tokens_correct),
+          'num_tokens': len(ex.y_toks),
+          'denotation_correct': denotation_correct,
+      })
+    if OPTIONS.verbose_eval:
+      print 'Example %d' % i
+      print '  x         = "%s"' % ex.x_str
+      print '  y         = "%s"' % ex.y_str
+      print('  y_pred (len = %s)    = "%s"' % (str(len(y_pred_str.split(' '))), y_pred_str))
+      print('  p_list (len = %s)    = ' % (str(len(p_list))) , p_list)
+      print('  y_lf      = "%s"' % ex.y_str_lf)
+      print('  y_pred_lf = "%s"' % y_pred_str_lf)
+      print('  entity_lex = "%s"' % entity_lex)
+      print('  sequence correct = %s' % is_correct)
+      print('  token accuracy = %d/%d = %g' % (
+          tokens_correct, len(ex.y_toks), float(tokens_correct) / len(ex.y_toks)))
+      if denotation_correct is not None:
+        print('  denotation correct = %s' % denotation_correct)
+  if RESULTS_WRITER:
+    RESULTS_WRITER.flush()
+  print_accuracy_metrics(name, metrics)
+  if cache is not None:
+    hits = cache.hits - cache_stats['hits']
+    misses = cache.misses - cache_stats['misses']
+    if hits + misses > 0:
+      STATS[name]['denotation_cache'] = {
+          'hits': hits,
+          'misses': misses,
+          'hit_rate': float(hits) / (hits + misses),
+          'size': len(cache),
+      }
+      print 'Denotation cache hits: %d/%d' % (hits, hits + misses)
 
 def run_shell(model):
   print('==== Neural Network Semantic Parsing REPL ====')
@@ -588,10 +615,26 @@ def write_stats():
     out.close()
 
 def run():
+  global RESULTS_WRITER
   configure_theano()
+  if OPTIONS.results_file:
+    RESULTS_WRITER = evalresults.ResultsWriter(OPTIONS.results_file)
   domain = None
   if OPTIONS.domain:
     domain = domains.new(OPTIONS.domain)
+    domain.execute_all_derivations = OPTIONS.execute_all_derivations
+    domain.verbose = OPTIONS.verbose_eval
+    if OPTIONS.denotation_cache_size > 0:
+      domain.set_denotation_cache(evaluator.DenotationCache(
+          OPTIONS.denotation_cache_size, filename=OPTIONS.denotation_cache_file))
+    if OPTIONS.evaluator_worker:
+      domain.set_evaluator(evaluator.get_worker(shlex.split(OPTIONS.evaluator_worker)))
+    elif OPTIONS.local_evaluator:
+      local_evaluator = domain.new_local_evaluator()
+      if local_evaluator is None:
+        print >> sys.stderr, 'Domain %s has no in-process executor' % OPTIONS.domain
+        sys.exit(1)
+      domain.set_evaluator(local_evaluator)
   train_raw, dev_raw = load_raw_all(domain=domain)
   databases = load_databases(OPTIONS.domain_grammar, domain=domain)
   random.seed(OPTIONS.model_seed)
@@ -606,6 +649,9 @@ def run():
   domain_controller = constructor2(OPTIONS.domain_grammar, use_domain_ontology)
   constructor3 = CONVERTORS[OPTIONS.domain_convertor]
   domain_convertor = constructor3
+  if OPTIONS.convertor_cache_size > 0:
+    domain_convertor = convertorcache.MemoizedConvertor(
+        domain_convertor, OPTIONS.convertor_cache_size)
 
 
 
@@ -634,7 +680,11 @@ def run():
   if dev_raw:
     evaluate_dev(model, domain_convertor, domain_controller, general_controller, dev_raw, domain=domain)
 
+  if isinstance(domain_convertor, convertorcache.MemoizedConvertor):
+    STATS['convertor_cache'] = domain_convertor.get_stats()
   write_stats()
+  if RESULTS_WRITER:
+    RESULTS_WRITER.close()
 
   if OPTIONS.shell:
     run_shell(model)
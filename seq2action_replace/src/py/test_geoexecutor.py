@@ -0,0 +1,99 @@
+"""Tests of the in-process Geoquery executor.
+
+The higher-order predicates are checked against the answers of the
+DatalogInterpreter of evaluator/geoquery.  If that binary is built, the
+denotations of all the gold LFs of geo880 are compared with its own.
+"""
+import glob
+import os
+import unittest
+
+import geoexecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+REFERENCE_EVALUATOR = os.path.join(ROOT, 'evaluator/geoquery')
+
+def get_geo880_files():
+  if os.environ.get('GEO880_FILES'):
+    return os.environ['GEO880_FILES'].split(':')
+  return sorted(glob.glob(os.path.join(ROOT, 'data/geo880/*/*.tsv')) +
+                glob.glob(os.path.join(ROOT, 'action/geo880/seq0/*.tsv')))
+
+class GeoExecutorTest(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.executor = geoexecutor.get_executor()
+
+  def check(self, lf, denotation):
+    self.assertEqual(self.executor.execute('_parse([query], %s).' % lf), denotation)
+
+  def test_conjunction(self):
+    self.check('answer(A,(state(A),next_to(A,B),const(B,stateid(texas))))',
+               '{stateid(arkansas), stateid(louisiana), stateid(new mexico), '
+               'stateid(oklahoma)}')
+
+  def test_superlative_of_number(self):
+    self.check('answer(A,largest(A,(state(B),population(B,A))))', '{23670000}')
+
+  def test_superlative_is_solved_on_its_own(self):
+    self.check('answer(A,smallest(A,state(A)))', '{stateid(district of columbia)}')
+    # The largest state of all is not next to texas.
+    self.check('answer(A,(const(B,stateid(texas)),largest(A,(state(A),next_to(A,B)))))',
+               '{}')
+
+  def test_most_and_fewest(self):
+    self.check('answer(A,most(A,B,(state(A),next_to(A,B))))',
+               '{stateid(missouri), stateid(tennessee)}')
+    # States with no neighbors count as having none.
+    self.check('answer(A,fewest(A,B,(state(A),next_to(A,B))))',
+               '{stateid(alaska), stateid(hawaii)}')
+
+  def test_count_the_min_max(self):
+    self.check('answer(A,count(B,state(B),A))', '{51}')
+    self.check('answer(A,the(B,(state(B),next_to(B,C),const(C,stateid(texas))),A))',
+               '{stateid(arkansas), stateid(louisiana), stateid(new mexico), '
+               'stateid(oklahoma)}')
+    self.check('answer(A,max(P,(state(B),population(B,P)),A))', '{23670000}')
+    self.check('answer(A,min(P,(state(B),population(B,P),const(B,stateid(utah))),A))',
+               '{1461000}')
+    self.check('answer(A,max(P,(state(B),population(B,P),const(B,cityid(austin,tx))),A))',
+               '{}')
+    self.check('answer(A,max(B,state(B),A))', geoexecutor.EXECUTE_ERROR)
+
+  def test_sum_argmin_argmax(self):
+    self.check('answer(A,sum(C,(state(C),next_to(C,B),const(B,stateid(utah))),area(C),A))',
+               '{630909}')
+    self.check('answer(A,sum(C,(state(C),const(C,cityid(austin,tx))),area(C),A))',
+               geoexecutor.EXECUTE_ERROR)
+    self.check('answer(A,argmax(B,state(B),population(B),A))', '{stateid(california)}')
+    self.check('answer(A,argmin(B,(state(B),next_to(B,C),const(C,stateid(texas))),area(B),A))',
+               '{stateid(louisiana)}')
+
+  def test_negation_sees_earlier_bindings_only(self):
+    self.check('answer(A,(state(A),\\+next_to(A,B)))', '{stateid(alaska), stateid(hawaii)}')
+    self.check('answer(A,(state(A),\\+loc(B,A),const(B,cityid(austin,tx))))', '{}')
+
+  def test_errors(self):
+    self.check('answer(A,state(A)', geoexecutor.PARSE_ERROR)
+    self.check('answer(A,sum(C,state(C),A))', geoexecutor.EXECUTE_ERROR)
+
+@unittest.skipUnless(os.path.exists(REFERENCE_EVALUATOR), 'evaluator/geoquery is not built')
+class ReferenceTest(unittest.TestCase):
+  def test_geo880_gold(self):
+    import domains
+    filenames = get_geo880_files()
+    if not filenames:
+      self.skipTest('No geo880 data')
+    domain = domains.GeoqueryDomain()
+    requests = [domain.get_request(lf) for lf in geoexecutor.read_gold_lfs(filenames)]
+    cwd = os.getcwd()
+    os.chdir(ROOT)
+    try:
+      diffs = geoexecutor.compare(requests, geoexecutor.get_executor(),
+                                  domain.new_evaluator())
+    finally:
+      os.chdir(cwd)
+    self.assertEqual(diffs, [])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,34 +1,66 @@
-"""Check if two params files have all the same values."""
+"""Check if two params files have all the same values.
+
+Each file is either a checkpoint (see checkpoint.py) or a spec pickled by
+an older spec.save().  Tensors are compared by name, one block of values at
+a time; tensors of checkpoints are memory-mapped, so neither file is ever
+read into memory whole.
+"""
 import numpy
 import sys
 
-import main as util  # Get all the requisite imports here
+import checkpoint
 
 TOL=1e-10
+BLOCK_SIZE=1 << 20  # Values compared at a time
 
 def read(filename):
+  """Get an iterator over the (name, value) of each tensor in a file."""
+  if checkpoint.is_checkpoint(filename):
+    return checkpoint.CheckpointReader(filename).iter_tensors()
+  import main as util  # Get all the requisite imports here
   spec = util.specutil.load(filename)
-  params = spec.get_params()
-  vals = [x.get_value() for x in params]
-  return vals
+  return ((name, param.get_value()) for name, param in checkpoint.get_named_params(spec))
+
+def compare(x1, x2):
+  """Get the number of values that differ and the largest difference."""
+  x1 = x1.reshape(-1)
+  x2 = x2.reshape(-1)
+  num_diff = 0
+  max_diff = 0.0
+  for start in range(0, len(x1), BLOCK_SIZE):
+    diffs = numpy.abs(x1[start:start + BLOCK_SIZE].astype(numpy.float64) -
+                      x2[start:start + BLOCK_SIZE].astype(numpy.float64))
+    num_diff += int(numpy.sum(~(diffs < TOL)))
+    if len(diffs):
+      max_diff = max(max_diff, float(numpy.max(diffs)))
+  return num_diff, max_diff
 
 def check(f1, f2):
-  p1 = read(f1)
-  p2 = read(f2)
+  p2 = dict(read(f2))
   all_equal = True
-  for x1, x2 in zip(p1, p2):
-    diffs = numpy.abs(x1 - x2)
-    is_equal = numpy.all(diffs < TOL)
-    if not is_equal:
+  for name, x1 in read(f1):
+    if name not in p2:
+      all_equal = False
+      print 'Only in %s: %s' % (f1, name)
+      continue
+    x2 = p2.pop(name)
+    if x1.shape != x2.shape:
+      all_equal = False
+      print 'Not equal: %s has shape %s and %s' % (name, x1.shape, x2.shape)
+      continue
+    num_diff, max_diff = compare(x1, x2)
+    if num_diff:
       all_equal = False
-      print 'Not equal:'
-      print x1
-      print x2
+      print 'Not equal: %s (%d of %d values, max difference %g)' % (
+          name, num_diff, x1.size, max_diff)
+  for name in p2:
+    all_equal = False
+    print 'Only in %s: %s' % (f2, name)
   if all_equal:
     print 'All equal! (within %g)' % TOL
 
 def main():
-  if len(sys.argv) == 1:
+  if len(sys.argv) != 3:
     print >> sys.stderr, 'Usage: %s params_1 params_2' % sys.argv[0]
     sys.exit(1)
   check(*sys.argv[1:])